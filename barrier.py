@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Fan-in barriers for the stages of a ranking run.  Each task in a stage
+# arrives at the stage's barrier when it's done (whether it succeeded or gave
+# up), and whichever task arrives last moves the run on to the next stage.
+# Arrivals are recorded in the datastore so that a retried task can't be
+# counted twice, and a memcache counter tracks how many are still outstanding
+# so that the last task can tell it's the last without a query.
+
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from ctrpmodels import StageArrival
+
+class Barrier(object):
+
+    def __init__(self, run_id, stage):
+        self.run_id = str(run_id)
+        self.stage = stage
+        self.namespace = 'run-%s' % self.run_id
+        self.counter = 'pending-%s' % stage
+
+    # Sets up the barrier for a stage with the given number of members.  This
+    # has to happen before any of the stage's tasks are queued.  Starting a
+    # stage a second time leaves the counter alone, since some of its tasks
+    # may have already arrived.
+    def start(self, expected):
+        memcache.add(self.counter, expected, namespace=self.namespace)
+
+    # Records that a member of the stage is done.  Returns True if that was the
+    # last member the barrier was waiting for.
+    def arrive(self, member, failed=False):
+        if not self._record(member, failed):
+            # a retry of a task that already arrived.  it can't be the last one
+            # in, but it may be retrying because it failed after it arrived, so
+            # let it move the run on if everything else is done.
+            return self.remaining() == 0
+
+        remaining = memcache.decr(self.counter, namespace=self.namespace)
+        if remaining is None:
+            # the counter got evicted.  leave it to the run's sweeper, which
+            # counts the arrivals in the datastore instead.
+            logging.warning('Barrier counter for %s in run %s is missing', self.stage, self.run_id)
+            return False
+
+        logging.info('Barrier for %s in run %s: %d remaining', self.stage, self.run_id, remaining)
+        return remaining == 0
+
+    # Returns the number of members that haven't arrived yet, according to the
+    # counter, or None if the counter is gone.
+    def remaining(self):
+        value = memcache.get(self.counter, namespace=self.namespace)
+        if value is None:
+            return None
+        return int(value)
+
+    # Counts the arrivals recorded in the datastore.  This is slower than the
+    # counter and only eventually consistent, so it's only for the sweeper.
+    def count_arrivals(self):
+        return StageArrival.query(StageArrival.run == self.run_id,
+                                  StageArrival.stage == self.stage).count()
+
+    # Writes the arrival marker for a member, returning False if it was already
+    # there.
+    @ndb.transactional
+    def _record(self, member, failed):
+        key = ndb.Key(StageArrival, StageArrival.make_id(self.run_id, self.stage, member))
+        if key.get() is not None:
+            return False
+        StageArrival(key=key, run=self.run_id, stage=self.stage, failed=failed).put()
+        return True
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Shared setup for the scripts in bench/.  These run outside of dev_appserver
+# so the App Engine SDK needs to be importable.  Point the GAE_SDK environment
+# variable at the SDK's root directory (the one that contains
+# dev_appserver.py) if it isn't already on the python path.
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def setup_path():
+    sdk = os.environ.get('GAE_SDK')
+    if sdk and sdk not in sys.path:
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+
+    # the app itself, plus the vendored libraries from appengine_config
+    for path in (os.path.join(ROOT, 'lib'), ROOT):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+# Runs func the requested number of times and returns the list of wall times
+# for each run, in seconds.
+def time_runs(func, runs):
+    times = list()
+    for _ in xrange(runs):
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+    return times
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = int(round((pct / 100.0) * (len(ordered) - 1)))
+    return ordered[index]
+
+def report(label, times):
+    print('%-40s runs: %5d  p50: %9.3f ms  p99: %9.3f ms  total: %8.3f s' % (
+        label, len(times), percentile(times, 50) * 1000.0,
+        percentile(times, 99) * 1000.0, sum(times)))
+
+# Activates a testbed with in-memory stubs for the datastore, memcache and the
+# task queue, and returns it.  The caller should deactivate it when done.
+def start_testbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+
+    # make the datastore stub strongly consistent so that queries see writes
+    # immediately, the same as the benchmarks expect.
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_urlfetch_stub()
+    bed.init_app_identity_stub()
+    ndb.get_context().clear_cache()
+    return bed
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Compares decoding character responses in full (json.loads, then trimming the
+# result down) with wowapi.project_character, which only decodes the fields the
+# ranker uses.  Reports the decode time per toon and the number of objects each
+# approach builds.  Pass a directory of recorded responses (one response per
+# .json file) to use those instead of the synthetic payloads.
+#
+# Usage: python bench/decode_bench.py [runs] [sample directory]
+
+from __future__ import print_function
+
+import glob
+import json
+import os
+import sys
+
+import benchutil
+benchutil.setup_path()
+
+import wowapi
+
+import fakedata
+
+def load_samples(directory):
+    if directory:
+        samples = list()
+        for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+            with open(path) as sample:
+                samples.append(sample.read())
+        return samples
+
+    samples = list()
+    for i in xrange(20):
+        toons = fakedata.make_group('Decode %d' % i, size=1, core=1, killed=i % 9)
+        samples.append(json.dumps(toons[0], separators=(',', ':')))
+    return samples
+
+# Counts every dict, list and scalar in a decoded object.
+def count_objects(obj):
+    count = 1
+    if isinstance(obj, dict):
+        for (key, value) in obj.iteritems():
+            count += 1 + count_objects(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            count += count_objects(value)
+    return count
+
+def full_decode(content):
+    return wowapi.project_decoded(json.loads(content))
+
+def main(runs, directory):
+    samples = load_samples(directory)
+    if not samples:
+        print('no samples found')
+        return 1
+
+    fallbacks = 0
+    full_objects = 0
+    projected_objects = 0
+    for content in samples:
+        projected = wowapi.project_character(content)
+        if projected is None:
+            fallbacks += 1
+            continue
+        if projected != full_decode(content):
+            print('MISMATCH between the projected and full decode')
+            return 1
+        full_objects += count_objects(json.loads(content))
+        projected_objects += count_objects(projected)
+
+    size = sum(len(content) for content in samples) / len(samples)
+    print('%d samples, %d bytes on average, %d fell back to a full decode' % (
+        len(samples), size, fallbacks))
+    print('objects built per toon: full %d, projected %d' % (
+        full_objects / len(samples), projected_objects / len(samples)))
+
+    def decode_all(decode):
+        return lambda: [decode(content) for content in samples]
+
+    benchutil.report('full decode, per %d toons' % len(samples),
+                     benchutil.time_runs(decode_all(full_decode), runs))
+    benchutil.report('projected decode, per %d toons' % len(samples),
+                     benchutil.time_runs(decode_all(wowapi.project_character), runs))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50,
+                  sys.argv[2] if len(sys.argv) > 2 else None))
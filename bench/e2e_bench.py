@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Runs a whole ranking run offline: POST /rank, every fetcher and builder task
+# the run queues, and finish_building at the end, against the fake Battle.net
+# and the testbed's in-memory datastore, memcache and task queue.  Reports the
+# wall time, the API calls, the datastore and memcache calls and the peak
+# memory for synthetic communities of a few sizes.  Each size runs in its own
+# process so that the peak resident set size belongs to that size alone.
+#
+# The tasks run one at a time, so the wall time is the total time spent in
+# the tasks rather than the time the queue would take to get through them.
+# Tasks that fail are retried with the retry count header set, up to the
+# limit from queue.yaml, the same as the task queue does.
+#
+# With --runs, the community is ranked more than once, with the toon cache
+# aged past its freshness window, the kills from the run before aged past the
+# ranker's window for active groups, and nothing changed in between, the way a
+# quiet stretch between raid nights looks.  The first run is always full, since
+# there hasn't been one before it.  The runs after it are incremental unless
+# --full is passed, so comparing the two shows what the incremental runs save.
+# The saved results and the comparison against the baseline use the last run.
+#
+# Results can be saved with --save and compared against a saved baseline with
+# --baseline, in which case the script exits with an error if any size got
+# slower, bigger or chattier than the baseline by more than the tolerances.
+#
+# Usage: python bench/e2e_bench.py [--sizes 100,1000,10000] [--latency 0.0]
+#            [--error-rate 0.0] [--runs 1] [--full] [--save results.json]
+#            [--baseline results.json]
+
+from __future__ import print_function
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import timeit
+
+import benchutil
+benchutil.setup_path()
+
+DEFAULT_SIZES = (100, 1000, 10000)
+
+# The number of toons on each roster, and the size of the community's pool of
+# toons as a multiple of the number of groups.  Drawing the rosters from a pool
+# smaller than the rosters put together gives some toons more than one group,
+# the way alts and pugs do in the real community.
+ROSTER_SIZE = 20
+POOL_FACTOR = 15
+
+# The number of distinct character payloads the fake API hands out.
+TEMPLATES = 40
+
+# How much worse than the baseline each measurement can get before the run
+# counts as a regression, as a fraction of the baseline.  Timings and memory
+# move around from run to run, the call counts shouldn't.
+TOLERANCES = {
+    'wall': 0.25,
+    'peak_kb': 0.25,
+    'api_calls': 0.02,
+    'datastore_calls': 0.02,
+    'memcache_calls': 0.05,
+}
+
+def make_community(count, seed=0):
+    import fakedata
+
+    rng = random.Random(seed)
+    pool = ['E2EToon%d/%s' % (i, rng.choice(fakedata.REALMS)) for i in xrange(count * POOL_FACTOR)]
+
+    groups = list()
+    for i in xrange(count):
+        group = fakedata.make_group_entity('E2E Bench %05d' % i, seed=i)
+        group.toons = sorted(rng.sample(pool, ROSTER_SIZE))
+        groups.append(group)
+    return groups
+
+# Runs every task that's waiting on the default queue, and every task those
+# queue in turn, until the queue is empty.  Returns the number of tasks run
+# and the number of tries that failed.
+def drain_queue(bed, client):
+    from google.appengine.ext import testbed
+
+    import ranker
+
+    stub = bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    tasks = 0
+    failures = 0
+    while True:
+        waiting = stub.get_filtered_tasks(queue_names=['default'])
+        if not waiting:
+            return (tasks, failures)
+
+        for task in waiting:
+            stub.DeleteTask('default', task.name)
+            tasks += 1
+            for retry in xrange(ranker.TASK_RETRY_LIMIT + 1):
+                try:
+                    response = client.post(task.url, data=task.payload,
+                                           content_type='application/x-www-form-urlencoded',
+                                           headers={'X-AppEngine-TaskRetryCount': str(retry)})
+                    if response.status_code < 300:
+                        break
+                except Exception:
+                    logging.exception('Task %s failed', task.name)
+                failures += 1
+
+# Makes every toon in the cache look like it was last checked a day ago, so
+# that the next run asks the API about all of them again.
+def age_toon_cache():
+    from google.appengine.ext import ndb
+
+    import ctrpmodels
+
+    entries = ctrpmodels.ToonCache.query().fetch()
+    for entry in entries:
+        entry.checked -= datetime.timedelta(days=1)
+    for i in xrange(0, len(entries), 500):
+        ndb.put_multi(entries[i:i+500])
+
+# Moves every history entry back past the ranker's window for active groups,
+# so that the groups that killed something in the last run count as quiet.
+def age_history():
+    from google.appengine.ext import ndb
+
+    import ctrpmodels
+    import ranker
+
+    entries = ctrpmodels.History.query().fetch()
+    for entry in entries:
+        entry.date -= datetime.timedelta(days=ranker.ACTIVE_DAYS + 1)
+    for i in xrange(0, len(entries), 500):
+        ndb.put_multi(entries[i:i+500])
+
+def child(count, latency, error_rate, full, runs):
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+
+    import ctrpmodels
+    import ranker
+    import ratelimit
+    import wowapi
+    from main import app
+
+    import fakebnet
+    import fakedata
+
+    logging.disable(logging.CRITICAL)
+    bed = benchutil.start_testbed()
+    try:
+        api = fakebnet.FakeBattleNet(latency=latency, timeout_rate=error_rate / 2,
+                                     server_error_rate=error_rate / 2)
+        api.install()
+        api.add_templates(fakedata.make_group('E2E Templates', size=TEMPLATES,
+                                              core=TEMPLATES / 2, killed=5))
+
+        groups = make_community(count)
+        for i in xrange(0, len(groups), 500):
+            ndb.put_multi(groups[i:i+500])
+        del groups
+
+        # skip the oauth round trip and the shared rate limit, which would
+        # only measure how long the bench spends waiting on the limit.  the
+        # run would post to twitter at the end, so leave that out too.
+        memcache.set('oauth_bearer_token', 'fake-token')
+        wowapi.api_limiter = ratelimit.TokenBucket('bench', 10000, 10000, ratelimit.LocalBucketStore())
+        wowapi.RETRY_BASE_DELAY = 0.02
+        wowapi.RETRY_MAX_DELAY = 0.2
+        ranker.twitter_client = lambda: None
+
+        calls = collections.Counter()
+        def count_call(service, call, request, response):
+            calls[service] += 1
+        hooks = apiproxy_stub_map.apiproxy.GetPreCallHooks()
+        hooks.Append('e2e-bench-datastore', count_call, 'datastore_v3')
+        hooks.Append('e2e-bench-memcache', count_call, 'memcache')
+        ndb.get_context().clear_cache()
+
+        client = app.test_client()
+        results = list()
+        for i in xrange(runs):
+            if i:
+                age_toon_cache()
+                age_history()
+            calls.clear()
+            api.calls.clear()
+            ndb.get_context().clear_cache()
+
+            start = timeit.default_timer()
+            client.post('/rank', data={'full': '1'} if full else {})
+            (tasks, failures) = drain_queue(bed, client)
+            wall = timeit.default_timer() - start
+
+            run = ctrpmodels.RankingRun.get_latest()
+            results.append({
+                'groups': count,
+                'finished': run is not None and 'build' in run.completed,
+                'wall': wall,
+                'tasks': tasks,
+                'task_failures': failures,
+                'api_calls': api.calls['character'],
+                'datastore_calls': calls['datastore_v3'],
+                'memcache_calls': calls['memcache'],
+                'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            })
+    finally:
+        bed.deactivate()
+
+    print(json.dumps(results))
+
+def run_size(count, args):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child',
+                                      str(count), str(args.latency), str(args.error_rate),
+                                      '1' if args.full else '0', str(args.runs)])
+    return json.loads(output.strip().splitlines()[-1])
+
+# Returns a list of descriptions of every measurement that got worse than the
+# baseline by more than its tolerance.
+def find_regressions(results, baseline):
+    regressions = list()
+    for (size, result) in sorted(results.iteritems()):
+        if size not in baseline:
+            continue
+        if not result['finished']:
+            regressions.append('%s groups: the run did not finish' % size)
+        for (metric, tolerance) in sorted(TOLERANCES.iteritems()):
+            old = baseline[size][metric]
+            new = result[metric]
+            if new > old * (1.0 + tolerance):
+                regressions.append('%s groups: %s went from %s to %s (allowed +%d%%)' % (
+                    size, metric, old, new, tolerance * 100))
+    return regressions
+
+def main(args):
+    sizes = [int(s) for s in args.sizes.split(',')]
+
+    print('%7s %4s %8s %9s %6s %9s %11s %10s %10s %10s' % (
+        'groups', 'run', 'finished', 'wall s', 'tasks', 'failures', 'api calls',
+        'datastore', 'memcache', 'peak KB'))
+    results = dict()
+    for count in sizes:
+        for (i, result) in enumerate(run_size(count, args)):
+            print('%7d %4d %8s %9.2f %6d %9d %11d %10d %10d %10d' % (
+                count, i + 1, 'yes' if result['finished'] else 'NO', result['wall'],
+                result['tasks'], result['task_failures'], result['api_calls'],
+                result['datastore_calls'], result['memcache_calls'], result['peak_kb']))
+        results[str(count)] = result
+
+    if args.save:
+        with open(args.save, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = find_regressions(results, json.load(baseline))
+        for regression in regressions:
+            print('REGRESSION: %s' % regression)
+        if regressions:
+            return 1
+
+    if not all(r['finished'] for r in results.itervalues()):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(int(sys.argv[2]), float(sys.argv[3]), float(sys.argv[4]),
+              sys.argv[5] == '1', int(sys.argv[6]))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='Offline end-to-end ranking run benchmark')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='comma separated list of community sizes, in groups')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='mean response time of the fake API, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of character requests that time out or get a 503')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='number of runs in a row for each size')
+    parser.add_argument('--full', action='store_true',
+                        help='rebuild every group instead of running incrementally')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline', help='fail if the results regress from this file')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# A fake Battle.net for running the importer and the ranking pipeline offline.
+# It replaces the urlfetch service stub, answers the OAuth and character API
+# URLs with synthetic data and can inject latency and faults (timeouts, network
+# errors, server errors and throttling) at configurable rates.
+
+import collections
+import email.utils
+import json
+import random
+import threading
+import time
+import urllib
+import urlparse
+
+from google.appengine.api import apiproxy_stub
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import urlfetch_service_pb
+from google.appengine.runtime import apiproxy_errors
+
+import fakedata
+
+class FakeBattleNet(apiproxy_stub.APIProxyStub):
+
+    THREADSAFE = True
+
+    # latency is the mean response time in seconds.  the *_rate arguments are
+    # the fraction of character requests that fail in each way.  if
+    # max_concurrent is set, requests beyond that many in flight at once get
+    # throttled like the real API does when the per-second quota is hit.
+    def __init__(self, latency=0.0, timeout_rate=0.0, network_error_rate=0.0,
+                 server_error_rate=0.0, throttle_rate=0.0, retry_after=None,
+                 max_concurrent=None, seed=0):
+        super(FakeBattleNet, self).__init__('urlfetch')
+        self.latency = latency
+        self.timeout_rate = timeout_rate
+        self.network_error_rate = network_error_rate
+        self.server_error_rate = server_error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.max_concurrent = max_concurrent
+
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+        # character payloads, keyed on lowercased name and realm slug
+        self.characters = dict()
+        self.encoded = dict()
+
+        # payloads handed out for characters that weren't added one by one,
+        # for communities too large to build a payload for every toon
+        self.templates = list()
+
+        # other URLs that should be answered with a fixed body
+        self.documents = dict()
+
+        self.calls = collections.Counter()
+        self.outcomes = collections.Counter()
+
+    # Adds a character to the fake API.  Any extra arguments are passed on to
+    # fakedata.make_character.
+    def add_character(self, name, realm, **kwargs):
+        self.characters[(name.lower(), realm)] = fakedata.make_character(name, realm, **kwargs)
+
+    def update_character(self, name, realm, payload):
+        key = (name.lower(), realm)
+        self.characters[key] = payload
+        self.encoded.pop(key, None)
+
+    # Answers every character that wasn't added with add_character with one of
+    # the given payloads, picked by the character's name and realm.  The name
+    # in the payload won't match, but the importer doesn't read it.
+    def add_templates(self, payloads):
+        self.templates.extend(payloads)
+
+    def add_document(self, url, body):
+        self.documents[url] = body
+
+    # Swaps this stub in for the urlfetch service.  Call this after the
+    # testbed has been activated.
+    def install(self):
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', self)
+
+    def _count(self, counter, key):
+        with self.lock:
+            counter[key] += 1
+
+    def _roll(self, rate):
+        with self.lock:
+            return rate > 0 and self.rng.random() < rate
+
+    def _Dynamic_Fetch(self, request, response):
+        url = request.url()
+        parsed = urlparse.urlparse(url)
+
+        if parsed.path == '/oauth/token':
+            self._count(self.calls, 'oauth')
+            self._respond(response, 200, json.dumps({'access_token': 'fake-token',
+                                                     'token_type': 'bearer',
+                                                     'expires_in': 86399}))
+            return
+
+        if url in self.documents:
+            self._count(self.calls, 'document')
+            self._respond(response, 200, self.documents[url])
+            return
+
+        if not parsed.path.startswith('/wow/character/'):
+            self._respond(response, 404, '')
+            return
+
+        self._count(self.calls, 'character')
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            crowded = self.max_concurrent is not None and self.in_flight > self.max_concurrent
+
+        try:
+            if self.latency:
+                with self.lock:
+                    delay = self.rng.expovariate(1.0 / self.latency)
+                time.sleep(delay)
+
+            if self._roll(self.timeout_rate):
+                self._count(self.outcomes, 'timeout')
+                raise apiproxy_errors.ApplicationError(
+                    urlfetch_service_pb.URLFetchServiceError.DEADLINE_EXCEEDED)
+            if self._roll(self.network_error_rate):
+                self._count(self.outcomes, 'network')
+                raise apiproxy_errors.ApplicationError(
+                    urlfetch_service_pb.URLFetchServiceError.FETCH_ERROR)
+            if crowded or self._roll(self.throttle_rate):
+                self._count(self.outcomes, 'throttled')
+                headers = dict()
+                if self.retry_after is not None:
+                    headers['Retry-After'] = str(self.retry_after)
+                self._respond(response, 429, json.dumps({'code': 429, 'type': 'Too Many Requests'}), headers)
+                return
+            if self._roll(self.server_error_rate):
+                self._count(self.outcomes, 'server')
+                self._respond(response, 503, 'Service Unavailable')
+                return
+
+            self._character(request, response, parsed)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def _character(self, request, response, parsed):
+        (realm, name) = parsed.path[len('/wow/character/'):].split('/', 1)
+        name = urllib.unquote(name).decode('utf-8')
+        key = (name.lower(), realm)
+
+        if key in self.characters:
+            payload = self.characters[key]
+        elif self.templates:
+            key = hash(key) % len(self.templates)
+            payload = self.templates[key]
+        else:
+            self._count(self.outcomes, 'missing')
+            self._respond(response, 404, json.dumps({'status': 'nok', 'reason': 'Character not found.'}))
+            return
+
+        # answer conditional requests for characters that haven't changed
+        # with a 304, the same as a well behaved HTTP server would.
+        headers = dict((h.key().lower(), h.value()) for h in request.header_list())
+        if 'if-modified-since' in headers:
+            since = email.utils.mktime_tz(email.utils.parsedate_tz(headers['if-modified-since']))
+            if payload['lastModified'] / 1000 <= since:
+                self._count(self.outcomes, 'not modified')
+                self._respond(response, 304, '')
+                return
+
+        self._count(self.outcomes, 'ok')
+        with self.lock:
+            if key not in self.encoded:
+                self.encoded[key] = json.dumps(payload)
+            body = self.encoded[key]
+        self._respond(response, 200, body)
+
+    def _respond(self, response, status, body, headers=None):
+        response.set_statuscode(status)
+        response.set_content(body)
+        for (name, value) in (headers or dict()).iteritems():
+            header = response.add_header()
+            header.set_key(name)
+            header.set_value(value)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Synthetic data for the benchmarks.  The character payloads are shaped like
+# the responses from the Battle.net character API with the progression and
+# items fields, including the long list of old raids and the full item tree
+# that the ranker doesn't care about.
+
+import datetime
+import random
+
+import ctrpmodels
+from ctrpmodels import Constants
+
+# Number of older raids that show up in a real progression payload in front of
+# the current one, and the number of bosses in each of them.
+OLD_RAIDS = 45
+OLD_RAID_BOSSES = 9
+
+SLOTS = ['head', 'neck', 'shoulder', 'back', 'chest', 'wrist', 'hands', 'waist',
+         'legs', 'feet', 'finger1', 'finger2', 'trinket1', 'trinket2',
+         'mainHand', 'offHand']
+
+REALMS = ['aerie-peak', 'bronzebeard', 'eonar', 'feathermoon', 'moon-guard']
+
+# Base timestamp for the fake kills, in milliseconds like the API uses.
+BASE_STAMP = 1562000000000
+
+def _boss(name, stamps):
+    boss = {'name': name, 'id': abs(hash(name)) % 100000,
+            'lfrKills': 0, 'lfrTimestamp': 0}
+    for diff in Constants.difficulties:
+        stamp = stamps.get(diff, 0)
+        boss[diff+'Kills'] = 1 if stamp else 0
+        boss[diff+'Timestamp'] = stamp
+    return boss
+
+def _raid(name, bosses):
+    return {'name': name, 'id': abs(hash(name)) % 100000, 'lfr': 0,
+            'normal': 1, 'heroic': 1, 'mythic': 0, 'bosses': bosses}
+
+def _item(rng, slot, ilvl):
+    return {
+        'id': rng.randint(150000, 170000),
+        'name': '%s of the Synthetic Depths' % slot.title(),
+        'icon': 'inv_%s_synthetic_%d' % (slot.lower(), rng.randint(1, 20)),
+        'quality': 4,
+        'itemLevel': ilvl + rng.randint(-10, 10),
+        'tooltipParams': {'transmogItem': rng.randint(1000, 9000),
+                          'timewalkerLevel': 0, 'azeritePower0': 0},
+        'stats': [{'stat': rng.randint(1, 80), 'amount': rng.randint(10, 900)}
+                  for _ in xrange(4)],
+        'armor': rng.randint(0, 500),
+        'context': 'raid-heroic',
+        'bonusLists': [rng.randint(1000, 6000) for _ in xrange(3)],
+        'artifactId': 0,
+        'displayInfoId': rng.randint(1000, 200000),
+        'artifactAppearanceId': 0,
+        'artifactTraits': [],
+        'relics': [],
+        'appearance': {'itemAppearanceModId': 0},
+        'azeriteItem': {'azeriteLevel': 0, 'azeriteExperience': 0,
+                        'azeriteExperienceRemaining': 0},
+        'azeriteEmpoweredItem': {'azeritePowers': [
+            {'id': rng.randint(1, 600), 'tier': tier, 'spellId': rng.randint(1000, 300000),
+             'bonusListId': 0} for tier in xrange(4)]},
+    }
+
+# Builds a single character payload.  kills is a dict of (boss name,
+# difficulty) to the kill timestamp for the current raid.
+def make_character(name, realm, kills=None, level=120, ilvl=420,
+                   last_modified=BASE_STAMP, seed=None):
+    rng = random.Random(seed if seed is not None else name)
+    kills = kills or dict()
+
+    raids = list()
+    for r in xrange(OLD_RAIDS):
+        raidname = 'Old Raid %d' % r
+        bosses = list()
+        for b in xrange(OLD_RAID_BOSSES):
+            stamps = {'normal': BASE_STAMP - rng.randint(1, 10**10)} if rng.random() < 0.3 else {}
+            bosses.append(_boss('%s Boss %d' % (raidname, b), stamps))
+        raids.append(_raid(raidname, bosses))
+
+    for _, raidname, bossnames in Constants.raids:
+        bosses = list()
+        for bossname in bossnames:
+            stamps = dict()
+            for diff in Constants.difficulties:
+                if (bossname, diff) in kills:
+                    stamps[diff] = kills[(bossname, diff)]
+            bosses.append(_boss(bossname, stamps))
+        raids.append(_raid(raidname, bosses))
+
+    items = {'averageItemLevel': ilvl + 2, 'averageItemLevelEquipped': ilvl}
+    for slot in SLOTS:
+        items[slot] = _item(rng, slot, ilvl)
+
+    return {
+        'lastModified': last_modified,
+        'name': name,
+        'realm': realm.replace('-', ' ').title(),
+        'battlegroup': 'Ruin',
+        'class': rng.randint(1, 12),
+        'race': rng.randint(1, 30),
+        'gender': rng.randint(0, 1),
+        'level': level,
+        'achievementPoints': rng.randint(1000, 30000),
+        'thumbnail': '%s/%d/%d-avatar.jpg' % (realm, rng.randint(1, 200), rng.randint(1, 10**8)),
+        'calcClass': 'Z',
+        'faction': 0,
+        'totalHonorableKills': rng.randint(0, 50000),
+        'items': items,
+        'progression': {'raids': raids},
+    }
+
+# Builds the toon data for a single group.  The first `core` toons share kill
+# timestamps for the first `killed` bosses, while the rest of the roster are
+# alts and pugs with scattered timestamps of their own.
+def make_group(name, size=20, core=10, killed=4, seed=None):
+    rng = random.Random(seed if seed is not None else name)
+    bosses = Constants.aepbosses
+
+    shared = dict()
+    for i, boss in enumerate(bosses[:killed]):
+        for d, diff in enumerate(Constants.difficulties):
+            shared[(boss, diff)] = BASE_STAMP + (i * 3 + d) * 3600000
+
+    toons = list()
+    for t in xrange(size):
+        toonname = '%s%d' % (name.replace(' ', ''), t)
+        if t < core:
+            kills = dict(shared)
+        else:
+            kills = dict()
+            for boss in bosses:
+                if rng.random() < 0.5:
+                    kills[(boss, 'normal')] = BASE_STAMP + rng.randint(1, 10**9)
+        toons.append(make_character(toonname, rng.choice(REALMS), kills,
+                                    ilvl=rng.randint(400, 440), seed=toonname))
+    return toons
+
+def make_roster(name, size=20, seed=None):
+    rng = random.Random(seed if seed is not None else name)
+    return ['%s%d/%s' % (name.replace(' ', ''), t, rng.choice(REALMS)) for t in xrange(size)]
+
+# Builds a Group entity with a roster and some random progress, for the
+# benchmarks that only need the stored groups.  Nothing is written to the
+# datastore.  With legacy set, the kills are stored as a list of Boss models
+# the way groups stored them before the kill data was packed.
+def make_group_entity(name, size=20, seed=None, legacy=False):
+    rng = random.Random(seed if seed is not None else name)
+    bosses = Constants.aepbosses
+    group = ctrpmodels.Group(name=name)
+    group.toons = make_roster(name, size=size, seed=seed)
+    group.avgilvl = rng.randint(400, 440)
+    group.aep = ctrpmodels.Raid()
+
+    killed = dict((diff, rng.randint(0, len(bosses))) for diff in Constants.difficulties)
+    killed['heroic'] = min(killed['heroic'], killed['normal'])
+    killed['mythic'] = min(killed['mythic'], killed['heroic'])
+    day = datetime.date(2019, 7, 9)
+    for i, boss in enumerate(bosses):
+        if legacy:
+            entry = ctrpmodels.Boss(name=boss)
+            group.aep.bosses.append(entry)
+        for diff in Constants.difficulties:
+            if i < killed[diff]:
+                killdate = day + datetime.timedelta(days=rng.randint(0, 60))
+                if legacy:
+                    setattr(entry, diff+'dead', killdate)
+                else:
+                    group.aep.set_kill(i, diff, killdate)
+    for diff in Constants.difficulties:
+        setattr(group.aep, diff, killed[diff])
+    return group
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Times views of the main page over a synthetic set of groups: rendered from
+# the datastore on every hit (the way display.display used to work), served
+# from the compressed copy in memcache, and served from the instance's own
+# copy.
+#
+# Usage: python bench/leaderboard_bench.py [groups] [runs]
+
+from __future__ import print_function
+
+import logging
+import sys
+
+import benchutil
+benchutil.setup_path()
+
+from google.appengine.ext import ndb
+
+import ctrpmodels
+import display
+from main import app
+
+import fakedata
+
+def main(count, runs):
+    logging.disable(logging.CRITICAL)
+    bed = benchutil.start_testbed()
+    try:
+        groups = [fakedata.make_group_entity('Leaderboard %04d' % i) for i in xrange(count)]
+        for i in xrange(0, len(groups), 500):
+            ndb.put_multi(groups[i:i+500])
+        last_updated = ctrpmodels.Global.mark_updated()
+
+        with app.test_request_context('/'):
+            def render():
+                ndb.get_context().clear_cache()
+                display.render_leaderboard(last_updated, 1, ctrpmodels.Group.query_for_singletier_display(), False)
+
+            def from_memcache():
+                display._leaderboard = (None, dict())
+                display.display()
+
+            page = display.rebuild_leaderboard(last_updated)[1]
+            print('%d groups, first page is %d KB' % (count, len(page.encode('utf-8')) / 1024))
+
+            benchutil.report('render on every view', benchutil.time_runs(render, runs))
+            benchutil.report('memcache copy', benchutil.time_runs(from_memcache, runs))
+            display.display()
+            benchutil.report('instance copy', benchutil.time_runs(display.display, runs))
+    finally:
+        bed.deactivate()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+                  int(sys.argv[2]) if len(sys.argv) > 2 else 20))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Measures the peak memory of a builder task loading a roster from the fake
+# Battle.net, with the responses buffered into a list and parsed afterwards
+# (the way process_group used to work) and with the responses streamed into a
+# progression.GroupTally.  Each mode runs in its own process so that the peak
+# resident set size belongs to that mode alone.  The testbed's datastore and
+# memcache live in the same process and keep everything the importer writes
+# to them, so part of the growth is theirs, more so the more toons there are.
+#
+# Usage: python bench/memory_bench.py [toons]
+
+from __future__ import print_function
+
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+
+import benchutil
+benchutil.setup_path()
+
+def current_rss_kb():
+    # linux only, but that's all the benchmarks need to run on
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() / 1024
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def child(mode, count):
+    from google.appengine.api import memcache
+
+    import progression
+    import ratelimit
+    import wowapi
+    from ctrpmodels import Constants
+
+    import fakebnet
+    import fakedata
+
+    logging.disable(logging.CRITICAL)
+    bed = benchutil.start_testbed()
+    api = fakebnet.FakeBattleNet()
+    api.install()
+
+    toons = fakedata.make_roster('Memory Bench', size=count)
+    for i, toon in enumerate(toons):
+        (name, realm) = wowapi.split_toon(toon)
+        api.add_character(name, realm, seed=i)
+        # encode everything up front so that the fake's own buffers are part
+        # of the baseline
+        api.encoded[(name.lower(), realm)] = json.dumps(api.characters[(name.lower(), realm)])
+
+    memcache.set('oauth_bearer_token', 'fake-token')
+    wowapi.api_limiter = ratelimit.TokenBucket('bench', 10000, 10000, ratelimit.LocalBucketStore())
+
+    before = current_rss_kb()
+    importer = wowapi.Importer()
+    if mode == 'buffered':
+        data = list()
+        importer.load(toons, data)
+        tally = progression.KillTally(Constants.aepbosses, Constants.aepname)
+        for toon in data:
+            tally.add(toon)
+        tally.results()
+        ilvl = 0
+        for toon in data:
+            if 'items' in toon and toon['level'] == 120:
+                ilvl += toon['items']['averageItemLevelEquipped']
+    else:
+        tally = progression.GroupTally()
+        importer.load(toons, tally)
+        tally.progress()
+        tally.average_ilvl()
+
+    peak = peak_rss_kb()
+    bed.deactivate()
+    print('%d %d' % (before, peak))
+
+def main(count):
+    results = dict()
+    for mode in ('buffered', 'streaming'):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                          '--child', mode, str(count)])
+        (before, peak) = [int(v) for v in output.split()[-2:]]
+        results[mode] = max(0, peak - before)
+        print('%-10s %5d toons  baseline: %8d KB  peak: %8d KB  growth: %8d KB' % (
+            mode, count, before, peak, results[mode]))
+    return 0
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 40))
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Micro-benchmark for kill detection.  Compares the list based parse that the
+# ranker used to run against the counter based tally in progression.py, for a
+# range of roster sizes, and checks that both come up with the same kills.
+#
+# Usage: python bench/parse_bench.py [runs]
+
+from __future__ import print_function
+
+import datetime
+import logging
+import sys
+
+import benchutil
+benchutil.setup_path()
+
+import ctrpmodels
+import progression
+from ctrpmodels import Constants
+
+import fakedata
+
+# The original implementation of ranker.parse, kept here as the baseline.
+def legacy_parse(bosses, toondata, raidname, progress):
+
+    progress[raidname] = list()
+
+    bossdata = dict()
+    for boss in bosses:
+        bossdata[boss] = dict()
+        for diff in Constants.difficulties:
+            bossdata[boss][diff] = dict()
+            bossdata[boss][diff]['times'] = list()
+            bossdata[boss][diff]['timeset'] = set()
+
+    for toon in toondata:
+
+        if 'progression' not in toon:
+            continue
+
+        raids = toon['progression']['raids']
+        raid = [d for d in raids if d['name'] == raidname][0]
+
+        for boss in bosses:
+
+            single_boss = None
+            filtered_bosses = [d for d in raid['bosses'] if d['name'] == boss]
+            if filtered_bosses:
+                single_boss = filtered_bosses[0]
+
+            if not single_boss:
+                logging.error('Failed to find boss %s in toon progression data', boss)
+                continue
+
+            for diff in Constants.difficulties:
+                if single_boss[diff+'Timestamp'] != 0:
+                    bossdata[boss][diff]['times'].append(single_boss[diff+'Timestamp'])
+                    bossdata[boss][diff]['timeset'].add(single_boss[diff+'Timestamp'])
+
+    for boss in bosses:
+
+        bossobj = ctrpmodels.Boss(name=boss)
+
+        for diff in Constants.difficulties:
+            timelist = list(bossdata[boss][diff]['timeset'])
+            timelist.sort(reverse=True)
+            logging.info("kill times for %s %s: %s", diff, boss, str(timelist))
+
+            for stamp in timelist:
+                count = bossdata[boss][diff]['times'].count(stamp)
+                logging.info('%s: time: %d   count: %s', boss, stamp, count)
+                if count >= 8:
+                    logging.info('*** found valid kill for %s %s at %d', diff, boss, stamp)
+                    setattr(bossobj, diff+'dead', datetime.date.today())
+                    break
+
+        progress[raidname].append(bossobj)
+
+def new_parse(bosses, toondata, raidname, progress):
+    tally = progression.KillTally(bosses, raidname)
+    for toon in toondata:
+        tally.add(toon)
+    progress[raidname] = tally.results()
+
+# Trim each payload down to the current raid, the same as
+# wowapi.handle_result does before the data ever gets to the parser.
+def filtered(toons):
+    for toon in toons:
+        toon['progression']['raids'] = [r for r in toon['progression']['raids']
+                                        if r['name'] in Constants.raidnames]
+    return toons
+
+def kills(progress):
+    return [(b.name, b.normaldead, b.heroicdead, b.mythicdead)
+            for b in progress[Constants.aepname]]
+
+def main(runs):
+    logging.disable(logging.CRITICAL)
+
+    for size in (10, 20, 40, 80):
+        toons = filtered(fakedata.make_group('Bench Group', size=size,
+                                             core=min(size, 12), killed=5))
+
+        old = dict()
+        new = dict()
+        legacy_parse(Constants.aepbosses, toons, Constants.aepname, old)
+        new_parse(Constants.aepbosses, toons, Constants.aepname, new)
+        if kills(old) != kills(new):
+            print('MISMATCH for roster size %d' % size)
+            return 1
+
+        benchutil.report('legacy parse, %d toons' % size, benchutil.time_runs(
+            lambda: legacy_parse(Constants.aepbosses, toons, Constants.aepname, dict()), runs))
+        benchutil.report('tally parse, %d toons' % size, benchutil.time_runs(
+            lambda: new_parse(Constants.aepbosses, toons, Constants.aepname, dict()), runs))
+
+    # scoring a whole community in one call
+    groups = dict()
+    for g in xrange(50):
+        name = 'Group %d' % g
+        groups[name] = filtered(fakedata.make_group(name, size=25, core=12, killed=g % 9))
+
+    def legacy_all():
+        for toons in groups.itervalues():
+            legacy_parse(Constants.aepbosses, toons, Constants.aepname, dict())
+
+    benchutil.report('legacy parse, 50 groups', benchutil.time_runs(legacy_all, max(1, runs / 10)))
+    benchutil.report('score_groups, 50 groups', benchutil.time_runs(
+        lambda: progression.score_groups(Constants.aepbosses, Constants.aepname, groups),
+        max(1, runs / 10)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Compares fetching every group in display order (the way the main page used
+# to be built) with the rank key queries that are made now: the snapshot
+# fetches every group in rank order at the end of a run, and the scheduler
+# fetches just their keys.
+#
+# Usage: python bench/rankkey_bench.py [groups] [runs]
+
+from __future__ import print_function
+
+import logging
+import sys
+
+import benchutil
+benchutil.setup_path()
+
+from google.appengine.ext import ndb
+
+import ctrpmodels
+
+import fakedata
+
+def main(count, runs):
+    logging.disable(logging.CRITICAL)
+    bed = benchutil.start_testbed()
+    try:
+        groups = [fakedata.make_group_entity('Rank Key %05d' % i) for i in xrange(count)]
+        for i in xrange(0, len(groups), 500):
+            ndb.put_multi(groups[i:i+500])
+
+        # make sure the rank key sorts the same as the old query
+        old_order = [g.name for g in ctrpmodels.Group.query_for_singletier_display()]
+        new_order = [g.name for g in ctrpmodels.Group.query_by_rank().fetch()]
+        if old_order != new_order:
+            print('MISMATCH between the rank key order and the display order')
+            return 1
+
+
+        def uncached(func):
+            def run():
+                ndb.get_context().clear_cache()
+                func()
+            return run
+
+        print('%d groups' % count)
+        benchutil.report('full fetch in display order', benchutil.time_runs(
+            uncached(ctrpmodels.Group.query_for_singletier_display), runs))
+        benchutil.report('full fetch by rank key', benchutil.time_runs(
+            uncached(lambda: ctrpmodels.Group.query_by_rank().fetch()), runs))
+        benchutil.report('keys by rank key', benchutil.time_runs(
+            uncached(lambda: ctrpmodels.Group.query_by_rank().fetch(keys_only=True)), runs))
+    finally:
+        bed.deactivate()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000,
+                  int(sys.argv[2]) if len(sys.argv) > 2 else 20))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Counts the datastore calls and times the lookups that every page view and
+# every builder task make, the way they used to be done (a query each time)
+# and the way ctrpmodels does them now: a get on Global's fixed key, which
+# ndb serves from memcache, and a get on the group's key from the group key
+# cache.  Each lookup is made once to warm things up before it's measured,
+# and each measured lookup starts with an empty ndb context cache, the same
+# as a new request.
+#
+# Usage: python bench/readcache_bench.py [groups] [views]
+
+from __future__ import print_function
+
+import collections
+import logging
+import sys
+import timeit
+
+import benchutil
+benchutil.setup_path()
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+
+import ctrpmodels
+
+import fakedata
+
+def measure(lookup, views, calls):
+    lookup()
+    calls.clear()
+    start = timeit.default_timer()
+    for _ in xrange(views):
+        ndb.get_context().clear_cache()
+        lookup()
+    elapsed = timeit.default_timer() - start
+    return (sum(calls.values()) / float(views), elapsed * 1000.0 / views)
+
+def main(count, views):
+    logging.disable(logging.CRITICAL)
+    bed = benchutil.start_testbed()
+    try:
+        groups = [fakedata.make_group_entity('Read Cache %04d' % i) for i in xrange(count)]
+        ndb.put_multi(groups)
+        ctrpmodels.Global.mark_updated()
+        name = groups[count / 2].name
+
+        calls = collections.Counter()
+        def hook(service, call, request, response):
+            calls[call] += 1
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('readcache-bench', hook, 'datastore_v3')
+
+        lookups = [
+            ('last updated (pages)',
+             lambda: ctrpmodels.Global.query().fetch(1)[0].lastupdated,
+             ctrpmodels.Global.get_last_updated),
+            ('group by name (builder)',
+             lambda: ctrpmodels.Group.query(ctrpmodels.Group.name == name).fetch(1)[0],
+             lambda: ctrpmodels.Group.get_group_by_name(name)),
+        ]
+
+        print('%-24s %10s %10s %10s %10s' % ('lookup', 'query rpcs', 'query ms', 'rpcs now', 'ms now'))
+        for (label, old, new) in lookups:
+            (old_rpcs, old_ms) = measure(old, views, calls)
+            (new_rpcs, new_ms) = measure(new, views, calls)
+            print('%-24s %10.1f %10.3f %10.1f %10.3f' % (label, old_rpcs, old_ms, new_rpcs, new_ms))
+    finally:
+        bed.deactivate()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+                  int(sys.argv[2]) if len(sys.argv) > 2 else 20))
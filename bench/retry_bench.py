@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Runs the importer against the fake Battle.net with faults injected, with and
+# without retries, and reports how many toons dropped out, how many requests it
+# took and where the adaptive concurrency limit ended up.  The backoff delays
+# are scaled down so that the whole thing runs in a few seconds.
+#
+# It also checks that the retries do their job: transient faults are recovered
+# when retries are on, Retry-After is waited out (and a Retry-After longer than
+# wowapi.RETRY_AFTER_MAX gives up instead), and the adaptive limit shrinks
+# under throttling and grows back afterwards.  Exits with an error if any of
+# those don't hold.
+#
+# Usage: python bench/retry_bench.py [toons]
+
+from __future__ import print_function
+
+import logging
+import sys
+import timeit
+
+import benchutil
+benchutil.setup_path()
+
+from google.appengine.api import memcache
+
+import ratelimit
+import wowapi
+
+import fakebnet
+import fakedata
+
+RETRY_AFTER = 0.05
+
+# The fraction of the toons that can still fail by chance with retries on in
+# a scenario that retries should recover.  A toon fails all four attempts at a
+# 10% fault rate one time in ten thousand, so this is a lot more than the
+# faults should ever cost and a lot less than running without retries does.
+RECOVERABLE_FAILURES = 0.005
+
+# The scenarios, and whether the toons should load once retries are on.
+SCENARIOS = [
+    ('clean', dict(), True),
+    ('10% timeouts', dict(timeout_rate=0.1), True),
+    ('10% network errors', dict(network_error_rate=0.1), True),
+    ('10% server errors', dict(server_error_rate=0.1), True),
+    ('10% throttled, Retry-After', dict(throttle_rate=0.1, retry_after=RETRY_AFTER), True),
+    ('quota of 3 in flight', dict(max_concurrent=3), True),
+    ('everything at once', dict(timeout_rate=0.05, network_error_rate=0.05,
+                                server_error_rate=0.05, max_concurrent=4), False),
+]
+
+def run(toons, faults, attempts):
+    bed = benchutil.start_testbed()
+    original_delay = wowapi.retry_delay
+    try:
+        api = fakebnet.FakeBattleNet(latency=0.01, **faults)
+        api.install()
+        for toon in toons:
+            (name, realm) = wowapi.split_toon(toon)
+            api.add_character(name, realm, seed=0)
+
+        # skip the oauth round trip and take the shared rate limit out of the
+        # picture, since only the retries are being measured here.
+        memcache.set('oauth_bearer_token', 'fake-token')
+        wowapi.api_limiter = ratelimit.TokenBucket('bench', 10000, 10000, ratelimit.LocalBucketStore())
+        wowapi.MAX_ATTEMPTS = attempts
+
+        # note the waits the importer picks when the API sent a Retry-After
+        waits = list()
+        def retry_delay(attempt, retry_after=None):
+            delay = original_delay(attempt, retry_after)
+            if retry_after is not None:
+                waits.append(delay)
+            return delay
+        wowapi.retry_delay = retry_delay
+
+        importer = wowapi.Importer()
+        lowest = [importer.concurrency.current()]
+        release = importer.concurrency.release
+        def tracked_release(seq, throttled=False):
+            release(seq, throttled)
+            lowest[0] = min(lowest[0], importer.concurrency.current())
+        importer.concurrency.release = tracked_release
+
+        start = timeit.default_timer()
+        results = [data for (_, data) in importer.fetch([wowapi.split_toon(t) for t in toons])]
+        elapsed = timeit.default_timer() - start
+
+        failed = len([r for r in results if r.get('status', 'ok') == 'nok'])
+        dropped = len(toons) - len(results)
+        return {'failed': failed + dropped, 'calls': api.calls['character'], 'wall': elapsed,
+                'limit': importer.concurrency.current(), 'lowest': lowest[0],
+                'peak': api.peak_in_flight, 'waits': waits,
+                'throttled': api.outcomes['throttled']}
+    finally:
+        wowapi.retry_delay = original_delay
+        bed.deactivate()
+
+# Checks the adaptive limit on its own: it halves on a throttled response,
+# only once for the requests that were already out when it was cut, doesn't
+# grow on their successes either, and climbs back to the maximum as requests
+# sent after the cut succeed.
+def check_limit():
+    problems = list()
+    limit = ratelimit.AdaptiveConcurrency(8)
+
+    window = [limit.acquire() for _ in xrange(8)]
+    limit.release(window.pop(), True)
+    if limit.current() != 4:
+        problems.append('limit was %d after a throttled response, expected 4' % limit.current())
+    limit.release(window.pop(), True)
+    if limit.current() != 4:
+        problems.append('limit was cut twice for one window of requests')
+    for seq in window:
+        limit.release(seq)
+    if limit.current() != 4:
+        problems.append('limit grew on successes sent before it was cut')
+
+    seq = limit.acquire()
+    limit.release(seq, True)
+    if limit.current() != 2:
+        problems.append('limit wasn\'t cut for a request sent after the last cut')
+
+    for _ in xrange(100):
+        limit.release(limit.acquire())
+    if limit.current() != 8:
+        problems.append('limit only grew back to %d after 100 successes' % limit.current())
+    return problems
+
+def main(count):
+    logging.disable(logging.CRITICAL)
+    wowapi.RETRY_BASE_DELAY = 0.02
+    wowapi.RETRY_MAX_DELAY = 0.2
+
+    toons = fakedata.make_roster('Retry Bench', size=count)
+    attempts = wowapi.MAX_ATTEMPTS
+    problems = check_limit()
+
+    print('%-28s %-9s %7s %7s %8s %6s %6s %5s' % ('scenario', 'retries', 'failed', 'calls',
+                                                 'wall s', 'lowest', 'limit', 'peak'))
+    for (label, faults, recoverable) in SCENARIOS:
+        results = dict()
+        for tries in (1, attempts):
+            result = run(toons, faults, tries)
+            results[tries] = result
+            print('%-28s %-9s %7d %7d %8.2f %6d %6d %5d' % (
+                label, 'on' if tries > 1 else 'off', result['failed'], result['calls'],
+                result['wall'], result['lowest'], result['limit'], result['peak']))
+
+        (off, on) = (results[1], results[attempts])
+        if recoverable and on['failed'] > len(toons) * RECOVERABLE_FAILURES:
+            problems.append('%s: %d toons failed with retries on' % (label, on['failed']))
+        if faults and off['failed'] and on['failed'] >= off['failed']:
+            problems.append('%s: retries didn\'t recover anything' % label)
+        if 'retry_after' in faults and any(wait != faults['retry_after'] for wait in on['waits']):
+            problems.append('%s: Retry-After was not used for the waits' % label)
+        if 'max_concurrent' in faults and on['throttled']:
+            if on['lowest'] >= wowapi.Importer.MAX_WORKERS:
+                problems.append('%s: the limit never came down' % label)
+
+    # a Retry-After past the longest wait the importer honours should give up
+    # on the request instead of trying again early
+    result = run(toons, dict(throttle_rate=0.1, retry_after=wowapi.RETRY_AFTER_MAX + 1), attempts)
+    print('%-28s %-9s %7d %7d %8.2f' % ('10% throttled, long wait', 'on', result['failed'],
+                                       result['calls'], result['wall']))
+    if result['calls'] != len(toons) or result['failed'] != result['throttled']:
+        problems.append('a Retry-After over RETRY_AFTER_MAX was retried early')
+
+    for problem in problems:
+        print('FAILED: %s' % problem)
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Measures ingesting a synthetic Raid Builder team list: decoding the whole
+# payload with json.loads and building the report by concatenating strings
+# (the way load_groups used to work), and decoding it a team at a time with
+# rostermgmt.iter_teams and building the report with RosterReport.  Each mode
+# runs in its own process so that the peak resident set size belongs to that
+# mode alone.  The datastore side of the load is left out, since it's the same
+# for both.
+#
+# Usage: python bench/roster_bench.py [teams]
+
+from __future__ import print_function
+
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import timeit
+
+import benchutil
+benchutil.setup_path()
+
+import fakedata
+
+OUTCOMES = ['Added', 'Updated', 'Removed', 'Skipped', 'Unchanged']
+
+def make_feed(count):
+    rng = random.Random(count)
+    teams = dict()
+    for i in xrange(count):
+        name = 'Roster Bench %05d' % i
+        toons = list()
+        for toon in fakedata.make_roster(name, size=rng.randint(10, 30), seed=i):
+            (toonname, realm) = toon.split('/')
+            toons.append({'toon_name': toonname, 'realm': realm, 'role': 'dps',
+                          'class': rng.randint(1, 12), 'status': 'Active' if rng.random() < 0.9 else 'Bench'})
+        teams[name] = {'status': 'Disbanded' if rng.random() < 0.05 else 'Active',
+                       'updated_at': {'date': '2019-08-01 12:00:00.000000', 'timezone': 'UTC'},
+                       'toons': toons}
+    return json.dumps(teams)
+
+def active_roster(team):
+    return sorted('%s/%s' % (t['toon_name'], t['realm']) for t in team['toons']
+                  if t['status'] == 'Active')
+
+def legacy(content):
+    import rostermgmt
+
+    jsondata = json.loads(content)
+    responses = list()
+    for name in jsondata:
+        if jsondata[name]['status'] == 'Disbanded':
+            continue
+        rostermgmt.roster_hash(active_roster(jsondata[name]))
+        responses.append((OUTCOMES[hash(name) % len(OUTCOMES)], 'Processed %s' % name))
+
+    response = '<html><head><title>Roster Update</title></head><body>'
+    for outcome in OUTCOMES:
+        response += '<h3>%s</h3>' % outcome
+        for i in sorted([x for x in responses if x[0] == outcome], key=lambda tup: tup[1]):
+            response += '%s<br/>' % i[1]
+    response += '</body></html>'
+    return response
+
+def streaming(content):
+    import rostermgmt
+
+    report = rostermgmt.RosterReport()
+    for (name, team) in rostermgmt.iter_teams(content):
+        if team['status'] == 'Disbanded':
+            continue
+        rostermgmt.roster_hash(active_roster(team))
+        report.add(OUTCOMES[hash(name) % len(OUTCOMES)], 'Processed %s' % name)
+    return report.render(0, 0)
+
+def current_rss_kb():
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() / 1024
+
+def child(mode, count):
+    logging.disable(logging.CRITICAL)
+    import rostermgmt
+
+    content = make_feed(count)
+    before = current_rss_kb()
+    start = timeit.default_timer()
+    (legacy if mode == 'legacy' else streaming)(content)
+    elapsed = timeit.default_timer() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%d %d %d %f' % (len(content), before, peak, elapsed))
+
+def main(count):
+    for mode in ('legacy', 'streaming'):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                          '--child', mode, str(count)])
+        fields = output.split()[-4:]
+        (size, before, peak) = [int(v) for v in fields[:3]]
+        elapsed = float(fields[3])
+        print('%-10s %6d teams (%6d KB)  peak growth: %8d KB  wall: %6.2f s' % (
+            mode, count, size / 1024, max(0, peak - before), elapsed))
+    return 0
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
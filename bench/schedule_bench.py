@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Compares the order the builder tasks are queued in, the way queue_builders
+# used to do it (whatever order the query returned) and the order from
+# scheduler.order_groups.  The groups that people watch are taken to be the
+# top of the rankings plus the teams that killed something in the last week.
+# Reports how far into the queue those groups sit on average, as a fraction
+# of the whole queue, and how long it takes to work out the order.
+#
+# Usage: python bench/schedule_bench.py [groups]
+
+from __future__ import print_function
+
+import datetime
+import logging
+import random
+import sys
+
+import benchutil
+benchutil.setup_path()
+
+from google.appengine.ext import ndb
+
+import ctrpmodels
+import scheduler
+from ctrpmodels import Constants
+
+import fakedata
+
+# The fraction of the community at the top of the rankings that counts as
+# watched, and the fraction of the community that's actively progressing.
+TOP_FRACTION = 0.05
+ACTIVE_FRACTION = 0.1
+
+def make_community(count, today):
+    rng = random.Random(count)
+    groups = list()
+    history = list()
+    for i in xrange(count):
+        group = fakedata.make_group_entity('Schedule Bench %05d' % i, seed=i)
+        group.rosterupdated = today - datetime.timedelta(days=rng.randint(0, 60))
+        groups.append(group)
+
+        if rng.random() < ACTIVE_FRACTION:
+            entry = ctrpmodels.History(group=group.name,
+                                       date=today - datetime.timedelta(days=rng.randint(0, 6)))
+            entry.aep = ctrpmodels.RaidHistory(normal=[], heroic=[], mythic=[])
+            diff = rng.choice(Constants.difficulties)
+            setattr(entry.aep, diff, rng.sample(Constants.aepbosses, rng.randint(1, 2)))
+            history.append(entry)
+
+    for batch in (groups, history):
+        for i in xrange(0, len(batch), 500):
+            ndb.put_multi(batch[i:i+500])
+    return set(entry.group for entry in history)
+
+def mean_position(order, watched):
+    positions = [i for (i, group) in enumerate(order) if group.name in watched]
+    if not positions:
+        return 0.0
+    return float(sum(positions)) / len(positions) / len(order)
+
+def main(count):
+    logging.disable(logging.CRITICAL)
+    bed = benchutil.start_testbed()
+    try:
+        today = datetime.date.today()
+        active = make_community(count, today)
+        top = [group.name for group in ctrpmodels.Group.query_by_rank().fetch(int(count * TOP_FRACTION))]
+        watched = active | set(top)
+
+        groups = ctrpmodels.Group.query().fetch(projection=[ctrpmodels.Group.name])
+        (ordered, report) = scheduler.order_groups(groups, today)
+
+        print('%d groups, %d watched' % (count, len(watched)))
+        print('mean queue position of the watched groups: query order %.2f, scheduled %.2f' % (
+            mean_position(groups, watched), mean_position(ordered, watched)))
+        print('front of the order: %s' % ', '.join('%s (%.2f)' % entry for entry in report[:5]))
+        benchutil.report('order_groups', benchutil.time_runs(
+            lambda: scheduler.order_groups(groups, today), 5))
+    finally:
+        bed.deactivate()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
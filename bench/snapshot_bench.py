@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Compares the ways the main page and the tooltips can get at every group:
+# querying and deserializing all of the Group entities, getting and decoding
+# the Snapshot, and using an instance's cached copy of the snapshot.
+#
+# Usage: python bench/snapshot_bench.py [groups] [runs]
+
+from __future__ import print_function
+
+import logging
+import sys
+
+import benchutil
+benchutil.setup_path()
+
+from google.appengine.ext import ndb
+
+import ctrpmodels
+import display
+
+import fakedata
+
+def main(count, runs):
+    logging.disable(logging.CRITICAL)
+    bed = benchutil.start_testbed()
+    try:
+        groups = [fakedata.make_group_entity('Snapshot %05d' % i) for i in xrange(count)]
+        for i in xrange(0, len(groups), 500):
+            ndb.put_multi(groups[i:i+500])
+        last_updated = ctrpmodels.Global.mark_updated()
+        display.rebuild_snapshot(last_updated)
+        version = display.version_stamp(last_updated)
+
+        snapshot = ctrpmodels.Snapshot.get_current()
+        print('%d groups, snapshot is %d bytes' % (count, len(snapshot.content)))
+
+        def query():
+            ndb.get_context().clear_cache()
+            ctrpmodels.Group.query_by_rank().fetch()
+
+        def get_snapshot():
+            ndb.get_context().clear_cache()
+            display._snapshot = (None, None)
+            display.snapshot_groups(version)
+
+        benchutil.report('query every group', benchutil.time_runs(query, runs))
+        benchutil.report('get and decode the snapshot', benchutil.time_runs(get_snapshot, runs))
+        display.snapshot_groups(version)
+        benchutil.report('instance copy of the snapshot', benchutil.time_runs(
+            lambda: display.snapshot_groups(version), runs))
+    finally:
+        bed.deactivate()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+                  int(sys.argv[2]) if len(sys.argv) > 2 else 20))
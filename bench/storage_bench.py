@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Compares groups that store their kills as a list of Boss models with groups
+# that store them as packed bitmasks and dates.  Reports the size of the
+# stored entities, the time to serialize and deserialize them, and the time to
+# render the main page and the tooltips from the datastore.
+#
+# Usage: python bench/storage_bench.py [groups] [runs]
+
+from __future__ import print_function
+
+import logging
+import sys
+
+import benchutil
+benchutil.setup_path()
+
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+import ctrpmodels
+import display
+from main import app
+
+import fakedata
+
+def make_groups(count, legacy):
+    groups = list()
+    for i in xrange(count):
+        group = fakedata.make_group_entity('Storage %04d' % i, legacy=legacy)
+        group.key = ndb.Key(ctrpmodels.Group, 'Storage %04d' % i)
+        groups.append(group)
+    return groups
+
+def run(count, runs, legacy):
+    label = 'legacy' if legacy else 'packed'
+
+    # the keys get the app id of the testbed, so it has to be active before
+    # the groups are made
+    bed = benchutil.start_testbed()
+    try:
+        groups = make_groups(count, legacy)
+        adapter = ndb.ModelAdapter()
+
+        pbs = [adapter.entity_to_pb(group) for group in groups]
+        size = sum(pb.ByteSize() for pb in pbs) / len(pbs)
+        print('%s: %d bytes per group entity' % (label, size))
+
+        encoded = [pb.Encode() for pb in pbs]
+        def serialize():
+            for group in groups:
+                adapter.entity_to_pb(group).Encode()
+        def deserialize():
+            for data in encoded:
+                adapter.pb_to_entity(entity_pb.EntityProto(data))
+
+        benchutil.report('%s serialize %d groups' % (label, count), benchutil.time_runs(serialize, runs))
+        benchutil.report('%s deserialize %d groups' % (label, count), benchutil.time_runs(deserialize, runs))
+
+        for i in xrange(0, len(groups), 500):
+            ndb.put_multi(groups[i:i+500])
+        last_updated = ctrpmodels.Global.mark_updated()
+
+        with app.test_request_context('/'):
+            def leaderboard():
+                ndb.get_context().clear_cache()
+                display.render_leaderboard(last_updated, 1, ctrpmodels.Group.query_for_singletier_display(), False)
+            def tooltips():
+                ndb.get_context().clear_cache()
+                display.build_tooltips()
+
+            benchutil.report('%s render main page' % label, benchutil.time_runs(leaderboard, runs))
+            benchutil.report('%s build tooltips' % label, benchutil.time_runs(tooltips, runs))
+    finally:
+        bed.deactivate()
+
+def main(count, runs):
+    logging.disable(logging.CRITICAL)
+    for legacy in (True, False):
+        run(count, runs, legacy)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+                  int(sys.argv[2]) if len(sys.argv) > 2 else 10))
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Compares the old tooltips.js, which carried the tooltips for every group and
+# was rebuilt on every request, with the loader script and per-group JSON that
+# replaced it.  Reports the bytes a page view downloads before any tooltip is
+# shown and the server time per request, for a few group counts.
+#
+# Usage: python bench/tooltips_bench.py [runs]
+
+from __future__ import print_function
+
+import logging
+import sys
+
+import benchutil
+benchutil.setup_path()
+
+from google.appengine.ext import ndb
+
+import ctrpmodels
+import display
+from flask import request
+from main import app
+
+import fakedata
+
+GROUP_COUNTS = (100, 500, 2000)
+
+LEGACY_TOOLTIP = ('    tooltips["%(name)s-%(raid)s-mythic-header"] = "%(mythictext)s";\n'
+                  '    tooltips["%(name)s-%(raid)s-heroic-header"] = "%(heroictext)s";\n'
+                  '    tooltips["%(name)s-%(raid)s-normal-header"] = "%(normaltext)s";\n')
+
+# The monolithic script, built the way display.build_tooltips used to build it
+# on every request to /tooltips.js.
+def legacy_tooltips():
+    response = ('$(function() {\n'
+                '  $(document).tooltip({\n'
+                '    items: "[ttid]",\n'
+                '    content: function() {\n'
+                '      var tooltips = {};\n')
+
+    groups = ctrpmodels.Group.query_for_singletier_display()
+    for raidinfo in ctrpmodels.Constants.raids:
+        raid = raidinfo[0]
+        for group in groups:
+            text = {'normaltext': '', 'heroictext': '', 'mythictext': ''}
+            bosses = []
+            groupraid = getattr(group, raid)
+            raidbosses = getattr(ctrpmodels.Constants, raid+'bosses')
+
+            # the old code read these from the list of Boss models that groups
+            # used to store
+            for (i, name) in enumerate(raidbosses):
+                bosses.append((name, groupraid.kill_date(i, 'normal'),
+                               groupraid.kill_date(i, 'heroic'), groupraid.kill_date(i, 'mythic')))
+            index_dict = {item: index for index, item in enumerate(raidbosses)}
+            bosses.sort(key=lambda t: index_dict[t[0]])
+
+            for boss in bosses:
+                for (i, diff) in enumerate(ctrpmodels.Constants.difficulties):
+                    if boss[i+1] != None:
+                        text[diff+'text'] += "<div class='bossdead'>%s</div>" % boss[0]
+                    else:
+                        text[diff+'text'] += "<div class='bossalive'>%s</div>" % boss[0]
+
+            response += LEGACY_TOOLTIP % dict(text, name=display.normalize(group.name), raid=raid)
+
+    response += ('\n'
+                 '      var element = $(this);\n'
+                 '      var ttid = element.attr("ttid");\n'
+                 '      return tooltips[ttid];\n'
+                 '    }});\n'
+                 '});')
+    return response
+
+def run(count, runs):
+    bed = benchutil.start_testbed()
+    try:
+        groups = [fakedata.make_group_entity('Tooltips %04d' % i) for i in xrange(count)]
+        for i in xrange(0, len(groups), 500):
+            ndb.put_multi(groups[i:i+500])
+        name = display.normalize(groups[count / 2].name)
+
+        with app.test_request_context('/'):
+            def legacy():
+                ndb.get_context().clear_cache()
+                return legacy_tooltips()
+
+            digest = display.rebuild_tooltips()
+            loader = display.serve_tooltips(request, digest).get_data()
+            group = display.serve_group_tooltips(request, digest, name).get_data()
+            script = legacy()
+
+            print('%5d groups: old script %8d bytes, loader %5d bytes, one group %5d bytes' % (
+                count, len(script), len(loader), len(group)))
+
+            benchutil.report('old /tooltips.js', benchutil.time_runs(legacy, runs))
+            benchutil.report('new loader script',
+                             benchutil.time_runs(lambda: display.serve_tooltips(request, digest), runs))
+            benchutil.report('new group tooltips',
+                             benchutil.time_runs(lambda: display.serve_group_tooltips(request, digest, name), runs))
+            benchutil.report('rebuild once per run', benchutil.time_runs(display.rebuild_tooltips, 1))
+    finally:
+        bed.deactivate()
+
+def main(runs):
+    logging.disable(logging.CRITICAL)
+    for count in GROUP_COUNTS:
+        run(count, runs)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20))
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Counts the datastore round trips for the write-heavy parts of a run: loading
+# the rosters, building the groups and marking the day's history as tweeted.
+# Each pass runs against the in-memory datastore from the testbed, once with
+# every entity written on its own (the way the code used to work) and once
+# with the writes batched by writebatch.WriteBatcher.
+#
+# Usage: python bench/write_bench.py [groups]
+
+from __future__ import print_function
+
+import collections
+import datetime
+import json
+import logging
+import sys
+import timeit
+
+import benchutil
+benchutil.setup_path()
+
+from google.appengine.api import apiproxy_stub_map
+
+import ctrpmodels
+import ranker
+import rostermgmt
+import writebatch
+
+import fakebnet
+import fakedata
+
+TEAMS_URL = 'http://guild.converttoraid.com/api/teams'
+
+# Writes each entity as soon as it's handed over, which makes the same calls
+# the code made before the writes were batched.
+class ImmediateWriter(writebatch.WriteBatcher):
+
+    def __init__(self, batch_size=None):
+        super(ImmediateWriter, self).__init__(batch_size=1)
+
+    def put(self, entity):
+        super(ImmediateWriter, self).put(entity)
+        self.flush()
+
+    def delete(self, key):
+        super(ImmediateWriter, self).delete(key)
+        self.flush()
+
+# Feeds canned toon data for a group into the ranker in place of the API.
+class ReplayImporter(object):
+
+    def __init__(self, groupdata):
+        self.groupdata = groupdata
+
+    def load(self, toonlist, data, store=None):
+        for toon in self.groupdata:
+            data.append(toon)
+
+def make_teams(count):
+    teams = dict()
+    groupdata = dict()
+    for i in xrange(count):
+        name = 'Write Bench %d' % i
+        toons = fakedata.make_group(name, size=20, core=10, killed=i % 9)
+        groupdata[name] = toons
+        teams[name] = {'status': 'Active', 'toons': [
+            {'toon_name': t['name'], 'realm': t['realm'], 'status': 'Active'}
+            for t in toons]}
+    return (teams, groupdata)
+
+def run(teams, groupdata, batched):
+    bed = benchutil.start_testbed()
+    original = writebatch.WriteBatcher
+    try:
+        if not batched:
+            writebatch.WriteBatcher = ImmediateWriter
+
+        api = fakebnet.FakeBattleNet()
+        api.install()
+        api.add_document(TEAMS_URL, json.dumps(teams))
+
+        calls = collections.Counter()
+        def count(service, call, request, response):
+            calls[call] += 1
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('write-bench', count, 'datastore_v3')
+
+        results = list()
+        def phase(label, func):
+            calls.clear()
+            start = timeit.default_timer()
+            func()
+            elapsed = timeit.default_timer() - start
+            writes = calls['Put'] + calls['Delete']
+            results.append((label, writes, sum(calls.values()), elapsed))
+
+        def build():
+            for group in ctrpmodels.Group.query().fetch():
+                ranker.process_group(group, ReplayImporter(groupdata[group.name]), True)
+
+        def mark():
+            updates = ctrpmodels.History.get_not_tweeted(datetime.date.today())
+            ranker.tweet_updates(updates, None)
+
+        phase('roster load', rostermgmt.load_groups)
+        phase('build groups', build)
+        phase('mark history', mark)
+        return results
+    finally:
+        writebatch.WriteBatcher = original
+        bed.deactivate()
+
+def main(count):
+    logging.disable(logging.CRITICAL)
+    (teams, groupdata) = make_teams(count)
+
+    print('%-14s %-9s %10s %12s %8s' % ('phase', 'writes', 'write rpcs', 'total rpcs', 'wall s'))
+    for batched in (False, True):
+        for (label, writes, total, elapsed) in run(teams, groupdata, batched):
+            print('%-14s %-9s %10d %12d %8.2f' % (label, 'batched' if batched else 'single',
+                                                writes, total, elapsed))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
@@ -5,7 +5,15 @@
 # This file contains the models for the NDB entries that CTRP uses to store data in
 # app engine.  They're here to keep the definitions out of the ranker code.
 
+import collections
+import datetime
+import json
 import logging
+import struct
+import threading
+import time
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 class Constants(object):
@@ -18,6 +26,48 @@ class Constants(object):
     raidnames = [aepname]
     raids = [('aep', aepname, aepbosses)]
 
+# Read-through cache for small values that are read far more often than they
+# change, with an LRU in each instance in front of memcache.  A miss in both
+# calls the loader passed to get and stores what it returns, unless that's
+# None.  Entries in an instance expire after local_ttl seconds so that an
+# invalidation on one instance reaches the rest of them in that time.
+class ReadThroughCache(object):
+
+    def __init__(self, namespace, ttl, local_ttl=60, local_size=1000):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local_ttl = min(local_ttl, ttl)
+        self.local_size = local_size
+        self.local = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, loader):
+        now = time.time()
+        with self.lock:
+            entry = self.local.pop(key, None)
+            if entry is not None and entry[0] > now:
+                # put it back at the most recently used end
+                self.local[key] = entry
+                return entry[1]
+
+        value = memcache.get(key, namespace=self.namespace)
+        if value is None:
+            value = loader()
+            if value is None:
+                return None
+            memcache.set(key, value, time=self.ttl, namespace=self.namespace)
+
+        with self.lock:
+            self.local[key] = (now + self.local_ttl, value)
+            while len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.local.pop(key, None)
+        memcache.delete(key, namespace=self.namespace)
+
 # Model for a single boss in a raid instance.  Keeps track of whether a boss has been
 # killed for each of the difficulties.  There will be multiple of these in each Raid
 # model below.
@@ -29,16 +79,96 @@ class Boss(ndb.Model):
 
 # Model of a raid instance.  This keeps track of the number of bosses killed by a raid
 # group for a single instance.  Contains a number of kills for each difficulty, built
-# from the array of bosses also kept in this model.  There maybe 1-to-many of these in
+# from the kill data also kept in this model.  There maybe 1-to-many of these in
 # each Group model below.
+#
+# The kills are stored compactly: a bitmask per difficulty with a bit set for each
+# boss killed, indexed by the boss's position in Constants.raids, and a packed
+# array of the dates of the kills, one slot per boss and difficulty.  Older
+# entities store the kills as a list of Boss models instead.  Those are converted
+# the first time the kills are read and dropped when the entity is next written.
 class Raid(ndb.Model):
     # the next three values are the number of kills for each of difficulties, culled
     # from the boss data.
     normal = ndb.IntegerProperty(required=True, default=0)
     heroic = ndb.IntegerProperty(required=True, default=0)
     mythic = ndb.IntegerProperty(required=True, default=0)
+
+    normalmask = ndb.IntegerProperty(indexed=False, default=0)
+    heroicmask = ndb.IntegerProperty(indexed=False, default=0)
+    mythicmask = ndb.IntegerProperty(indexed=False, default=0)
+
+    # big-endian unsigned shorts, each the number of days since DATE_EPOCH plus
+    # one for the date of a kill, or zero if there hasn't been one.  the slot
+    # for a boss and difficulty is boss index * 3 + difficulty index.
+    killdates = ndb.BlobProperty(default='')
+
+    # the legacy storage for the kills
     bosses = ndb.StructuredProperty(Boss, repeated=True)
 
+    DATE_EPOCH = datetime.date(2000, 1, 1)
+
+    def killed(self, index, diff):
+        self.convert_bosses()
+        return bool(getattr(self, diff+'mask') & (1 << index))
+
+    # Returns the date of the kill of a boss on a difficulty, or None.
+    def kill_date(self, index, diff):
+        self.convert_bosses()
+        slot = index * len(Constants.difficulties) + Constants.difficulties.index(diff)
+        dates = self._unpack_dates()
+        if slot >= len(dates) or dates[slot] == 0:
+            return None
+        return self.DATE_EPOCH + datetime.timedelta(days=dates[slot] - 1)
+
+    # Records the kill of a boss on a difficulty.  This doesn't update the kill
+    # counts, since the ranker uses those to tell what's new.
+    def set_kill(self, index, diff, date):
+        self.convert_bosses()
+        setattr(self, diff+'mask', getattr(self, diff+'mask') | (1 << index))
+
+        slot = index * len(Constants.difficulties) + Constants.difficulties.index(diff)
+        dates = self._unpack_dates()
+        if slot >= len(dates):
+            dates.extend([0] * (slot + 1 - len(dates)))
+        dates[slot] = (date - self.DATE_EPOCH).days + 1
+        self.killdates = struct.pack('>%dH' % len(dates), *dates)
+
+    def kill_mask(self, diff):
+        self.convert_bosses()
+        return getattr(self, diff+'mask')
+
+    # Returns the number of bosses killed on a difficulty, from the bitmask.
+    def kill_count(self, diff):
+        self.convert_bosses()
+        return bin(getattr(self, diff+'mask')).count('1')
+
+    def _unpack_dates(self):
+        return list(struct.unpack('>%dH' % (len(self.killdates) / 2), self.killdates))
+
+    # Moves the kills from the legacy list of Boss models into the packed data.
+    def convert_bosses(self):
+        if not self.bosses:
+            return
+
+        legacy = self.bosses
+        self.bosses = list()
+        for raid in Constants.raids:
+            index = dict((boss, i) for (i, boss) in enumerate(raid[2]))
+            if legacy[0].name in index:
+                break
+        else:
+            logging.error('Failed to find the raid for boss %s', legacy[0].name)
+            return
+
+        for boss in legacy:
+            if boss.name not in index:
+                continue
+            for diff in Constants.difficulties:
+                date = getattr(boss, diff+'dead')
+                if date is not None:
+                    self.set_kill(index[boss.name], diff, date)
+
 class Group(ndb.Model):
     name = ndb.StringProperty(indexed=True, required=True)
     toons = ndb.StringProperty(repeated=True)
@@ -51,6 +181,32 @@ class Group(ndb.Model):
     rosterupdated = ndb.DateProperty()
     avgilvl = ndb.IntegerProperty(default=0)
 
+    # hash of the toon list as of the last roster load, see rostermgmt.py
+    rosterhash = ndb.StringProperty(indexed=False)
+
+    # the newest lastModified time of any of the group's toons, the hash of
+    # its roster and the number of its toons that loaded, as of the last time
+    # it was built.  an incremental ranking run skips the group if every toon
+    # loaded then and now and neither the time nor the roster has moved since.
+    builtmodified = ndb.IntegerProperty(indexed=False)
+    builtroster = ndb.StringProperty(indexed=False)
+    builtloaded = ndb.IntegerProperty(indexed=False)
+
+    # The group's place in the rankings as a single sortable string: the kill
+    # counts for each difficulty, most important first and subtracted from 99
+    # so that more kills sort first, then the group name to break ties.  This
+    # sorts the same as the order in query_for_singletier_display, but with a
+    # single property index, so a page of the rankings or a group's rank is a
+    # cheap query.  It's kept up to date every time the group is written.
+    rankkey = ndb.StringProperty(indexed=True)
+
+    def make_rank_key(self):
+        return u'%02d%02d%02d|%s' % (99 - self.aep.mythic, 99 - self.aep.heroic,
+                                     99 - self.aep.normal, self.name)
+
+    def _pre_put_hook(self):
+        self.rankkey = self.make_rank_key()
+
     # Query used in display.py to get a consistent set of data for both the graphical
     # and text displays.
     @classmethod
@@ -59,6 +215,11 @@ class Group(ndb.Model):
         results = query.fetch()
         return results
 
+    # Returns the query for the groups in rank order.
+    @classmethod
+    def query_by_rank(cls):
+        return cls.query().order(cls.rankkey)
+
     # Query used in display.py to get a consistent set of data for both the graphical
     # and text displays.
     @classmethod
@@ -67,24 +228,281 @@ class Group(ndb.Model):
         results = query.fetch()
         return results
 
+    # Looks up a group by name.  The key for the name is cached, so after the
+    # first lookup this is a get, which ndb serves from its own cache.  A name
+    # never moves to a different key, so the cache only has to be fixed up if
+    # the group was deleted.
     @classmethod
     def get_group_by_name(cls, group_name):
-        results = cls.query(cls.name == group_name).fetch(1)
+        urlsafe = group_key_cache.get(group_name, lambda: cls._find_key(group_name))
+        if urlsafe is None:
+            return None
+
+        group = ndb.Key(urlsafe=urlsafe).get()
+        if group is None:
+            group_key_cache.invalidate(group_name)
+            urlsafe = cls._find_key(group_name)
+            if urlsafe is not None:
+                group = ndb.Key(urlsafe=urlsafe).get()
+        return group
+
+    @classmethod
+    def _find_key(cls, group_name):
+        results = cls.query(cls.name == group_name).fetch(1, keys_only=True)
         if results:
-            return results[0]
+            return results[0].urlsafe()
         return None
 
+# Compact copy of everything the main page and the tooltips need from every
+# group, in rank order.  The ranker writes it once at the end of each run so
+# that those pages can be built from a single get instead of a query that
+# loads every group.  Each group is stored as a list of its name and average
+# ilvl, then for each raid in Constants.raids the normal, heroic and mythic
+# kill counts followed by the three kill bitmasks, all encoded as JSON, which
+# decodes a lot faster than the entities do.
+class Snapshot(ndb.Model):
+    SNAPSHOT_ID = 'leaderboard'
+
+    version = ndb.StringProperty(indexed=False)
+    content = ndb.BlobProperty(compressed=True)
+
+    # Builds and stores the snapshot from the groups in the datastore.
+    @classmethod
+    def build(cls, version):
+        rows = list()
+        for group in Group.query_by_rank().fetch():
+            row = [group.name, group.avgilvl]
+            for raid in Constants.raids:
+                group_raid = getattr(group, raid[0])
+                row.extend(getattr(group_raid, diff) for diff in Constants.difficulties)
+                row.extend(group_raid.kill_mask(diff) for diff in Constants.difficulties)
+            rows.append(row)
+
+        snapshot = cls(id=cls.SNAPSHOT_ID, version=version,
+                       content=json.dumps(rows, separators=(',', ':')))
+        snapshot.put()
+        return snapshot
+
+    @classmethod
+    def get_current(cls):
+        return cls.get_by_id(cls.SNAPSHOT_ID)
+
+    # Returns the groups in the snapshot as GroupSummary objects, in rank order.
+    def get_groups(self):
+        width = len(Constants.difficulties)
+        groups = list()
+        for row in json.loads(self.content):
+            group = GroupSummary(row[0], row[1])
+            offset = 2
+            for raid in Constants.raids:
+                setattr(group, raid[0], RaidSummary(row[offset:offset+width],
+                                                    row[offset+width:offset+2*width]))
+                offset += 2 * width
+            groups.append(group)
+        return groups
+
+# The parts of a Group kept in a Snapshot.  These stand in for Group and Raid
+# entities in the templates and the tooltips.
+class GroupSummary(object):
+
+    def __init__(self, name, avgilvl):
+        self.name = name
+        self.avgilvl = avgilvl
+
+class RaidSummary(object):
+
+    def __init__(self, counts, masks):
+        (self.normal, self.heroic, self.mythic) = counts
+        self.masks = masks
+
+    def killed(self, index, diff):
+        return bool(self.masks[Constants.difficulties.index(diff)] & (1 << index))
+
+# Global state for the site.  There's only one of these, stored under a fixed
+# key, so reading it is a get that ndb serves from memcache instead of a query.
 class Global(ndb.Model):
+    GLOBAL_ID = 'global'
+
     lastupdated = ndb.DateTimeProperty(auto_now=True)
 
     @classmethod
     def get_last_updated(cls):
-        result = cls.query().fetch()
-        if result:
-            updated = result[0].lastupdated
-            return updated
+        entry = cls.get_by_id(cls.GLOBAL_ID)
+        if entry is None:
+            # the entry from before the fixed key was used, if there is one
+            result = cls.query().fetch(1)
+            if not result:
+                return None
+            entry = result[0]
+        return entry.lastupdated
+
+    # Bumps the last updated time to now, creating the entry if there isn't one
+    # yet, and returns the new time.
+    @classmethod
+    def mark_updated(cls):
+        entry = cls.get_by_id(cls.GLOBAL_ID)
+        if entry is None:
+            entry = cls(id=cls.GLOBAL_ID)
+        entry.put()
+        return entry.lastupdated
+
+# A generated file that's the same for every visitor, like tooltips.js.  The
+# digest is a hash of the content, used for versioned URLs and ETags.  This is
+# kept out of ndb's memcache cache since it can be large and display.py keeps
+# its own cached copy.
+class Artifact(ndb.Model):
+    _use_memcache = False
+
+    content = ndb.BlobProperty(compressed=True)
+    digest = ndb.StringProperty(indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+# Cached copy of the parts of a toon's Battle.net data that the ranker uses,
+# keyed on the toon's name and realm.  lastmodified is the API's timestamp for
+# the last time the character changed, which is sent back to the API to skip
+# downloading characters that haven't changed since they were cached.  The
+# importer reads and writes each entry once per request, so they're kept out
+# of ndb's in-context cache, which would otherwise hold on to every toon a
+# builder or fetcher touched until the request ends.
+class ToonCache(ndb.Model):
+    _use_cache = False
+
+    lastmodified = ndb.IntegerProperty(indexed=False, default=0)
+    etag = ndb.StringProperty(indexed=False)
+    level = ndb.IntegerProperty(indexed=False, default=0)
+    ilvl = ndb.IntegerProperty(indexed=False)
+    raids = ndb.JsonProperty(indexed=False, compressed=True)
+    checked = ndb.DateTimeProperty(indexed=False)
+
+    # how long a cached toon is used as-is without asking the API whether it
+    # has changed
+    FRESH_TIME = datetime.timedelta(minutes=30)
+
+    def is_fresh(self, now):
+        return self.checked is not None and now - self.checked < self.FRESH_TIME
+
+    # Rebuilds toon data in the same shape as a response from the API, so
+    # that it can be used anywhere a live response can.
+    def to_toondata(self):
+        toondata = {
+            'name': self.key.id().split('/')[0],
+            'lastModified': self.lastmodified,
+            'level': self.level,
+            'progression': {'raids': self.raids or []},
+            'cached': True,
+        }
+        if self.ilvl is not None:
+            toondata['items'] = {'averageItemLevelEquipped': self.ilvl}
+        return toondata
+
+    @classmethod
+    def from_toondata(cls, key, toondata, etag=None):
+        entry = cls(id=key)
+        entry.lastmodified = toondata.get('lastModified', 0)
+        entry.etag = etag
+        entry.level = toondata.get('level', 0)
+        if 'items' in toondata:
+            entry.ilvl = toondata['items'].get('averageItemLevelEquipped')
+        if toondata.get('progression') is not None:
+            entry.raids = toondata['progression']['raids']
+        entry.checked = datetime.datetime.utcnow()
+        return entry
+
+# Model for a single ranking run.  Keeps track of the size of the run so that the
+# admin page can report on how much work the run-level fetch stage saved, and
+# of which stages of the run have finished.
+class RankingRun(ndb.Model):
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty()
+    groups = ndb.IntegerProperty(default=0)
+    fetch_tasks = ndb.IntegerProperty(default=0)
+
+    # the number of toon entries across all of the group rosters, and the
+    # number of distinct toons among them.  each distinct toon is only
+    # fetched once per run.
+    toons_total = ndb.IntegerProperty(default=0)
+    toons_unique = ndb.IntegerProperty(default=0)
+
+    # the stages of the run that have completed, in order
+    completed = ndb.StringProperty(repeated=True)
+
+    # whether the run skips the groups that can't have changed, and the names
+    # of the groups it skipped outright because they were quiet and unchanged.
+    # groups whose toons hadn't changed are counted in the run's ToonStore.
+    incremental = ndb.BooleanProperty(default=False)
+    skipped = ndb.StringProperty(repeated=True, indexed=False)
+
+    # the front of the order the builders were queued in, as a list of
+    # [group name, score] pairs.  see scheduler.py.
+    build_order = ndb.JsonProperty(indexed=False)
+
+    @classmethod
+    def get_latest(cls):
+        results = cls.query().order(-cls.started).fetch(1)
+        if results:
+            return results[0]
+        return None
+
+    @classmethod
+    def get_latest_full(cls):
+        results = cls.query(cls.incremental == False).order(-cls.started).fetch(1)
+        if results:
+            return results[0]
         return None
 
+    # Marks a stage of a run as completed.  Returns False if it already was,
+    # in which case whatever follows the stage has already been started.
+    @classmethod
+    @ndb.transactional
+    def complete_stage(cls, run_id, stage):
+        run = cls.get_by_id(int(run_id))
+        if run is None or stage in run.completed:
+            return False
+        run.completed.append(stage)
+        if stage == 'build':
+            run.finished = datetime.datetime.utcnow()
+        run.put()
+        return True
+
+    # Undoes complete_stage, for when starting the next stage failed.
+    @classmethod
+    @ndb.transactional
+    def reopen_stage(cls, run_id, stage):
+        run = cls.get_by_id(int(run_id))
+        if run is not None and stage in run.completed:
+            run.completed.remove(stage)
+            run.finished = None
+            run.put()
+
+# Marker for a task in one of the stages of a ranking run having finished.
+# See barrier.py.
+class StageArrival(ndb.Model):
+    run = ndb.StringProperty(required=True)
+    stage = ndb.StringProperty(required=True)
+    failed = ndb.BooleanProperty(default=False)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    @staticmethod
+    def make_id(run_id, stage, member):
+        return ('%s:%s:%s' % (run_id, stage, member)).encode('utf-8')
+
+# A profile of a single request, taken by profiler.py.  top holds the hottest
+# functions and stacks holds the samples in the collapsed format that
+# flamegraph.pl reads, when the profile was sampled.
+class Profile(ndb.Model):
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    endpoint = ndb.StringProperty(required=True)
+    path = ndb.StringProperty(indexed=False)
+    mode = ndb.StringProperty(indexed=False)
+    duration = ndb.FloatProperty(indexed=False)
+    samples = ndb.IntegerProperty(default=0, indexed=False)
+    top = ndb.JsonProperty(indexed=False, compressed=True)
+    stacks = ndb.TextProperty(compressed=True)
+
+    @classmethod
+    def get_recent(cls, count=20):
+        return cls.query().order(-cls.started).fetch(count)
+
 class RaidHistory(ndb.Model):
     mythic = ndb.StringProperty(repeated=True)
     heroic = ndb.StringProperty(repeated=True)
@@ -104,29 +522,90 @@ class History(ndb.Model):
         results = cls.query(cls.date == date).order(cls.group).fetch()
         return results
 
+    # Returns every entry from the given date on, in a single query, ordered
+    # by date and then group name.
+    @classmethod
+    def get_since(cls, date):
+        results = cls.query(cls.date >= date).order(cls.date, cls.group).fetch()
+        return results
+
     @classmethod
     def get_for_group(cls, group_name):
         results = cls.query(cls.group == group_name).order(-cls.date)
         return results
 
+    # Returns a page of the entries for a group, most recent first, as
+    # (entries, cursor, more).  cursor is the urlsafe cursor for the next page,
+    # or None if there isn't one.
+    @classmethod
+    def get_page(cls, group_name, page_size, cursor=None, keys_only=False):
+        query = cls.query(cls.group == group_name).order(-cls.date)
+        start = Cursor(urlsafe=cursor) if cursor else None
+        (results, next_cursor, more) = query.fetch_page(page_size, start_cursor=start,
+                                                        keys_only=keys_only)
+        if more and next_cursor is not None:
+            return (results, next_cursor.urlsafe(), True)
+        return (results, None, False)
+
     @classmethod
     def get_not_tweeted(cls, date):
         results = cls.query(ndb.AND(cls.date == date,
                                     cls.tweeted == False)).order(cls.group)
         return results
 
+# Copy of the most recent history entries for a group, keyed on the group name,
+# so that the first page of a group's history is a single get instead of a
+# query.  The ranker adds to it whenever it writes a new History entry for the
+# group.  cursor is where the second page starts, and is filled in the first
+# time it's needed after the entries change.
+class Timeline(ndb.Model):
+    PAGE_SIZE = 20
+
+    entries = ndb.LocalStructuredProperty(History, repeated=True)
+    more = ndb.BooleanProperty(default=False, indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+
+    # Returns the timeline for a group, building it from the group's history
+    # if it doesn't exist yet.  A newly built timeline is only stored if the
+    # group has any history.
+    @classmethod
+    def get_for_group(cls, group_name):
+        timeline = cls.get_by_id(group_name)
+        if timeline is None:
+            (entries, cursor, more) = History.get_page(group_name, cls.PAGE_SIZE)
+            timeline = cls(id=group_name, entries=entries, more=more, cursor=cursor)
+            if entries:
+                timeline.put()
+        return timeline
+
+    # Adds a new entry to the front of the timeline.
+    def add(self, history):
+        self.entries.insert(0, history)
+        if len(self.entries) > self.PAGE_SIZE:
+            del self.entries[self.PAGE_SIZE:]
+            self.more = True
+        self.cursor = None
+
+group_key_cache = ReadThroughCache('group-keys', ttl=7*24*60*60, local_size=10000)
+
+# Converts the groups that still store their kills as lists of Boss models to
+# the packed kill data, and fills in the rank key for groups that don't have
+# one yet.  The last updated time is bumped afterwards, since the pages cached
+# against the old one may have been built without the groups that were
+# missing a rank key.  Returns the new last updated time and a message for
+# the page.
 def migrate():
     groups = Group.query().fetch()
+    converted = list()
     for group in groups:
-        if 'bod' in group._properties:
-            del group._properties['bod']
-
-        group.aep = Raid()
-        group.aep.raidname = Constants.aepname
-        group.aep.bosses = list()
-        for boss in Constants.aepbosses:
-            newboss = Boss(name=boss)
-            group.aep.bosses.append(newboss)
-
-        logging.info(group)
-        group.put()
+        raids = [getattr(group, raid[0]) for raid in Constants.raids]
+        if any(group_raid.bosses for group_raid in raids) or group.rankkey != group.make_rank_key():
+            for group_raid in raids:
+                group_raid.convert_bosses()
+            converted.append(group)
+
+    logging.info('Migrating %d groups', len(converted))
+    for i in xrange(0, len(converted), 100):
+        ndb.put_multi(converted[i:i+100])
+
+    return (Global.mark_updated(), 'Migrated %d groups' % len(converted))
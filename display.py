@@ -1,100 +1,362 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python
 
+import cgi
 import datetime
-from flask import render_template, redirect
+import hashlib
+import json
+import logging
+import urllib
+import zlib
+from flask import Response, current_app, render_template, redirect
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 import ctrpmodels
 
 def normalize(groupname):
     return groupname.lower().replace('\'', '').replace(' ', '-').replace('"', '')
 
-def display():
-    last_updated = ctrpmodels.Global.get_last_updated()
+# (version, groups) for the snapshot of the groups held by this instance
+_snapshot = (None, None)
+
+# Returns the string used to version the caches built from the data as of a
+# Global last updated time.
+def version_stamp(last_updated):
+    return last_updated.strftime('%Y%m%d%H%M%S%f')
+
+# Writes the snapshot of the groups at the end of a ranking run.
+def rebuild_snapshot(last_updated):
+    global _snapshot
+
+    snapshot = ctrpmodels.Snapshot.build(version_stamp(last_updated))
+    _snapshot = (snapshot.version, snapshot.get_groups())
+
+# Writes the snapshot of the groups and rebuilds everything that's built from
+# it as of a new Global last updated time: the tooltips and the cached copies
+# of the main page (which links to the new tooltips).  Also rebuilds today's
+# history.
+def rebuild_all(last_updated):
+    rebuild_snapshot(last_updated)
+    rebuild_tooltips(version_stamp(last_updated))
+    rebuild_leaderboard(last_updated)
+    rebuild_history_today(last_updated)
+
+# Returns the groups for the main page and the tooltips, in rank order, from
+# the snapshot written by the last ranking run.  If the instance's copy is for
+# the requested version it's used without going to the datastore at all.
+def snapshot_groups(version=None):
+    global _snapshot
+
+    if version is not None and version == _snapshot[0]:
+        return _snapshot[1]
+
+    snapshot = ctrpmodels.Snapshot.get_current()
+    if snapshot is None:
+        # no run has finished since the snapshots were added.  groups from
+        # before then might not have a rank key yet, so don't sort on it.
+        return ctrpmodels.Group.query_for_singletier_display()
+
+    groups = snapshot.get_groups()
+    _snapshot = (snapshot.version, groups)
+    return groups
+
+# The main page only changes when a ranking run finishes, so the rendered pages
+# are cached in memcache (compressed, since they're large) and in each
+# instance, keyed on the Global last updated time.  The ranker renders all of
+# the pages in one pass over the groups at the end of every run.  A page view
+# that finds the instance's copy is still current only costs the memcache read
+# for the version.
+LEADERBOARD_VERSION_KEY = 'leaderboard-version'
+LEADERBOARD_PAGE_KEY = 'leaderboard-page-%s-%d'
+
+# The number of groups on each page of the main page.
+LEADERBOARD_PAGE_SIZE = 100
+
+# (version, dict of page number to page) for the copies of the main page held
+# by this instance
+_leaderboard = (None, dict())
+
+def display(page=1):
+    global _leaderboard
+
+    page = max(page, 1)
+    version = memcache.get(LEADERBOARD_VERSION_KEY)
+    if version is None:
+        last_updated = ctrpmodels.Global.get_last_updated()
+
+        # if the pages couldn't be stored in memcache, the instance's copy is
+        # still good as long as no run has finished since it was rendered
+        (local_version, local) = _leaderboard
+        if (last_updated is not None and local_version is not None and
+                local_version.rsplit('-', 1)[0] == version_stamp(last_updated)):
+            pages = local
+        else:
+            pages = rebuild_leaderboard(last_updated)
+        if page in pages:
+            return pages[page], 200
+        return render_leaderboard_page(last_updated or datetime.datetime.now(), page), 200
+
+    # don't go past the last page
+    page = min(page, int(version.rsplit('-', 1)[1]))
+
+    (local_version, local) = _leaderboard
+    if version != local_version:
+        local = dict()
+        _leaderboard = (version, local)
+    if page in local:
+        return local[page], 200
+
+    compressed = memcache.get(LEADERBOARD_PAGE_KEY % (version, page))
+    if compressed is not None:
+        html = zlib.decompress(compressed).decode('utf-8')
+    else:
+        # the page got evicted
+        html = render_leaderboard_page(ctrpmodels.Global.get_last_updated(), page)
+        _store_leaderboard(version, {page: html})
+
+    local[page] = html
+    return html, 200
+
+# Renders every page of the main page from the datastore and stores them in
+# the caches.  last_updated is the Global last updated time if the caller
+# already has it.  Returns a dict of page number to page.
+def rebuild_leaderboard(last_updated=None):
+    global _leaderboard
+
     if last_updated is None:
-        last_updated = datetime.datetime.now()
+        last_updated = ctrpmodels.Global.get_last_updated()
 
+    if last_updated is None:
+        # the ranker has never finished a run.  there's nothing to key the
+        # cache on, so don't cache anything.
+        return {1: render_leaderboard_page(datetime.datetime.now(), 1)}
+
+    groups = snapshot_groups(version_stamp(last_updated))
+    pages = dict()
+    for start in xrange(0, max(len(groups), 1), LEADERBOARD_PAGE_SIZE):
+        page = start / LEADERBOARD_PAGE_SIZE + 1
+        pages[page] = render_leaderboard(last_updated, page,
+                                         groups[start:start+LEADERBOARD_PAGE_SIZE],
+                                         start + LEADERBOARD_PAGE_SIZE < len(groups))
+
+    # the number of pages goes in the version so views know where the last
+    # page is
+    version = '%s-%d' % (version_stamp(last_updated), len(pages))
+    if _store_leaderboard(version, pages):
+        memcache.set(LEADERBOARD_VERSION_KEY, version)
+
+    _leaderboard = (version, dict(pages))
+    return pages
+
+# Stores pages of the main page in memcache.  Returns True if they all fit.
+def _store_leaderboard(version, pages):
+    try:
+        failed = memcache.set_multi(dict(
+            (LEADERBOARD_PAGE_KEY % (version, page), zlib.compress(html.encode('utf-8')))
+            for (page, html) in pages.iteritems()))
+    except ValueError:
+        failed = True
+    if failed:
+        logging.warning('Failed to store the main page in memcache, only caching it locally')
+    return not failed
+
+# Renders a single page of the main page.
+def render_leaderboard_page(last_updated, page):
+    groups = snapshot_groups(version_stamp(last_updated))
+    start = (page - 1) * LEADERBOARD_PAGE_SIZE
+    return render_leaderboard(last_updated, page, groups[start:start+LEADERBOARD_PAGE_SIZE],
+                              start + LEADERBOARD_PAGE_SIZE < len(groups))
+
+def render_leaderboard(last_updated, page, groups, more):
     template_values = {
         'last_updated': last_updated,
         'title' : 'Main',
-        'tier': 24
+        'tier': 24,
+        'tooltips_url': tooltips_url(),
     }
-    response = render_template('header.html', **template_values)
-    response += '<table>\n'
+    parts = [render_template('header.html', **template_values), '<table>\n']
 
-    groups = ctrpmodels.Group.query_for_singletier_display()
+    # render_template looks the template up and sets up the context on every
+    # call, so render the rows straight from the template instead
+    row = current_app.jinja_env.get_template('group-raids.html')
     for group in groups:
-        template_values = {'group' : group}
-        response += render_template('group-raids.html', **template_values)
-
-    response += '</table>\n'
-    response += render_template('footer.html')
-    return response, 200
-
-def build_tooltips():
-
-    response = ('$(function() {\n'
-                '  $(document).tooltip({\n'
-                '    items: "[ttid]",\n'
-                '    content: function() {\n'
-                '      var tooltips = {};\n')
-
-    groups = ctrpmodels.Group.query_for_singletier_display()
+        parts.append(row.render(group=group))
+
+    parts.append('</table>\n')
+
+    links = list()
+    if page > 1:
+        links.append('<a href="/?page=%d">Previous</a>' % (page - 1))
+    if more:
+        links.append('<a href="/?page=%d">Next</a>' % (page + 1))
+    if links:
+        parts.append('<p style="text-align:center">%s</p>\n' % ' | '.join(links))
+
+    parts.append(render_template('footer.html'))
+    return u''.join(parts)
+
+# The boss lists shown in the tooltips only change when a ranking run finishes,
+# so the ranker builds them once at the end of each run, for every group, and
+# stores them with a hash of their content.  tooltips.js is just a small loader
+# that fetches a group's tooltips the first time one of them is needed.  Both
+# the loader and the per-group data have the hash in their URLs so browsers can
+# cache them forever, and a new run gets new URLs.
+TOOLTIPS_NAME = 'tooltips.json'
+TOOLTIPS_DIGEST_KEY = 'tooltips-digest'
+TOOLTIPS_NAMESPACE = 'tooltips-%s'
+
+# How long browsers and the edge cache can keep the versioned responses, in
+# seconds.  The unversioned /tooltips.js always has to be revalidated.
+TOOLTIPS_MAX_AGE = 365 * 24 * 60 * 60
+
+# (digest, tooltips) for the copy of the tooltips held by this instance
+_tooltips = (None, None)
+
+# Builds the tooltips for every group, from the snapshot with the given version
+# if there is one.  Returns a dict of the normalized group name to a dict of
+# the tooltip id (without the group name) to its contents.
+def build_tooltips(version=None):
+    tooltips = dict()
+
+    groups = snapshot_groups(version)
     for raidinfo in ctrpmodels.Constants.raids:
         raid = raidinfo[0]
+        raidbosses = getattr(ctrpmodels.Constants, raid+'bosses')
+
         for group in groups:
-            normaltext = ""
-            heroictext = ""
-            mythictext = ""
-            bosses = []
             groupraid = getattr(group, raid)
-            raidbosses = getattr(ctrpmodels.Constants, raid+'bosses')
-
-            for boss in groupraid.bosses:
-                bosses.append((boss.name, boss.normaldead, boss.heroicdead, boss.mythicdead))
-            index_dict = {item: index for index, item in enumerate(raidbosses)}
-            bosses.sort(key=lambda t: index_dict[t[0]])
-
-            for boss in bosses:
-                if boss[1] != None:
-                    normaltext += "<div class='bossdead'>%s</div>" % boss[0]
-                else:
-                    normaltext += "<div class='bossalive'>%s</div>" % boss[0]
-                if boss[2] != None:
-                    heroictext += "<div class='bossdead'>%s</div>" % boss[0]
-                else:
-                    heroictext += "<div class='bossalive'>%s</div>" % boss[0]
-                if boss[3] != None:
-                    mythictext += "<div class='bossdead'>%s</div>" % boss[0]
-                else:
-                    mythictext += "<div class='bossalive'>%s</div>" % boss[0]
-
-            template_values = {
-                'name': group.name,
-                'raid': raid,
-                'normaltext': normaltext,
-                'heroictext': heroictext,
-                'mythictext': mythictext,
-            }
-
-            response += render_template('group-tooltip.js', **template_values)
-
-    response += ('\n'
-                 '      var element = $(this);\n'
-                 '      var ttid = element.attr("ttid");\n'
-                 '      return tooltips[ttid];\n'
-                 '    }});\n'
-                 '});')
 
-    return response
+            entry = tooltips.setdefault(normalize(group.name), dict())
+            for diff in ctrpmodels.Constants.difficulties:
+                divs = list()
+                for (i, boss) in enumerate(raidbosses):
+                    if groupraid.killed(i, diff):
+                        divs.append("<div class='bossdead'>%s</div>" % boss)
+                    else:
+                        divs.append("<div class='bossalive'>%s</div>" % boss)
+                entry['%s-%s-header' % (raid, diff)] = ''.join(divs)
+
+    return tooltips
+
+# Builds the tooltips and stores them for the rest of the instances.  Returns
+# the new digest.
+def rebuild_tooltips(version=None):
+    global _tooltips
+
+    tooltips = build_tooltips(version)
+    content = json.dumps(tooltips, sort_keys=True, separators=(',', ':'))
+    digest = hashlib.sha1(content).hexdigest()[:16]
+    ctrpmodels.Artifact(id=TOOLTIPS_NAME, content=content, digest=digest).put()
+    _store_tooltips(digest, tooltips)
+
+    _tooltips = (digest, tooltips)
+    return digest
+
+# Caches each group's tooltips in memcache on its own, since the endpoint only
+# ever needs one group's.
+def _store_tooltips(digest, tooltips):
+    entries = dict((name, json.dumps(entry, sort_keys=True, separators=(',', ':')))
+                   for (name, entry) in tooltips.iteritems())
+    memcache.set_multi(entries, namespace=TOOLTIPS_NAMESPACE % digest)
+    memcache.set(TOOLTIPS_DIGEST_KEY, digest)
+
+# Returns (digest, tooltips) for the current tooltips, from the instance's copy
+# if it's current, otherwise from the datastore.  Returns (None, {}) if they
+# haven't been built yet.  They're only built at the end of a ranking run and
+# by /migrate, never while a page is being served.
+def _load_tooltips(digest=None):
+    global _tooltips
+
+    if digest is not None and digest == _tooltips[0]:
+        return _tooltips
+
+    artifact = ctrpmodels.Artifact.get_by_id(TOOLTIPS_NAME)
+    if artifact is None:
+        logging.info('Tooltips have not been built yet')
+        return (None, dict())
+
+    tooltips = json.loads(artifact.content)
+    _store_tooltips(artifact.digest, tooltips)
+    _tooltips = (artifact.digest, tooltips)
+    return _tooltips
+
+def tooltips_digest():
+    digest = memcache.get(TOOLTIPS_DIGEST_KEY)
+    if digest is None:
+        digest = _load_tooltips()[0]
+    return digest
+
+# Returns the URL of the tooltip loader script, or None if there are no
+# tooltips yet.
+def tooltips_url():
+    digest = tooltips_digest()
+    if digest is None:
+        return None
+    return '/tooltips-%s.js' % digest
+
+# Sets the caching headers for a tooltip response.  Responses from a versioned
+# URL can be cached indefinitely as long as it's the current version, while
+# pages cached with an old version get current data, but only for a while.
+def _tooltip_response(response, current, digest, request):
+    response.set_etag(current)
+    if digest == current:
+        response.cache_control.public = True
+        response.cache_control.max_age = TOOLTIPS_MAX_AGE
+    elif digest is not None:
+        response.cache_control.public = True
+        response.cache_control.max_age = 300
+    else:
+        response.cache_control.no_cache = True
+
+    return response.make_conditional(request)
+
+# Serves the tooltip loader script.
+def serve_tooltips(request, digest=None):
+    current = tooltips_digest()
+    if current is None:
+        return '', 404
+    script = render_template('tooltips.js', digest=current)
+    response = Response(script, content_type='application/javascript')
+    return _tooltip_response(response, current, digest, request)
+
+# Serves the tooltips for one group, as JSON.  name is the normalized group
+# name, the same as the start of the tooltip ids on the page.
+def serve_group_tooltips(request, digest, name):
+    current = tooltips_digest()
+    if current is None:
+        return '', 404
+    content = memcache.get(name, namespace=TOOLTIPS_NAMESPACE % current)
+    if content is None:
+        (current, tooltips) = _load_tooltips(current)
+        if name not in tooltips:
+            return '', 404
+        content = json.dumps(tooltips[name], sort_keys=True, separators=(',', ':'))
+
+    response = Response(content, content_type='application/json')
+    return _tooltip_response(response, current, digest, request)
 
 def display_history(request):
-    group = request.form.get('group', '')
+    group = request.values.get('group', '')
     if group:
-        return display_group_history(group)
+        return display_group_history(group, request.values.get('cursor'))
 
     return display_full_history()
 
+# The full history page shows this many days, ending with today.  Each day's
+# block of the page is rendered once and cached in memcache and in the
+# instance.  Days before today can't get any new entries, so their blocks are
+# kept for good, while today's block is keyed on the Global last updated time
+# and rebuilt by the ranker at the end of each run.
+HISTORY_DAYS = 13
+HISTORY_DAY_KEY = 'history-day-%s'
+HISTORY_TODAY_KEY = 'history-day-%s-%s'
+
+# rendered day blocks held by this instance, keyed the same as in memcache
+_history_days = dict()
+
 def display_full_history():
+    global _history_days
+
     last_updated = ctrpmodels.Global.get_last_updated()
     if last_updated is None:
         last_updated = datetime.datetime.now()
@@ -108,52 +370,97 @@ def display_full_history():
     # add the beginnings of the table
     response += '<table style="margin-left:50px;margin-right:50px">\n'
 
-    # request all of the history entries, sorted in reverse order by date
-    curdate = datetime.date.today()
-    oneday = datetime.timedelta(1)
+    # the days to show, most recent first
+    today = datetime.date.today()
+    days = [today - datetime.timedelta(i) for i in xrange(HISTORY_DAYS)]
+    keys = dict((day, history_day_key(day, today, last_updated)) for day in days)
+
+    local = _history_days
+    blocks = dict((day, local[keys[day]]) for day in days if keys[day] in local)
+    missing = [day for day in days if day not in blocks]
+    if missing:
+        cached = memcache.get_multi([keys[day] for day in missing])
+        for day in missing:
+            if keys[day] in cached:
+                blocks[day] = cached[keys[day]]
+        missing = [day for day in missing if day not in blocks]
+    if missing:
+        blocks.update(build_history_days(missing, today, last_updated))
+
+    # only hang on to the blocks for the days that are still on the page
+    _history_days = dict((keys[day], blocks[day]) for day in days)
+
+    response += u''.join(blocks[day] for day in days)
+    response += '</table>\n'
+    response += render_template('footer.html')
+
+    return response, 200
+
+def history_day_key(day, today, last_updated):
+    if day < today:
+        return HISTORY_DAY_KEY % day.isoformat()
+    return HISTORY_TODAY_KEY % (day.isoformat(), version_stamp(last_updated))
+
+# Renders the history blocks for a list of days, loading the entries for all of
+# them in one query, and caches the results.  Returns a dict of day to block.
+def build_history_days(days, today, last_updated):
+    entries = dict((day, list()) for day in days)
+    for update in ctrpmodels.History.get_since(min(days)):
+        if update.date in entries:
+            entries[update.date].append(update)
 
-    for i in xrange(0, 13):
-        response += '<tr><td colspan="2" class="history-date">%s</td></tr>\n' % curdate
+    row = current_app.jinja_env.get_template('history.html')
+    num_aep_bosses = len(ctrpmodels.Constants.aepbosses)
 
-        # Retrieve all of the entires for this date ordered by group name
-        updates = ctrpmodels.History.get_for_date(curdate)
+    blocks = dict()
+    for day in days:
+        parts = ['<tr><td colspan="2" class="history-date">%s</td></tr>\n' % day]
+
+        updates = entries[day]
         if not updates:
             # if there were no results for this date, add just a simple
             # entry displaying nothing
-            response += '<tr>'
-            response += '<td colspan="2" style="text-align:center">'
-            if i == 0:
+            parts.append('<tr>')
+            parts.append('<td colspan="2" style="text-align:center">')
+            if day == today:
                 current = datetime.datetime.now()
                 if current > last_updated:
-                    response += 'Data not parsed for today yet'
+                    parts.append('Data not parsed for today yet')
                 else:
-                    response += 'No new kills for this date!'
+                    parts.append('No new kills for this date!')
             else:
-                response += 'No new kills for this date!'
-            response += '</td>'
-            response += '</tr>\n'
+                parts.append('No new kills for this date!')
+            parts.append('</td>')
+            parts.append('</tr>\n')
 
         else:
 
             # now loop through the groups and output the updates in some
             # fashion
             for update in updates:
+                parts.append(row.render(history=update, num_aep_bosses=num_aep_bosses))
+                parts.append('\n')
 
-                template_values = {
-                    'history': update,
-                    'num_aep_bosses': len(ctrpmodels.Constants.aepbosses)
-                }
-                response += render_template('history.html', **template_values)
-                response += '\n'
+        blocks[day] = u''.join(parts)
 
-        curdate -= oneday
+    memcache.set_multi(dict((history_day_key(day, today, last_updated), block)
+                            for (day, block) in blocks.iteritems()))
+    return blocks
 
-    response += '</table>\n'
-    response += render_template('footer.html')
+# Rebuilds today's history block after a ranking run, so that the first view
+# of the history page after the run doesn't have to.
+def rebuild_history_today(last_updated):
+    global _history_days
 
-    return response, 200
+    today = datetime.date.today()
+    block = build_history_days([today], today, last_updated)[today]
+    local = dict(_history_days)
+    local[history_day_key(today, today, last_updated)] = block
+    _history_days = local
 
-def display_group_history(group_name):
+# Shows a page of the history for a group.  The first page comes from the
+# group's timeline, and the pages after it from a query starting at the cursor.
+def display_group_history(group_name, cursor=None):
     last_updated = ctrpmodels.Global.get_last_updated()
     if last_updated is None:
         last_updated = datetime.datetime.now()
@@ -164,26 +471,49 @@ def display_group_history(group_name):
     }
     response = render_template('header.html', **template_values)
 
-    # Record all history for this group that has been recorded sorted by the
-    # date
-    entries = ctrpmodels.History.get_for_group(group_name)
+    # Record the history for this group that has been recorded sorted by the
+    # date, one page at a time
+    page_size = ctrpmodels.Timeline.PAGE_SIZE
+    entries = None
+    if cursor:
+        try:
+            (entries, next_cursor, more) = ctrpmodels.History.get_page(group_name, page_size, cursor)
+        except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+            # the cursor was mangled or made up.  show the first page instead.
+            logging.info('Ignoring a bad history cursor for group %s', group_name)
+
+    if entries is None:
+        timeline = ctrpmodels.Timeline.get_for_group(group_name)
+        entries = timeline.entries
+        more = timeline.more
+        next_cursor = timeline.cursor
+        if more and next_cursor is None:
+            # the entries changed since the cursor for the next page was last
+            # found.  find it again and save it for the next view.
+            (_, next_cursor, more) = ctrpmodels.History.get_page(group_name, page_size,
+                                                                 keys_only=True)
+            timeline.cursor = next_cursor
+            timeline.more = more
+            timeline.put()
 
     if not entries:
-        response += 'No history recorded for group %s' % group_name
+        response += 'No history recorded for group %s' % cgi.escape(group_name)
     else:
-        response += '<div class="history-date">%s</div><p/>' % group_name
+        response += '<div class="history-date">%s</div><p/>' % cgi.escape(group_name)
         response += '<table style="margin-left:50px;11margin-right:50px">\n'
 
+        row = current_app.jinja_env.get_template('group-history.html')
+        num_aep_bosses = len(ctrpmodels.Constants.aepbosses)
         for entry in entries:
-            template_values = {
-                'history': entry,
-                'num_aep_bosses': len(ctrpmodels.Constants.aepbosses)
-            }
-            response += render_template('group-history.html', **template_values)
+            response += row.render(history=entry, num_aep_bosses=num_aep_bosses)
             response += '\n'
 
         response += '</table>\n'
 
+        if more:
+            query = urllib.urlencode({'group': group_name.encode('utf-8'), 'cursor': next_cursor})
+            response += '<p style="text-align:center"><a href="/history?%s">Older entries</a></p>\n' % cgi.escape(query, True)
+
     response += render_template('footer.html')
     return response, 200
 
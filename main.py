@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python
 
-from flask import Flask, request, Response
+from flask import Flask, request
 from werkzeug.routing import BaseConverter
 
 import ctrpmodels
 import display
+import profiler
 import ranker
 import rostermgmt
 
@@ -21,8 +22,9 @@ app.url_map.converters['regex'] = RegexConverter
 app.jinja_env.filters['normalize'] = display.normalize
 
 @app.route('/')
+@profiler.profiled('main')
 def root():
-    return display.display()
+    return display.display(request.args.get('page', 1, type=int))
 
 @app.route('/history')
 def history():
@@ -36,32 +38,66 @@ def load_groups():
 def rank():
     if request.method == 'GET':
         return ranker.rank()
-    return ranker.start_ranking()
+    return ranker.start_ranking(full=request.form.get('full') == '1')
 
 # This is used by the cron job to start ranking automatically. We call the ranker
 # but we don't care about the redirect that it responds with. Instead just return
 # a 200 so the cron job doesn't fail.
 @app.route('/startrank')
 def startrank():
-    ranker.start_ranking()
+    ranker.start_ranking(full=request.args.get('full') == '1')
     return '', 200
 
+@app.route('/metrics')
+def metrics():
+    return ranker.show_metrics(request)
+
 @app.route('/builder', methods=['POST'])
+@profiler.profiled('builder', armable=True)
 def builder():
     return ranker.run_builder(request)
 
+@app.route('/fetcher', methods=['POST'])
+def fetcher():
+    return ranker.run_fetcher(request)
+
 @app.route('/migrate')
 def migrate():
-    return ctrpmodels.migrate()
+    (last_updated, message) = ctrpmodels.migrate()
+    display.rebuild_all(last_updated)
+    return message, 200
 
 @app.route('/<regex("tier(\d+)"):tier>')
 def display_tier(tier):
     return display.display_tier(tier)
 
 @app.route('/tooltips.js')
+@profiler.profiled('tooltips')
 def tooltips():
-    return Response(display.build_tooltips(), content_type='application/javascript')
+    return display.serve_tooltips(request)
+
+@app.route('/tooltips-<regex("[0-9a-f]+"):digest>.js')
+@profiler.profiled('tooltips')
+def versioned_tooltips(digest):
+    return display.serve_tooltips(request, digest)
+
+@app.route('/tooltips/<regex("[0-9a-f]+"):digest>/<path:name>.json')
+def group_tooltips(digest, name):
+    return display.serve_group_tooltips(request, digest, name)
 
 @app.route('/loadone')
+@profiler.profiled('loadone')
 def load_one():
     return ranker.loadone(request)
+
+@app.route('/profiles/arm', methods=['POST'])
+def arm_profiler():
+    return profiler.arm_from_form(request.form)
+
+@app.route('/profiles/<int:profile_id>')
+def show_profile(profile_id):
+    return profiler.show_profile(profile_id)
+
+@app.route('/profiles/<int:profile_id>.folded')
+def profile_stacks(profile_id):
+    return profiler.serve_stacks(profile_id)
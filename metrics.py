@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Timing spans for the ranking pipeline.  Code wraps the steps it wants timed
+# in a span, which records how long the step took and whether it failed into a
+# small histogram kept in memory for the ranking run the thread is recording
+# for.  Each task records inside a recording block for its run, which flushes
+# what the task recorded into counters in memcache for the run at the end,
+# with a single call, and the /metrics page adds those counters up into
+# counts, error rates and percentiles for each span.  Spans recorded outside
+# of a run (like /loadone building a group) are thrown away.
+#
+# Recording a span is a couple of clock reads and a few integer adds under a
+# lock, so it stays on all the time.  The percentiles come from fixed buckets
+# and are only as fine as the buckets are.
+
+import bisect
+import threading
+import time
+
+from google.appengine.api import memcache
+
+# The upper bounds of the histogram buckets, in milliseconds.  Anything slower
+# than the last one goes in an overflow bucket.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+# The counters kept for each span.  total_us is the total time in
+# microseconds, and b0 through bN are the counts for each bucket.
+FIELDS = ['count', 'errors', 'total_us'] + ['b%d' % i for i in xrange(len(BUCKETS) + 1)]
+
+# The spans that are recorded, in the order they're shown on the metrics page.
+SPANS = [
+    ('oauth', 'OAuth token request'),
+    ('fetch', 'Character request (each attempt)'),
+    ('parse', 'Character response parse'),
+    ('toons.write', 'Toon cache datastore write'),
+    ('progress', 'Progress and ilvl calculation'),
+    ('timeline.read', 'Timeline lookup'),
+    ('group.write', 'Group, history and timeline datastore write'),
+    ('task.fetch', 'Fetcher task'),
+    ('task.build', 'Builder task'),
+    ('finish', 'Finish building'),
+]
+
+PERCENTILES = (50, 95, 99)
+
+_lock = threading.Lock()
+
+# the spans recorded and not flushed yet, keyed on the run and the span name
+_pending = dict()
+
+# the run that the current thread is recording spans for
+_local = threading.local()
+
+# Sets the run that the spans recorded by the current thread belong to, or
+# None to stop recording.  Code that hands work to other threads passes the
+# run along with this, like the importer's threadpool does.
+def set_run(run_id):
+    _local.run_id = str(run_id) if run_id else None
+
+def current_run():
+    return getattr(_local, 'run_id', None)
+
+# Records the spans from the current thread for a run until the block ends,
+# then flushes everything recorded for the run.
+class recording(object):
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+
+    def __enter__(self):
+        set_run(self.run_id)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        set_run(None)
+        flush(self.run_id)
+        return False
+
+class span(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.failed = False
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.name, time.time() - self.start, self.failed or exc_type is not None)
+        return False
+
+    # Marks the span as failed even though nothing was raised, for steps that
+    # report failures by returning them.
+    def fail(self):
+        self.failed = True
+
+def record(name, seconds, failed=False):
+    run_id = current_run()
+    if run_id is None:
+        return
+
+    bucket = bisect.bisect_left(BUCKETS, seconds * 1000.0)
+    with _lock:
+        stats = _pending.get((run_id, name))
+        if stats is None:
+            stats = _pending[(run_id, name)] = [0] * len(FIELDS)
+        stats[0] += 1
+        if failed:
+            stats[1] += 1
+        stats[2] += int(seconds * 1000000)
+        stats[3 + bucket] += 1
+
+# Adds everything recorded for a ranking run since the last flush to the
+# counters for the run.
+def flush(run_id):
+    if not run_id:
+        return
+
+    run_id = str(run_id)
+    with _lock:
+        pending = dict((name, _pending.pop((run, name)))
+                       for (run, name) in _pending.keys() if run == run_id)
+
+    if not pending:
+        return
+
+    deltas = dict()
+    for (name, stats) in pending.iteritems():
+        for (field, value) in zip(FIELDS, stats):
+            if value:
+                deltas['%s:%s' % (name, field)] = value
+    memcache.offset_multi(deltas, namespace=_namespace(run_id), initial_value=0)
+
+def _namespace(run_id):
+    return 'metrics-%s' % run_id
+
+def _percentile(buckets, count, pct):
+    target = count * pct / 100.0
+    seen = 0
+    for (i, value) in enumerate(buckets):
+        seen += value
+        if seen >= target:
+            if i < len(BUCKETS):
+                return '%d ms' % BUCKETS[i]
+            return '> %d ms' % BUCKETS[-1]
+    return '-'
+
+# Returns the summary of each span recorded for a ranking run, in the order
+# they're listed in SPANS.  Spans that weren't recorded at all are left out.
+def get_run_metrics(run_id):
+    keys = ['%s:%s' % (name, field) for (name, _) in SPANS for field in FIELDS]
+    values = memcache.get_multi(keys, namespace=_namespace(run_id))
+
+    results = list()
+    for (name, label) in SPANS:
+        stats = [int(values.get('%s:%s' % (name, field), 0)) for field in FIELDS]
+        (count, errors, total_us) = stats[:3]
+        if not count:
+            continue
+
+        summary = {
+            'name': name,
+            'label': label,
+            'count': count,
+            'errors': errors,
+            'error_rate': float(errors) / count,
+            'mean_ms': total_us / 1000.0 / count,
+        }
+        for pct in PERCENTILES:
+            summary['p%d' % pct] = _percentile(stats[3:], count, pct)
+        results.append(summary)
+    return results
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Opt-in profiling for individual requests.  A view wrapped with profiled()
+# runs under a profiler when the request asks for it with an X-Profile header
+# or a profile query argument (from an admin or from the task queue), or, for
+# views that can be armed, when an admin has armed profiling for the next few
+# requests from the ranker page.  The builder tasks can't carry a header, so
+# arming is how those get profiled.
+#
+# There are two kinds of profile.  'sample' (the default) has a thread look at
+# the request's stack every few milliseconds, which is cheap enough to leave
+# the timings close to normal and gives whole stacks for a flame graph.
+# 'cprofile' runs the request under cProfile, which counts every call exactly
+# but slows the request down and doesn't keep stacks.  The hottest functions,
+# and the stacks for a sampled profile, are stored in a ctrpmodels.Profile.
+
+import cProfile
+import collections
+import functools
+import logging
+import os
+import pstats
+import sys
+import thread
+import threading
+import time
+
+from flask import Response, abort, redirect, render_template, request
+from google.appengine.api import memcache
+from google.appengine.api import users
+
+from ctrpmodels import Profile
+
+MODES = ('sample', 'cprofile')
+
+# How often the sampler looks at the request's stack, in seconds.
+SAMPLE_INTERVAL = 0.005
+
+# The number of functions kept in a profile's list of the hottest ones, and
+# the number of distinct stacks kept for the flame graph.
+TOP_FUNCTIONS = 25
+MAX_STACKS = 5000
+
+# memcache key for the number of armed requests left, per endpoint.
+ARMED_KEY = 'profile-armed-%s'
+
+# Profiles the next count requests to an endpoint that can be armed.
+def arm(endpoint, count):
+    memcache.set(ARMED_KEY % endpoint, count)
+
+def armed_count(endpoint):
+    return int(memcache.get(ARMED_KEY % endpoint) or 0)
+
+# Returns the kind of profile the current request wants, or None.
+def _requested_mode(endpoint, armable):
+    mode = request.headers.get('X-Profile') or request.args.get('profile')
+    if mode:
+        # the task queue strips this header from requests that come from
+        # anywhere else, so it can be trusted
+        if 'X-AppEngine-QueueName' in request.headers or users.is_current_user_admin():
+            return mode if mode in MODES else MODES[0]
+        return None
+
+    if armable and armed_count(endpoint) > 0:
+        if memcache.decr(ARMED_KEY % endpoint) is not None:
+            return MODES[0]
+    return None
+
+# Wraps a view so that it can be profiled.  This goes below the route
+# decorator so that the profile covers the view and nothing else.
+def profiled(endpoint, armable=False):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            mode = _requested_mode(endpoint, armable)
+            if mode is None:
+                return view(*args, **kwargs)
+            return _run_profiled(endpoint, mode, view, args, kwargs)
+        return wrapper
+    return decorator
+
+def _run_profiled(endpoint, mode, view, args, kwargs):
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+    else:
+        profiler = Sampler(sys._getframe().f_code)
+
+    start = time.time()
+    profiler.enable()
+    try:
+        return view(*args, **kwargs)
+    finally:
+        profiler.disable()
+        duration = time.time() - start
+        try:
+            _store(endpoint, mode, profiler, duration)
+        except Exception:
+            # losing a profile shouldn't fail the request that was profiled
+            logging.exception('Failed to store the profile for %s', request.path)
+
+def _store(endpoint, mode, profiler, duration):
+    profile = Profile(endpoint=endpoint, path=request.full_path, mode=mode, duration=duration)
+    if mode == 'cprofile':
+        profile.top = _cprofile_top(profiler)
+    else:
+        profile.samples = profiler.total
+        profile.top = profiler.top()
+        profile.stacks = profiler.collapsed()
+    profile.put()
+    logging.info('Profiled %s in %f seconds as profile %s', request.path, duration, profile.key.id())
+
+def _function_name(filename, line, name):
+    return '%s:%d(%s)' % (os.path.basename(filename), line, name)
+
+def _cprofile_top(profiler):
+    stats = pstats.Stats(profiler)
+    rows = list()
+    for ((filename, line, name), (_, calls, self_time, total_time, _)) in stats.stats.iteritems():
+        rows.append({'function': _function_name(filename, line, name), 'calls': calls,
+                     'self_ms': self_time * 1000.0, 'total_ms': total_time * 1000.0})
+    rows.sort(key=lambda row: row['total_ms'], reverse=True)
+    return rows[:TOP_FUNCTIONS]
+
+# Samples the stack of the thread that creates it from a second thread until
+# it's disabled.  Frames above root_code (the profiler's own and the web
+# framework's) are left out of the stacks.
+class Sampler(object):
+
+    def __init__(self, root_code, interval=SAMPLE_INTERVAL):
+        self.root_code = root_code
+        self.interval = interval
+        self.thread_id = thread.get_ident()
+        self.stacks = collections.Counter()
+        self.total = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def enable(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def disable(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+
+            stack = list()
+            while frame is not None and frame.f_code is not self.root_code:
+                code = frame.f_code
+                stack.append(_function_name(code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            stack.reverse()
+
+            self.stacks[tuple(stack)] += 1
+            self.total += 1
+
+    # The functions that showed up in the most samples, with the time they
+    # were running themselves and the time they were anywhere on the stack.
+    def top(self):
+        own = collections.Counter()
+        anywhere = collections.Counter()
+        for (stack, count) in self.stacks.iteritems():
+            if stack:
+                own[stack[-1]] += count
+            for function in set(stack):
+                anywhere[function] += count
+
+        interval_ms = self.interval * 1000.0
+        rows = [{'function': function, 'calls': None, 'self_ms': own[function] * interval_ms,
+                 'total_ms': count * interval_ms}
+                for (function, count) in anywhere.most_common(TOP_FUNCTIONS)]
+        return rows
+
+    # The samples in the collapsed stack format, one line per distinct stack
+    # with the frames separated by semicolons and the number of samples at
+    # the end.
+    def collapsed(self):
+        lines = ['%s %d' % (';'.join(stack), count)
+                 for (stack, count) in self.stacks.most_common(MAX_STACKS) if stack]
+        return '\n'.join(lines)
+
+# Handles the form on the ranker page that arms profiling for the next few
+# builder tasks.
+def arm_from_form(form):
+    count = max(0, min(form.get('count', 0, type=int), 100))
+    arm('builder', count)
+    return redirect('/rank')
+
+def show_profile(profile_id):
+    profile = Profile.get_by_id(profile_id)
+    if profile is None:
+        abort(404)
+    return render_template('profile.html', profile=profile)
+
+def serve_stacks(profile_id):
+    profile = Profile.get_by_id(profile_id)
+    if profile is None or not profile.stacks:
+        abort(404)
+    return Response(profile.stacks, mimetype='text/plain')
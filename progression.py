@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Kill detection for the ranker.  Toon data returned from the Blizzard API is
+# folded into a fixed grid of timestamp counters (one slot per boss and
+# difficulty), and a boss counts as killed by a group once enough toons share
+# the same kill timestamp for it.
+
+import collections
+import datetime
+import logging
+
+import ctrpmodels
+from ctrpmodels import Constants
+
+# The number of toons from a group that must share a kill timestamp before the
+# kill is credited to the group.
+KILL_THRESHOLD = 8
+
+class KillTally(object):
+
+    def __init__(self, bosses, raidname):
+        self.bosses = bosses
+        self.raidname = raidname
+        self.toons = 0
+
+        # map boss names to their position in the grid so that each toon's
+        # boss list only needs to be walked once.
+        self.index = dict((boss, i) for i, boss in enumerate(bosses))
+        self.counts = [[collections.Counter() for _ in Constants.difficulties]
+                       for _ in bosses]
+
+    # Fold the progression data for a single toon into the counters.  Toons
+    # that we didn't get data back for are ignored.
+    def add(self, toon):
+
+        if 'progression' not in toon:
+            return
+
+        raid = None
+        for r in toon['progression']['raids']:
+            if r['name'] == self.raidname:
+                raid = r
+                break
+
+        if raid is None:
+            logging.error('Failed to find raid %s in toon progression data', self.raidname)
+            return
+
+        self.toons += 1
+
+        # only the first entry for each boss is counted, in case the API ever
+        # sends back duplicates.
+        seen = [False] * len(self.bosses)
+        for entry in raid['bosses']:
+            i = self.index.get(entry['name'])
+            if i is None or seen[i]:
+                continue
+            seen[i] = True
+
+            # skip any timestamps of zero.  that means the toon never killed
+            # the boss on that difficulty.
+            slot = self.counts[i]
+            for d, diff in enumerate(Constants.difficulties):
+                stamp = entry[diff+'Timestamp']
+                if stamp != 0:
+                    slot[d][stamp] += 1
+
+        for i, found in enumerate(seen):
+            if not found:
+                logging.error('Failed to find boss %s in toon progression data', self.bosses[i])
+
+    # Alias so that a tally can be handed to anything that expects to append
+    # toon data to a list.
+    append = add
+
+    # Returns the most recent timestamp shared by enough toons to count as a
+    # kill for the boss at the given position, or None if there isn't one.
+    def kill_time(self, boss_index, diff_index):
+        valid = [stamp for stamp, count in self.counts[boss_index][diff_index].iteritems()
+                 if count >= KILL_THRESHOLD]
+        if valid:
+            return max(valid)
+        return None
+
+    # Builds the list of Boss objects for the raid, in the same order as the
+    # boss list the tally was created with.
+    def results(self):
+        today = datetime.date.today()
+        results = list()
+        for i, boss in enumerate(self.bosses):
+            bossobj = ctrpmodels.Boss(name=boss)
+            for d, diff in enumerate(Constants.difficulties):
+                stamp = self.kill_time(i, d)
+                if stamp is not None:
+                    logging.info('*** found valid kill for %s %s at %d', diff, boss, stamp)
+                    setattr(bossobj, diff+'dead', today)
+            results.append(bossobj)
+        return results
+
+# Scores the toon data for many groups in one call.  groupdata is a dict of
+# group name to the list of toon data for that group, and the return value is
+# a dict of group name to the list of Boss objects for the raid.
+def score_groups(bosses, raidname, groupdata):
+    scores = dict()
+    for name, toondata in groupdata.iteritems():
+        tally = KillTally(bosses, raidname)
+        for toon in toondata:
+            tally.add(toon)
+        scores[name] = tally.results()
+    return scores
+
+# Folds all of the toon data for a group as it arrives: the kill tallies for
+# each of the raids in the tier and a running total for the group's average
+# item level.  Once a toon has been added the tally doesn't hold on to any of
+# its data, so the importer can stream results into it and throw each response
+# away as soon as it's been counted.
+class GroupTally(object):
+
+    # only max level toons count towards the group's item level
+    MAX_LEVEL = 120
+
+    def __init__(self):
+        self.raids = dict()
+        for raid in Constants.raids:
+            self.raids[raid[1]] = KillTally(raid[2], raid[1])
+
+        self.ilvl_total = 0
+        self.ilvl_toons = 0
+
+        # the newest lastModified time of any of the toons, and the number of
+        # toons that came back with current data (not an error, and not a
+        # stale cached copy standing in for a failed request)
+        self.last_modified = 0
+        self.loaded = 0
+
+    def add(self, toon):
+        for tally in self.raids.itervalues():
+            tally.add(toon)
+
+        self.last_modified = max(self.last_modified, toon.get('lastModified', 0))
+        if toon.get('status', 'ok') != 'nok' and not toon.get('stale', False):
+            self.loaded += 1
+
+        # ignore toons that we didn't get data back for or for toons less
+        # than max level
+        if 'items' in toon and toon.get('level') == self.MAX_LEVEL:
+            self.ilvl_toons += 1
+            self.ilvl_total += toon['items']['averageItemLevelEquipped']
+
+    append = add
+
+    def average_ilvl(self):
+        if self.ilvl_toons == 0:
+            return 0
+        return self.ilvl_total / self.ilvl_toons
+
+    # Returns the Boss objects for each raid, keyed by raid name.
+    def progress(self):
+        return dict((name, tally.results()) for (name, tally) in self.raids.iteritems())
@@ -4,12 +4,12 @@
 # External imports
 import os
 import datetime
+import hashlib
 import json
-import time
 import logging
 import twitter
 
-from flask import render_template, redirect
+from flask import render_template, redirect, jsonify
 
 # Imports from google
 from google.appengine.api import taskqueue
@@ -17,64 +17,280 @@ from google.appengine.api.taskqueue import Queue
 from google.appengine.api.taskqueue import Task
 
 # Internal imports
+import barrier
+import display
+import metrics
+import profiler
+import progression
+import rostermgmt
+import scheduler
+import writebatch
 import wowapi
 from ctrpmodels import Constants
 from ctrpmodels import Group
 import ctrpmodels
 
+# The number of toons loaded by each task in the fetch stage of a ranking run.
+FETCH_BATCH_SIZE = 50
+
+# The number of times a failing task is retried, which has to match the
+# task_retry_limit for the default queue in queue.yaml.  A task that fails on
+# its last try still arrives at its stage's barrier so that the run finishes.
+TASK_RETRY_LIMIT = 3
+
+# How often the sweeper checks on a ranking run, in seconds.
+SWEEP_INTERVAL = 300
+
+# The number of sweeps in a row that have to find the default queue empty
+# before the sweeper gives up on the tasks that never arrived, and how long a
+# run can go before the sweeper finishes it with whatever it has and stops.
+IDLE_SWEEPS = 2
+MAX_RUN_TIME = datetime.timedelta(hours=24)
+
+# Incremental runs leave out groups that haven't killed anything in the last
+# ACTIVE_DAYS days and haven't changed since they were last built.  A group
+# that starts killing again is picked up by the next full run, and a run is
+# made full if there hasn't been a full one in FULL_RUN_INTERVAL.
+ACTIVE_DAYS = 7
+FULL_RUN_INTERVAL = datetime.timedelta(days=1)
+
+# A ranking run happens in two stages.  The fetch stage loads every distinct
+# toon into the run's toon store, and then the build stage builds the progress
+# for each of the groups.  Each task arrives at the barrier for its stage when
+# it's done, and the last one in starts the next stage (or finishes the run).
+# A sweeper task checks on the run every so often in case the barrier's
+# counter was lost, or a task died without arriving.
+
 def run_builder(request):
     groupname = request.form.get('group')
+    run_id = request.form.get('run')
+    incremental = request.form.get('incremental') == '1'
     if groupname == 'ctrp-taskcheck':
+        with metrics.recording(run_id):
+            sweep_run(run_id, request.form.get('idle', 0, type=int))
+        return '', 200
+
+    with metrics.recording(run_id):
+        try:
+            with metrics.span('task.build'):
+                response = build_group(groupname, run_id, incremental)
+        except Exception:
+            if not is_final_try(request):
+                raise
+            logging.exception('Builder task for %s failed for the last time', groupname)
+            arrive(run_id, 'build', groupname, failed=True)
+            return '', 200
+
+        arrive(run_id, 'build', groupname, failed=(response[1] != 200))
+        return response
+
+def build_group(groupname, run_id, incremental=False):
+    group = Group.get_group_by_name(groupname)
 
-        # Grab the default queue and keep checking for whether or not
-        # all of the tasks have finished.
-        default_queue = Queue()
-        stats = default_queue.fetch_statistics()
-        while stats.tasks > 0:
-            logging.info("task check: waiting for %d tasks to finish", stats.tasks)
-            time.sleep(5)
-            stats = default_queue.fetch_statistics()
-
-        finish_building()
-        response = ''
-
-    else:
-
-        group = Group.get_group_by_name(groupname)
+    # sanity check, tho this shouldn't be possible
+    if not group:
+        logging.info('Builder failed to find group %s', groupname)
+        return '', 404
 
-        # sanity check, tho this shouldn't be possible
-        if not group:
-            logging.info('Builder failed to find group %s', groupname)
-            return '', 404
+    store = None
+    if run_id:
+        store = wowapi.ToonStore(run_id)
 
-        logging.info('Builder task for %s started', groupname)
-        importer = wowapi.Importer()
-        response = process_group(group, importer, True)
-        logging.info('Builder task for %s completed', groupname)
+    logging.info('Builder task for %s started', groupname)
+    importer = wowapi.Importer()
+    response = process_group(group, importer, True, store, incremental)
+    logging.info('Builder task for %s completed', groupname)
 
     return response, 200
 
-def process_group(group, importer, write_to_db):
-    logging.info('Starting work on group %s', group.name)
-
-    data = list()
-    importer.load(group.toons, data)
-
-    progress = dict()
-    parse(Constants.aepbosses, data, Constants.aepname, progress)
+def run_fetcher(request):
+    run_id = request.form.get('run')
+    batch = request.form.get('batch')
+    toons = json.loads(request.form.get('toons', '[]'))
+
+    with metrics.recording(run_id):
+        try:
+            with metrics.span('task.fetch'):
+                logging.info('Fetcher task for run %s started with %d toons', run_id, len(toons))
+                importer = wowapi.Importer()
+                loaded = importer.prefetch(toons, wowapi.ToonStore(run_id))
+                logging.info('Fetcher task for run %s loaded %d of %d toons', run_id, loaded, len(toons))
+        except Exception:
+            if not is_final_try(request):
+                raise
+            # the builders will fetch whatever toons this missed themselves
+            logging.exception('Fetcher task %s for run %s failed for the last time', batch, run_id)
+            arrive(run_id, 'fetch', batch, failed=True)
+            return '', 200
+
+        arrive(run_id, 'fetch', batch)
+        return '', 200
+
+def is_final_try(request):
+    return int(request.headers.get('X-AppEngine-TaskRetryCount', 0)) >= TASK_RETRY_LIMIT
+
+# Records that a task in a stage of a run is done, and moves the run on to the
+# next stage if it was the last one.
+def arrive(run_id, stage, member, failed=False):
+    if not run_id:
+        return
+    if barrier.Barrier(run_id, stage).arrive(member, failed):
+        advance_run(run_id, stage)
+
+def advance_run(run_id, stage):
+    if not ctrpmodels.RankingRun.complete_stage(run_id, stage):
+        return
+
+    logging.info('Stage %s of run %s is complete', stage, run_id)
+    try:
+        if stage == 'fetch':
+            queue_builders(run_id)
+        else:
+            with metrics.span('finish'):
+                finish_building()
+    except:
+        # let whoever retries this (the task or the sweeper) try again
+        ctrpmodels.RankingRun.reopen_stage(run_id, stage)
+        raise
+
+# Checks on a run in case the last task in a stage couldn't tell that it was
+# the last one, and keeps checking until the run is finished.  This counts the
+# arrivals in the datastore, which is slower than the barrier's counter but
+# can't be evicted.
+#
+# A task that dies on its last try without getting to catch an exception (a
+# DeadlineExceededError or the instance going away) never arrives.  Once the
+# default queue is empty there's nothing left that could arrive, so if the
+# sweeper finds it empty IDLE_SWEEPS times in a row (the queue's statistics
+# can lag behind it) it moves the stage on without the missing tasks.  idle is
+# the number of sweeps in a row so far that found it empty.
+def sweep_run(run_id, idle=0):
+    run = ctrpmodels.RankingRun.get_by_id(int(run_id))
+    if run is None:
+        return
+
+    if datetime.datetime.utcnow() - run.started > MAX_RUN_TIME:
+        finish_overdue_run(run)
+        return
+
+    for (stage, expected) in (('fetch', run.fetch_tasks), ('build', run.groups)):
+        if stage in run.completed:
+            continue
 
-    # calculate the avg ilvl values from the toon data
-    group.avgilvl = 0
-    numtoons = 0
-    for toon in data:
-        # ignore toons that we didn't get data back for or for toons less than
-        # level 120
-        if 'items' in toon and toon['level'] == 120:
-            numtoons += 1
-            group.avgilvl += toon['items']['averageItemLevelEquipped']
+        arrived = barrier.Barrier(run_id, stage).count_arrivals()
+        logging.info('Sweeper: %d of %d tasks done for %s in run %s', arrived, expected, stage, run_id)
+        if arrived >= expected:
+            advance_run(run_id, stage)
+            if stage == 'build':
+                return
+            idle = 0
+        elif Queue().fetch_statistics().tasks == 0:
+            idle += 1
+            if idle >= IDLE_SWEEPS:
+                logging.warning('Sweeper: %d tasks for %s in run %s died without finishing, moving on without them',
+                                expected - arrived, stage, run_id)
+                advance_run(run_id, stage)
+                if stage == 'build':
+                    return
+                idle = 0
+        else:
+            idle = 0
+        break
+    else:
+        return
+
+    schedule_sweep(run_id, idle)
+
+# Finishes a run that has been going for longer than MAX_RUN_TIME with the
+# groups that got built, without queueing any more tasks for it.  The sweeper
+# stops checking on the run whether this works or not.
+def finish_overdue_run(run):
+    run_id = run.key.id()
+    logging.error('Sweeper: run %s has been going since %s, finishing it now', run_id, run.started)
+    try:
+        ctrpmodels.RankingRun.complete_stage(run_id, 'fetch')
+        advance_run(run_id, 'build')
+    except Exception:
+        logging.exception('Sweeper: failed to finish run %s, giving up on it', run_id)
+
+def schedule_sweep(run_id, idle=0):
+    sweeper = Task(url='/builder', params={'group':'ctrp-taskcheck', 'run':run_id, 'idle':idle},
+                   countdown=SWEEP_INTERVAL)
+    Queue(name='taskcheck').add(sweeper)
+
+# Tasks for a stage are named after the run and the member of the stage so that
+# queueing a stage a second time doesn't run anything twice.
+def task_name(stage, run_id, member):
+    return '%s-%s-%s' % (stage, run_id, hashlib.md5(unicode(member).encode('utf-8')).hexdigest())
+
+# Adds a list of tasks to a queue, in chunks as large as the task queue API
+# allows for a single call.  Tasks that were already added are skipped.
+def add_tasks(queue, tasks):
+    for i in xrange(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        try:
+            queue.add(tasks[i:i+taskqueue.MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            logging.info('Some tasks were already queued')
+
+def queue_builders(run_id):
+    groups = Group.query().fetch(projection=[Group.name])
+
+    # the groups may have changed since the run started.  leave out the ones
+    # the run is skipping.
+    run = ctrpmodels.RankingRun.get_by_id(int(run_id))
+    skipped = set(run.skipped)
+    groups = [group for group in groups if group.name not in skipped]
+
+    # queue the groups people are most likely to be watching first
+    (groups, run.build_order) = scheduler.order_groups(groups)
+    run.groups = len(groups)
+    run.put()
+
+    params = {'run': run_id}
+    if run.incremental:
+        params['incremental'] = '1'
+
+    barrier.Barrier(run_id, 'build').start(len(groups))
+    tasks = [Task(url='/builder', name=task_name('build', run_id, group.name),
+                  params=dict(params, group=group.name)) for group in groups]
+    add_tasks(Queue(), tasks)
+    logging.info('Queued %d builder tasks for run %s', len(tasks), run_id)
+
+    if not tasks:
+        advance_run(run_id, 'build')
+
+# Builds the progress for a group from its toons.  In an incremental run, a
+# group is left alone if its roster is the same as the last time it was built
+# and none of its toons have a newer lastModified time than they did then,
+# since nothing the group is ranked on can have changed.  That only holds if
+# every toon loaded, both this time and the last time, since a toon that
+# failed then may bring kills that were never counted.
+def process_group(group, importer, write_to_db, store=None, incremental=False):
+    logging.info('Starting work on group %s', group.name)
 
-    if numtoons != 0:
-        group.avgilvl /= numtoons
+    # stream the toon data into a tally as it comes back from the API.  this
+    # counts the kills and the ilvls without keeping any of the responses
+    # around.
+    tally = progression.GroupTally()
+    importer.load(group.toons, tally, store)
+
+    roster = rostermgmt.roster_hash(group.toons)
+    complete = len(group.toons)
+    if (incremental and group.builtmodified is not None and group.builtroster == roster and
+            group.builtloaded == complete and tally.loaded == complete and
+            tally.last_modified <= group.builtmodified):
+        logging.info('Skipping group %s: no toons changed since it was last built', group.name)
+        if store is not None:
+            store.record_unchanged()
+        return '%s unchanged<br/>' % group.name
+
+    group.builtmodified = tally.last_modified
+    group.builtroster = roster
+    group.builtloaded = tally.loaded
+
+    with metrics.span('progress'):
+        progress = tally.progress()
+        group.avgilvl = tally.average_ilvl()
 
     # update the entry in ndb with the new progression data for this
     # group.  this also checks to make sure that the progress only ever
@@ -96,24 +312,20 @@ def process_group(group, importer, write_to_db):
         killedtoday['heroic'] = list()
         killedtoday['mythic'] = list()
 
-        for group_boss in group_raid.bosses:
-            data_boss = [b for b in data_raid if b.name == group_boss.name][0]
-            if data_boss.normaldead is not None and group_boss.normaldead is None:
-                killedtoday['normal'].append(data_boss.name)
-                group_boss.normaldead = data_boss.normaldead
-                logging.debug('new normal kill of %s', data_boss.name)
-            if data_boss.heroicdead is not None and group_boss.heroicdead is None:
-                killedtoday['heroic'].append(data_boss.name)
-                group_boss.heroicdead = data_boss.heroicdead
-                logging.debug('new heroic kill of %s', data_boss.name)
-            if data_boss.mythicdead is not None and group_boss.mythicdead is None:
-                killedtoday['mythic'].append(data_boss.name)
-                group_boss.mythicdead = data_boss.mythicdead
-                logging.debug('new mythic kill of %s', data_boss.name)
+        # the bosses in the progress data are in the same order as the
+        # bosses for the raid in Constants, which is the order the group's
+        # kill data is indexed in.
+        for (i, data_boss) in enumerate(data_raid):
+            for diff in Constants.difficulties:
+                killdate = getattr(data_boss, diff+'dead')
+                if killdate is not None and not group_raid.killed(i, diff):
+                    killedtoday[diff].append(data_boss.name)
+                    group_raid.set_kill(i, diff, killdate)
+                    logging.debug('new %s kill of %s', diff, data_boss.name)
 
         for diff in Constants.difficulties:
             old = getattr(group_raid, diff)
-            new = len([b for b in group_raid.bosses if getattr(b, diff+'dead') is not None])
+            new = group_raid.kill_count(diff)
             if old < new:
                 if new_hist is None:
                     new_hist = ctrpmodels.History(group=group.name)
@@ -136,83 +348,23 @@ def process_group(group, importer, write_to_db):
                 setattr(group_raid, diff, new)
 
     if write_to_db:
-        group.put()
-        if new_hist is not None:
-            new_hist.put()
+        # the group, its history and its timeline all go out in one batch
+        # when the writer is done, so the group.write span covers writing all
+        # of them.  the timeline.read span is just the lookup of the timeline.
+        with metrics.span('group.write'), writebatch.WriteBatcher() as writer:
+            writer.put(group)
+            if new_hist is not None:
+                writer.put(new_hist)
+
+                # keep the group's timeline up to date for the history page
+                with metrics.span('timeline.read'):
+                    timeline = ctrpmodels.Timeline.get_for_group(group.name)
+                timeline.add(new_hist)
+                writer.put(timeline)
 
     logging.info('Finished building group %s', group.name)
     return '%s data generated<br/>' % group.name
 
-def parse(bosses, toondata, raidname, progress):
-
-    progress[raidname] = list()
-
-    bossdata = dict()
-    for boss in bosses:
-        bossdata[boss] = dict()
-        for diff in Constants.difficulties:
-            bossdata[boss][diff] = dict()
-            bossdata[boss][diff]['times'] = list()
-            bossdata[boss][diff]['timeset'] = set()
-
-    # loop through each toon in the data from the blizzard API
-    for toon in toondata:
-
-        if 'progression' not in toon:
-            continue
-
-        # get just the raid data for this toon
-        raids = toon['progression']['raids']
-
-        # this filters the raid data down to just the raid we're looking
-        # at this pass
-        raid = [d for d in raids if d['name'] == raidname][0]
-
-        # loop through the individual bosses and get the timestamp for
-        # the last kill for this toon for each boss
-        for boss in bosses:
-
-            # this filters the raid data down to just a single boss
-            single_boss = None
-            filtered_bosses = [d for d in raid['bosses'] if d['name'] == boss]
-            if filtered_bosses:
-                single_boss = filtered_bosses[0]
-
-            if not single_boss:
-                logging.error('Failed to find boss %s in toon progression data', boss)
-                continue
-
-            # loop through each difficulty level and grab each timestamp.
-            # skip any timestamps of zero.  that means the toon never
-            # killed the boss.
-            for diff in Constants.difficulties:
-                if single_boss[diff+'Timestamp'] != 0:
-                    bossdata[boss][diff]['times'].append(single_boss[diff+'Timestamp'])
-                    bossdata[boss][diff]['timeset'].add(single_boss[diff+'Timestamp'])
-
-    # loop back through the difficulties and bosses and build up the
-    # progress data
-    for boss in bosses:
-
-        bossobj = ctrpmodels.Boss(name=boss)
-
-        for diff in Constants.difficulties:
-            # for each boss, grab the set of unique timestamps and sort it
-            # with the last kill first
-            timelist = list(bossdata[boss][diff]['timeset'])
-            timelist.sort(reverse=True)
-            logging.info("kill times for %s %s: %s", diff, boss, str(timelist))
-
-            for stamp in timelist:
-                count = bossdata[boss][diff]['times'].count(stamp)
-                logging.info('%s: time: %d   count: %s', boss, stamp, count)
-                if count >= 8:
-                    logging.info('*** found valid kill for %s %s at %d', diff, boss, stamp)
-                    setattr(bossobj, diff+'dead', datetime.date.today())
-                    break
-
-        progress[raidname].append(bossobj)
-
 def finish_building():
 
     # post any changes that happened with the history to twitter
@@ -223,43 +375,55 @@ def finish_building():
     updates = ctrpmodels.History.get_not_tweeted(curdate)
 
     if updates:
-        path = os.path.join(os.path.split(__file__)[0], 'api-auth.json')
-        json_data = json.load(open(path))
-
-        tw_client = twitter.Api(
-            consumer_key=json_data['twitter_consumer_key'],
-            consumer_secret=json_data['twitter_consumer_secret'],
-            access_token_key=json_data['twitter_access_token'],
-            access_token_secret=json_data['twitter_access_secret'],
-            cache=None)
-
-        template_start = 'CtR group <%s> killed %d new boss'
-        template_end = ' in %s %s to be %d/%d%s!'
-        for update in updates:
-
-            # mark this update as tweeted to avoid reposts
-            update.tweeted = True
-
-            for raid in Constants.raids:
-
-                raidhist = getattr(update, raid[0])
-                if raidhist is not None:
-                    for diff in reversed(Constants.difficulties):
-                        kills = getattr(raidhist, diff)
-                        if kills:
-                            total = getattr(raidhist, diff+'_total')
-                            text = template_start % (update.group, len(kills))
-                            if len(kills) > 1:
-                                text += "es"
-                            text += template_end % (diff.title(), raid[1], total, len(raid[2]), diff.title()[0])
-                            if (diff != 'normal') and total == len(raid[2]):
-                                text = text + ' #aotc'
-
-#                            tw_client.PostUpdate(text)
-
-            # update the entry in the database so that the tweeted flag
-            # gets set to true
-            update.put()
+        tweet_updates(updates, twitter_client())
+
+    # the rankings are done, so rebuild the pages from the new data
+    display.rebuild_all(ctrpmodels.Global.mark_updated())
+
+def twitter_client():
+    path = os.path.join(os.path.split(__file__)[0], 'api-auth.json')
+    json_data = json.load(open(path))
+
+    return twitter.Api(
+        consumer_key=json_data['twitter_consumer_key'],
+        consumer_secret=json_data['twitter_consumer_secret'],
+        access_token_key=json_data['twitter_access_token'],
+        access_token_secret=json_data['twitter_access_secret'],
+        cache=None)
+
+# Posts the history updates to twitter and marks them as tweeted so that they
+# don't get posted again.
+def tweet_updates(updates, tw_client):
+    template_start = 'CtR group <%s> killed %d new boss'
+    template_end = ' in %s %s to be %d/%d%s!'
+    writer = writebatch.WriteBatcher()
+    for update in updates:
+
+        # mark this update as tweeted to avoid reposts
+        update.tweeted = True
+
+        for raid in Constants.raids:
+
+            raidhist = getattr(update, raid[0])
+            if raidhist is not None:
+                for diff in reversed(Constants.difficulties):
+                    kills = getattr(raidhist, diff)
+                    if kills:
+                        total = getattr(raidhist, diff+'_total')
+                        text = template_start % (update.group, len(kills))
+                        if len(kills) > 1:
+                            text += "es"
+                        text += template_end % (diff.title(), raid[1], total, len(raid[2]), diff.title()[0])
+                        if (diff != 'normal') and total == len(raid[2]):
+                            text = text + ' #aotc'
+
+#                        tw_client.PostUpdate(text)
+
+        # update the entry in the database so that the tweeted flag
+        # gets set to true
+        writer.put(update)
+
+    writer.flush()
 
 def loadone(request):
     groupname = request.args.get('group', '')
@@ -280,24 +444,125 @@ def rank():
         'in_flight': stats.in_flight,
     }
 
+    # report on how many API calls the last run saved by only fetching each
+    # toon once
+    run = ctrpmodels.RankingRun.get_latest()
+    if run is not None:
+        store = wowapi.ToonStore(run.key.id())
+        misses = store.get_misses()
+        template_values['run'] = run
+        template_values['misses'] = misses
+        template_values['unchanged'] = store.get_unchanged()
+        template_values['calls_saved'] = run.toons_total - run.toons_unique - misses
+        if run.toons_unique:
+            template_values['dedup_ratio'] = float(run.toons_total) / run.toons_unique
+        else:
+            template_values['dedup_ratio'] = 1.0
+
+    template_values['profiles'] = ctrpmodels.Profile.get_recent()
+    template_values['profiles_armed'] = profiler.armed_count('builder')
+
     return render_template('ranker.html', **template_values)
 
-def start_ranking():
+# Shows the timings recorded for a ranking run, the latest one unless another
+# is asked for.  Add format=json to get the same data as JSON.
+def show_metrics(request):
+    run_id = request.args.get('run', type=int)
+    if run_id is not None:
+        run = ctrpmodels.RankingRun.get_by_id(run_id)
+    else:
+        run = ctrpmodels.RankingRun.get_latest()
+
+    spans = list()
+    if run is not None:
+        spans = metrics.get_run_metrics(run.key.id())
+
+    if request.args.get('format') == 'json':
+        return jsonify(run=run.key.id() if run is not None else None, spans=spans)
+
+    return render_template('metrics.html', run=run, spans=spans,
+                           percentiles=metrics.PERCENTILES)
+
+# Returns True if an incremental run can leave a group out entirely: a builder
+# has written it since the rank keys were added (the rankings are read in rank
+# key order, and a group without one wouldn't show up in them), every toon on
+# its current roster loaded the last time it was built, and it hasn't killed
+# anything recently.  active is the set of names of the groups that have.
+def can_skip(group, active):
+    return (group.rankkey is not None and group.builtmodified is not None and
+            group.name not in active and
+            group.builtroster == rostermgmt.roster_hash(group.toons) and
+            group.builtloaded == len(group.toons))
+
+# Returns True if the next run has to be a full one.
+def full_run_due():
+    latest = ctrpmodels.RankingRun.get_latest_full()
+    return latest is None or datetime.datetime.utcnow() - latest.started > FULL_RUN_INTERVAL
+
+# Starts a ranking run.  Runs are incremental unless full is set or a full run
+# is due: groups that haven't killed anything recently and haven't changed
+# since they were last built are skipped entirely, and the builders skip
+# groups whose toons haven't changed since the group was last built.  A full
+# run rebuilds every group.
+def start_ranking(full=False):
     # refuse to start the tasks if there are some already running
     queue = Queue()
     stats = queue.fetch_statistics()
     if stats.tasks == 0:
 
-        # queue up all of the groups into individual tasks.  the configuration
-        # in queue.yaml only allows 10 tasks to run at once.  the builder only
-        # allows 10 URL requests at a time, which should hopefully keep the
-        # Blizzard API queries under control.
+        if not full and full_run_due():
+            logging.info('No full ranking run in the last %s, making this one full', FULL_RUN_INTERVAL)
+            full = True
+
         groups = Group.query().fetch()
+        skipped = list()
+        if not full:
+            since = datetime.date.today() - datetime.timedelta(days=ACTIVE_DAYS)
+            active = set(entry.group for entry in ctrpmodels.History.get_since(since))
+            skipped = [group.name for group in groups if can_skip(group, active)]
+            groups = [group for group in groups if not can_skip(group, active)]
+
+        # gather up the distinct set of toons across all of the group rosters.
+        # toons that are on more than one roster only get fetched once, in the
+        # fetch stage of the run, and the builders for the groups read them
+        # back out of the run's toon store.
+        unique = dict()
+        total = 0
         for group in groups:
-            taskqueue.add(url='/builder', params={'group':group.name})
-
-        checker = Task(url='/builder', params={'group':'ctrp-taskcheck'})
-        taskcheck = Queue(name='taskcheck')
-        taskcheck.add(checker)
+            for toon in group.toons:
+                total += 1
+                (name, realm) = wowapi.split_toon(toon)
+                unique.setdefault(wowapi.toon_key(name, realm), toon)
+
+        run = ctrpmodels.RankingRun(groups=len(groups), toons_total=total,
+                                    toons_unique=len(unique), incremental=not full,
+                                    skipped=skipped)
+        run_id = run.put().id()
+        logging.info('Ranking run %s (%s): %d groups, %d toons, %d unique, %d quiet groups skipped',
+                     run_id, 'full' if full else 'incremental', len(groups), total,
+                     len(unique), len(skipped))
+
+        # queue up the fetch stage.  the configuration in queue.yaml only
+        # allows 6 tasks to run at once, and every request to the Blizzard
+        # API goes through the shared rate limiter in wowapi.
+        toons = sorted(unique.itervalues())
+        tasks = list()
+        for i in xrange(0, len(toons), FETCH_BATCH_SIZE):
+            batch = i / FETCH_BATCH_SIZE
+            tasks.append(Task(url='/fetcher', name=task_name('fetch', run_id, batch), params={
+                'run': run_id,
+                'batch': batch,
+                'toons': json.dumps(toons[i:i+FETCH_BATCH_SIZE])}))
+
+        run.fetch_tasks = len(tasks)
+        run.put()
+
+        with metrics.recording(run_id):
+            barrier.Barrier(run_id, 'fetch').start(len(tasks))
+            add_tasks(queue, tasks)
+            if not tasks:
+                advance_run(run_id, 'fetch')
+
+        schedule_sweep(run_id)
 
     return redirect('/rank')
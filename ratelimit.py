@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Token bucket rate limiting for requests to the Blizzard API.  The state of a
+# bucket is kept in memcache so that every builder and fetch task, across all
+# of the instances, draws from the same budget.  A local store is also
+# available for running outside of app engine.  This also has the adaptive
+# limit on concurrent requests that each importer uses.
+
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+
+# Keeps the bucket state in memory for this process only.
+class LocalBucketStore(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = dict()
+
+    def take(self, name, rate, burst):
+        with self.lock:
+            now = time.time()
+            (tokens, last) = self.buckets.get(name, (burst, now))
+            (tokens, wait) = _refill_and_take(tokens, last, now, rate, burst)
+            self.buckets[name] = (tokens, now)
+            return wait
+
+# Keeps the bucket state in memcache, updated with compare-and-set so that
+# concurrent requests don't hand out the same token twice.
+class MemcacheBucketStore(object):
+
+    # the number of times to retry a contended update before giving up and
+    # just waiting for the next token to show up.
+    MAX_CAS_RETRIES = 10
+
+    def take(self, name, rate, burst):
+        key = 'ratelimit-%s' % name
+
+        # cas ids are tracked per client object, so each call gets its own
+        # client to keep threads from clobbering each other.
+        client = memcache.Client()
+        for _ in xrange(self.MAX_CAS_RETRIES):
+            now = time.time()
+            state = client.gets(key)
+            if state is None:
+                # first request, or the bucket got evicted.  start out full.
+                if client.add(key, (burst - 1, now)):
+                    return 0
+                continue
+
+            (tokens, wait) = _refill_and_take(state[0], state[1], now, rate, burst)
+            if client.cas(key, (tokens, now)):
+                return wait
+
+        logging.warning('rate limiter %s: too much contention, backing off', name)
+        return 1.0 / rate
+
+# Adds the tokens accumulated since the last update to the bucket and tries to
+# take one out.  Returns the new token count and the number of seconds to wait
+# before trying again, which is zero if a token was taken.
+def _refill_and_take(tokens, last, now, rate, burst):
+    tokens = min(float(burst), tokens + max(0.0, now - last) * rate)
+    if tokens >= 1.0:
+        return (tokens - 1.0, 0)
+    return (tokens, (1.0 - tokens) / rate)
+
+class TokenBucket(object):
+
+    # rate is the sustained number of requests per second and burst is the
+    # number of requests that can go out at once after the bucket has had
+    # time to fill up.
+    def __init__(self, name, rate, burst, store=None):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = burst
+        self.store = store if store is not None else MemcacheBucketStore()
+
+    # Blocks until a token is available for a request.
+    def acquire(self):
+        waited = 0.0
+        wait = self.store.take(self.name, self.rate, self.burst)
+        while wait > 0:
+            time.sleep(wait)
+            waited += wait
+            wait = self.store.take(self.name, self.rate, self.burst)
+
+        if waited > 0:
+            logging.debug('rate limiter %s: waited %f seconds', self.name, waited)
+        return waited
+
+# Limits the number of requests in flight at once, adjusting the limit based on
+# how the API responds.  The limit is cut in half whenever a request gets
+# throttled and grows back by about one for every limit's worth of requests
+# that succeed (AIMD, the same scheme TCP uses for its congestion window).
+#
+# Like TCP, the limit is only cut once per window.  Each request gets a
+# sequence number when it goes out, and a cut remembers the last number sent
+# under the old limit.  Throttled responses to requests from before the cut
+# were sent at the old limit and don't cut it again, and successes from
+# before the cut don't grow it either, so the limit only climbs once requests
+# sent at the new limit start coming back without being throttled.
+class AdaptiveConcurrency(object):
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.active = 0
+        self.sent = 0
+        self.window_end = 0
+        self.cond = threading.Condition()
+
+    def current(self):
+        return int(self.limit)
+
+    # Blocks until there is room under the current limit for another request
+    # and returns the request's sequence number, to be handed back to release.
+    def acquire(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+            self.sent += 1
+            return self.sent
+
+    def release(self, seq, throttled=False):
+        with self.cond:
+            self.active -= 1
+            if seq > self.window_end:
+                if throttled:
+                    self.limit = max(float(self.minimum), self.limit / 2)
+                    self.window_end = self.sent
+                    logging.info('concurrency limit cut to %d after throttling', int(self.limit))
+                else:
+                    self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
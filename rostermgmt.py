@@ -13,149 +13,169 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import hashlib
 import json
 import logging
 import datetime
 import time
 
-from pytz.gae import pytz
 from google.appengine.api import urlfetch_errors
 from google.appengine.api import urlfetch
 
-from ctrpmodels import Boss
-from ctrpmodels import Constants
 from ctrpmodels import Group
 from ctrpmodels import Raid
+import writebatch
 
 # Force the deadline for urlfetch to be 10 seconds (Default is 5).  For some
 # reason, that first lookup for the spreadsheet takes a bit.
 urlfetch.set_default_fetch_deadline(20)
 
+TEAMS_URL = 'http://guild.converttoraid.com/api/teams'
+
+# The sections of the report from a roster load, in order, as the outcome from
+# the worker and the heading for it.
+REPORT_SECTIONS = [
+    ('Added', 'New Raid Groups'),
+    ('Updated', 'Updated Raid Groups'),
+    ('Removed', 'Disbanded/Removed Raid Groups'),
+    ('Skipped', 'Raid groups skipped due to Size'),
+    ('Unchanged', 'Raid groups skipped due to Unchanged Roster'),
+]
+
 def load_groups():
 
     time1 = time.time()
     logging.info('retrieving roster data from Raid Builder')
-    url = 'http://guild.converttoraid.com/api/teams'
     try:
-        response = urlfetch.fetch(url)
+        response = urlfetch.fetch(TEAMS_URL)
     except urlfetch_errors.DeadlineExceededError:
         logging.error('urlfetch threw DeadlineExceededError')
+        return 'Failed to retrieve the team list', 500
     except urlfetch_errors.DownloadError:
         logging.error('urlfetch threw DownloadError')
+        return 'Failed to retrieve the team list', 500
     except:
         logging.error('urlfetch threw unknown exception')
-
-    jsondata = json.loads(response.content)
+        return 'Failed to retrieve the team list', 500
 
     groupcount = 0
     tooncount = 0
-    responses = list()
+    report = RosterReport()
 
     time2 = time.time()
 
-    response = '<html><head><title>Roster Update</title></head><body>'
-
-    # Grab the list of groups already in the database.  Loop through and
-    # delete any groups that don't exist in the list (it happens...) and
-    # any groups that are now marked disbanded. Groups listed in the
-    # history will remain even if they disband. While we're looping, also
-    # remove any groups from the list to be processed that haven't had
-    # a roster update since the last time we did this.
+    # Grab the list of groups already in the database, in a map by name so
+    # that the workers below don't have to look them up again.
+    #
+    # All of the writes for the load are batched up and sent as the loop goes,
+    # instead of making a datastore call for each group.
+    writer = writebatch.WriteBatcher()
     query = Group.query().order(Group.name)
-    results = query.fetch()
-    for res in results:
-
-        # Check for groups that don't exist in the jsondata anymore. These
-        # groups were removed for whatever reason and should be deleted
-        # from the database.
-        if res.name not in jsondata:
-            responses.append(('Removed', 'Removed disbanded or non-existent team from database: %s' % res.name))
-            res.key.delete()
-            continue
-
-        # Check for groups that are in both the jsondata and database, but
-        # are marked as disbanded in the json data. These should be removed
-        # from the database and removed from the json data so they don't
-        # get processed later.
-        elif jsondata[res.name]['status'] == 'Disbanded':
-            responses.append(('Removed', 'Removed team marked disbanded from database: %s' % res.name))
-            res.key.delete()
-
-        # if the last updated time exists in the roster data (maccus added
-        # it), while we're looping through the groups, also remove any
-        # groups from the list to be processed that haven't had a roster
-        # update since the last time we parsed groups.
-        elif 'updated_at' in jsondata[res.name]:
-            # date comes to us as date/time with a timezone. adjust the date time
-            # to add the timezone information, then pull just the date out of it
-            # in UTC time.
-            updated_at = jsondata[res.name]['updated_at']
-            updatetime = datetime.datetime.strptime(updated_at['date'], '%Y-%m-%d %H:%M:%S.%f')
-            timezone = updated_at['timezone'].replace('\\', '')
-            localtime = pytz.timezone(timezone).localize(updatetime)
-            lastupdate = localtime.astimezone(pytz.timezone('UTC')).date()
-
-            if res.rosterupdated != None and res.rosterupdated > lastupdate:
-                responses.append(('DateUnchanged', '%s hasn\'t been updated since last load (load: %s, update: %s)' % (res.name, res.rosterupdated, lastupdate)))
-                groupcount += 1
-                tooncount += len(res.toons)
-                del jsondata[res.name]
-
-    logging.info('num groups to process: %d', len(jsondata))
+    existing = dict((res.name, res) for res in query.fetch())
 
     time3 = time.time()
 
     logging.info('time spent getting list of groups %s', (time2-time1))
-    logging.info('time spent cleaning groups %s', (time3-time2))
-
-    # loop through the remaining groups in the json data and process them
-    # in one pass.  we don't have to worry about hitting memory limits or
-    # anything anymore since we're not making calls into the spreadsheet.
-    for group in jsondata:
-        if jsondata[group]['status'] == 'Disbanded':
+    logging.info('time spent getting existing groups %s', (time3-time2))
+
+    # loop through the teams in the json data and process them in one pass,
+    # decoding them one at a time so that the whole list never has to be in
+    # memory at once.  any groups that are now marked disbanded are deleted.
+    # Groups listed in the history will remain even if they disband.
+    seen = set()
+    for (name, team) in iter_teams(response.content):
+        seen.add(name)
+        if team['status'] == 'Disbanded':
+            if name in existing:
+                report.add('Removed', 'Removed team marked disbanded from database: %s' % name)
+                writer.delete(existing[name].key)
             continue
 
-        returnval = worker(group, jsondata[group])
-        responses.append((returnval[0], returnval[2]))
-        if returnval[0] == 'Added' or returnval[0] == 'Updated':
+        returnval = worker(name, team, writer, existing.get(name))
+        report.add(returnval[0], returnval[2])
+        if returnval[0] in ('Added', 'Updated', 'Unchanged'):
             groupcount += 1
             tooncount += returnval[1]
 
-    response += '<h3>New Raid Groups</h3>'
-    added = sorted([x for x in responses if x[0] == 'Added'], key=lambda tup: tup[1])
-    for i in added:
-        response += '%s<br/>' % i[1]
+    # Check for groups that don't exist in the jsondata anymore. These
+    # groups were removed for whatever reason and should be deleted
+    # from the database.
+    for (name, res) in existing.iteritems():
+        if name not in seen:
+            report.add('Removed', 'Removed disbanded or non-existent team from database: %s' % name)
+            writer.delete(res.key)
 
-    response += '<h3>Updated Raid Groups</h3>'
-    updated = sorted([x for x in responses if x[0] == 'Updated'], key=lambda tup: tup[1])
-    for i in updated:
-        response += '%s<br/>' % i[1]
-
-    response += '<h3>Disbanded/Removed Raid Groups</h3>'
-    removed = sorted([x for x in responses if x[0] == 'Removed'], key=lambda tup: tup[1])
-    for i in removed:
-        response += '%s<br/>' % i[1]
-
-    response += '<h3>Raid groups skipped due to Size</h3>'
-    skipped = sorted([x for x in responses if x[0] == 'Skipped'], key=lambda tup: tup[1])
-    for i in skipped:
-        response += '%s<br/>' % i[1]
-
-    response += '<h3>Raid groups skipped due to Last Update Date</h3>'
-    updatedate = sorted([x for x in responses if x[0] == 'DateUnchanged'], key=lambda tup: tup[1])
-    for i in updatedate:
-        response += '%s<br/>' % i[1]
+    logging.info('num groups processed: %d', len(seen))
 
+    writer.flush()
     time6 = time.time()
     logging.info('time spent building groups %s', (time6-time3))
 
-    response += '<br/>'
-    response += 'Now managing %d groups with %d total toons<br/>' % (groupcount, tooncount)
-    response += '</body></html>'
-
-    return response, 200
-
-def worker(name, group):
+    return report.render(groupcount, tooncount), 200
+
+# Decodes the team list from Raid Builder one team at a time.  The list is a
+# JSON object of team name to the team's data, and this yields (name, team)
+# for each entry without building the dict for the whole thing.
+def iter_teams(content):
+    decoder = json.JSONDecoder()
+    ws = json.decoder.WHITESPACE
+
+    idx = ws.match(content, 0).end()
+    if content[idx:idx+1] != '{':
+        raise ValueError('Team list is not a JSON object')
+    idx = ws.match(content, idx + 1).end()
+    if content[idx:idx+1] == '}':
+        return
+
+    while True:
+        if content[idx:idx+1] != '"':
+            raise ValueError('Expected a team name at %d' % idx)
+        (name, idx) = json.decoder.scanstring(content, idx + 1)
+
+        idx = ws.match(content, idx).end()
+        if content[idx:idx+1] != ':':
+            raise ValueError('Expected : at %d' % idx)
+        idx = ws.match(content, idx + 1).end()
+        (team, idx) = decoder.raw_decode(content, idx)
+        yield (name, team)
+
+        idx = ws.match(content, idx).end()
+        nextchar = content[idx:idx+1]
+        if nextchar == '}':
+            return
+        if nextchar != ',':
+            raise ValueError('Expected , or } at %d' % idx)
+        idx = ws.match(content, idx + 1).end()
+
+# Collects the outcomes of a roster load, grouped by outcome as they're added,
+# and renders them into the HTML report.
+class RosterReport(object):
+
+    def __init__(self):
+        self.sections = dict((outcome, list()) for (outcome, _) in REPORT_SECTIONS)
+
+    def add(self, outcome, message):
+        self.sections[outcome].append(message)
+
+    def render(self, groupcount, tooncount):
+        parts = ['<html><head><title>Roster Update</title></head><body>']
+        for (outcome, heading) in REPORT_SECTIONS:
+            parts.append('<h3>%s</h3>' % heading)
+            for message in sorted(self.sections[outcome]):
+                parts.append('%s<br/>' % message)
+
+        parts.append('<br/>')
+        parts.append('Now managing %d groups with %d total toons<br/>' % (groupcount, tooncount))
+        parts.append('</body></html>')
+        return ''.join(parts)
+
+# Returns a hash of a roster, for telling whether it changed since the last
+# load.  The toon list is already sorted, so the same roster always hashes the
+# same.
+def roster_hash(toons):
+    return hashlib.sha1(u'\n'.join(toons).encode('utf-8')).hexdigest()
+
+def worker(name, group, writer, existing):
     time4 = time.time()
     logging.info('working on group %s', name)
 
@@ -173,17 +193,15 @@ def worker(name, group):
         toons.append('%s/%s' % (toon['toon_name'], toon['realm']))
 
     toons = sorted(toons)
+    rosterhash = roster_hash(toons)
     time5 = time.time()
 
     # Check if this group already exists in the datastore.  We don't
     # want to overwrite existing progress data for a group if we don't
     # have to.
-    query = Group.query(Group.name == name)
-    results = query.fetch(1)
-
     response = ''
     loggroup = ''
-    if not results:
+    if existing is None:
         # create a new group, but only if it has at least 5 toons in
         # it.  that's the threshold for building progress data and
         # there's no real reason to create groups with only that many
@@ -191,27 +209,30 @@ def worker(name, group):
         if len(toons) >= 5:
             newgroup = Group(name=name)
             newgroup.aep = Raid()
-            newgroup.aep.bosses = list()
-            for boss in Constants.aepbosses:
-                newboss = Boss(name=boss)
-                newgroup.aep.bosses.append(newboss)
 
             newgroup.toons = toons
+            newgroup.rosterhash = rosterhash
             newgroup.rosterupdated = datetime.date.today()
 
-            newgroup.put()
+            writer.put(newgroup)
             response = 'Added group %s with %d toons' % (name, len(toons))
             loggroup = 'Added'
         else:
             response = 'New group %s only has %d toons and was not included' % (name, len(toons))
             loggroup = 'Skipped'
+    elif existing.rosterhash == rosterhash or (existing.rosterhash is None and existing.toons == toons):
+        # the roster is the same as it was last time, so there's nothing to
+        # write.  groups from before the hashes were stored get theirs the
+        # next time the roster does change.
+        response = '%s hasn\'t changed since the last load (updated %s)' % (name, existing.rosterupdated)
+        loggroup = 'Unchanged'
     else:
         # the group already exists and all we need to do is update the
         # toon list.  all of the other data stays the same.
-        existing = results[0]
         existing.toons = toons
+        existing.rosterhash = rosterhash
         existing.rosterupdated = datetime.date.today()
-        existing.put()
+        writer.put(existing)
         response = 'Updated group %s with %d toons' % (name, len(toons))
         loggroup = 'Updated'
 
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Picks the order the builder tasks for a ranking run are queued in, so that
+# the groups people are most likely to be watching are updated first.  Each
+# group gets a score from three things:
+#
+#   - its recent kills, from the History entries of the last few weeks, with
+#     harder difficulties counting more and older kills counting less
+#   - its place in the rankings, with the top of the page counting more
+#   - whether its roster changed recently, which means the team is active
+#
+# The task queue runs tasks roughly in the order they were added, so this only
+# changes which groups tend to finish first.  Every group still gets built.
+
+import datetime
+import logging
+
+from ctrpmodels import Constants
+from ctrpmodels import Group
+from ctrpmodels import History
+
+# How far back to look for kills and roster changes, in days.
+HISTORY_DAYS = 21
+ROSTER_DAYS = 7
+
+# A kill counts half as much for every KILL_HALF_LIFE days since it happened.
+KILL_HALF_LIFE = 7.0
+
+# How much a kill on each difficulty is worth.
+DIFFICULTY_WEIGHTS = {'normal': 1.0, 'heroic': 2.0, 'mythic': 4.0}
+
+# How much the first place in the rankings is worth, falling off linearly to
+# nothing at the bottom, and how much a recent roster change is worth.  A
+# mythic kill last week is worth about as much as being top of the rankings.
+RANK_WEIGHT = 2.0
+ROSTER_WEIGHT = 1.0
+
+# The number of groups from the front of the order kept for the ranker page.
+REPORT_SIZE = 25
+
+# Returns a dict of group name to the weighted count of its recent kills.
+def recent_kills(today):
+    kills = dict()
+    for entry in History.get_since(today - datetime.timedelta(days=HISTORY_DAYS)):
+        age = (today - entry.date).days
+        decay = 0.5 ** (age / KILL_HALF_LIFE)
+        for raid in Constants.raids:
+            raidhist = getattr(entry, raid[0])
+            if raidhist is None:
+                continue
+            for diff in Constants.difficulties:
+                count = len(getattr(raidhist, diff) or [])
+                if count:
+                    kills[entry.group] = (kills.get(entry.group, 0.0) +
+                                          count * DIFFICULTY_WEIGHTS[diff] * decay)
+    return kills
+
+# Returns the scores for a list of groups, as a dict of group key to score.
+# The groups can come from a projection query, since only their keys and names
+# are used.
+def score_groups(groups, today=None):
+    today = today or datetime.date.today()
+
+    # these only need keys, so they're cheap even for a big community.  groups
+    # that haven't been given a rank key yet end up at the bottom.
+    ranked = Group.query_by_rank().fetch(keys_only=True)
+    positions = dict((key, i) for (i, key) in enumerate(ranked))
+    cutoff = today - datetime.timedelta(days=ROSTER_DAYS)
+    active = set(Group.query(Group.rosterupdated >= cutoff).fetch(keys_only=True))
+
+    kills = recent_kills(today)
+
+    total = max(len(ranked), 1)
+    scores = dict()
+    for group in groups:
+        score = kills.get(group.name, 0.0)
+        if group.key in positions:
+            score += RANK_WEIGHT * (1.0 - float(positions[group.key]) / total)
+        if group.key in active:
+            score += ROSTER_WEIGHT
+        scores[group.key] = score
+    return scores
+
+# Orders groups for building, highest score first and then by name.  Takes the
+# groups from a projection query (anything with a key and a name will do) and
+# returns them along with the list of (name, score) pairs for the front of the
+# order, for the report.
+def order_groups(groups, today=None):
+    scores = score_groups(groups, today)
+    ordered = sorted(groups, key=lambda group: (-scores[group.key], group.name))
+    report = [(group.name, round(scores[group.key], 2)) for group in ordered[:REPORT_SIZE]]
+
+    logging.info('Build order starts with: %s',
+                 ', '.join('%s (%.2f)' % (name, score) for (name, score) in report[:10]))
+    return (ordered, report)
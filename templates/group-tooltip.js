@@ -1,3 +0,0 @@
-    tooltips["{{ name | normalize }}-{{ raid }}-mythic-header"] = "{{ mythictext }}";
-    tooltips["{{ name | normalize }}-{{ raid }}-heroic-header"] = "{{ heroictext }}";
-    tooltips["{{ name | normalize }}-{{ raid }}-normal-header"] = "{{ normaltext }}";
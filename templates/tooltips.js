@@ -0,0 +1,26 @@
+$(function() {
+  // the tooltips for each group are fetched the first time any of them are
+  // shown, and kept for the rest of the page's life.
+  var version = "{{ digest }}";
+  var groups = {};
+  var suffix = /-[a-z]+-(normal|heroic|mythic)-header$/;
+
+  $(document).tooltip({
+    items: "[ttid]",
+    content: function(callback) {
+      var ttid = $(this).attr("ttid");
+      var split = ttid.search(suffix);
+      if (split < 0) {
+        return;
+      }
+
+      var group = ttid.substring(0, split);
+      if (!groups.hasOwnProperty(group)) {
+        groups[group] = $.getJSON("/tooltips/" + version + "/" + encodeURIComponent(group) + ".json");
+      }
+      groups[group].done(function(tooltips) {
+        callback(tooltips[ttid.substring(split + 1)]);
+      });
+    }
+  });
+});
@@ -5,16 +5,34 @@
 import json
 import logging
 import os
+import random
+import re
 import time
 import base64
+import collections
+import datetime
+import email.utils
 import urllib
+import Queue
 from concurrent import futures
 
 from google.appengine.api import urlfetch
 from google.appengine.api import urlfetch_errors
 from google.appengine.api import memcache
+from google.appengine.ext import ndb
 
 import ctrpmodels
+import metrics
+import ratelimit
+import writebatch
+
+# Request budget for the Blizzard API, shared by every task that talks to it.
+# The API allows 36,000 requests an hour and up to 100 a second, so stay just
+# under the hourly rate on average and let short bursts go higher.
+API_REQUESTS_PER_SECOND = 9.5
+API_BURST_SIZE = 100
+
+api_limiter = ratelimit.TokenBucket('blizzard-api', API_REQUESTS_PER_SECOND, API_BURST_SIZE)
 
 def get_oauth_headers():
 
@@ -26,10 +44,13 @@ def get_oauth_headers():
         credentials = "{}:{}".format(authdata['blizzard_client_id'], authdata['blizzard_client_secret'])
         encoded_credentials = base64.b64encode(credentials)
 
-        response = urlfetch.fetch('https://us.battle.net/oauth/token',
-                                  payload='grant_type=client_credentials',
-                                  method=urlfetch.POST,
-                                  headers={'Authorization': 'Basic ' + encoded_credentials})
+        with metrics.span('oauth') as span:
+            response = urlfetch.fetch('https://us.battle.net/oauth/token',
+                                      payload='grant_type=client_credentials',
+                                      method=urlfetch.POST,
+                                      headers={'Authorization': 'Basic ' + encoded_credentials})
+            if response.status_code != urlfetch.httplib.OK:
+                span.fail()
 
         if response.status_code == urlfetch.httplib.OK:
             response_data = json.loads(response.content)
@@ -47,97 +68,442 @@ def get_oauth_headers():
 
     return {'Authorization': 'Bearer ' + oauth_token}
 
-# Method that gets called by the threadpool.  This will fill in the toondata
-# dict for the requested toon with either data from Battle.net or with an
-# error message to display on the page.  This has to be defined at the
-# module level so that the threadpool can call it correctly.
-def handle_result(name, realm, oauth_headers):
+# Retry settings for requests to the Blizzard API.  Requests that time out,
+# fail on the network or get a throttling or server error response are retried
+# with exponential backoff and full jitter, unless the API says how long to
+# wait with a Retry-After header.
+MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 10.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
-    toondata = dict()
+# The longest wait a Retry-After header is honoured for, in seconds.  If the API
+# asks for a longer wait than this the request gives up instead, since trying
+# again any sooner would only spend quota on another throttled response.
+RETRY_AFTER_MAX = 60.0
 
-    url = 'https://us.api.blizzard.com/wow/character/%s/%s?fields=progression,items&locale=en_US' % (realm, urllib.quote(name.encode('utf-8')))
+# Response codes that mean the API wants us to slow down.
+THROTTLE_STATUSES = (429, 503)
+
+# Returns the number of seconds to wait before the next attempt at a request
+# that has failed attempt+1 times, or None if the API asked for a longer wait
+# than RETRY_AFTER_MAX and the request shouldn't be retried.
+def retry_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        try:
+            delay = max(0.0, float(retry_after))
+        except ValueError:
+            # Retry-After can also be an HTTP date.  fall back to the normal
+            # backoff for those.
+            delay = None
+        if delay is not None:
+            return delay if delay <= RETRY_AFTER_MAX else None
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+def error_result(name, reason):
+    return {'toon': name, 'status': 'nok', 'reason': reason}
+
+# Makes a single attempt at a request.  Returns the response (or None if the
+# request failed), the reason for the failure and whether or not the request
+# is worth trying again.
+def fetch_once(url, name, oauth_headers):
     try:
         response = urlfetch.fetch(url, headers=oauth_headers)
     except urlfetch_errors.DeadlineExceededError:
         logging.error('urlfetch threw DeadlineExceededError on toon %s', name.encode('ascii', 'ignore'))
-        toondata['toon'] = name
-        toondata['status'] = 'nok'
-        toondata['reason'] = 'Timeout retrieving data from Battle.net for %s.  Refresh page to try again.' % name
-        return toondata
+        return (None, 'Timeout retrieving data from Battle.net for %s.  Refresh page to try again.' % name, True)
     except urlfetch_errors.DownloadError:
         logging.error('urlfetch threw DownloadError on toon %s', name.encode('ascii', 'ignore'))
-        toondata['toon'] = name
-        toondata['status'] = 'nok'
-        toondata['reason'] = 'Network error retrieving data from Battle.net for toon %s.  Refresh page to try again.' % name
-        return toondata
+        return (None, 'Network error retrieving data from Battle.net for toon %s.  Refresh page to try again.' % name, True)
     except:
         logging.error('urlfetch threw unknown exception on toon %s', name.encode('ascii', 'ignore'))
-        toondata['toon'] = name
-        toondata['status'] = 'nok'
-        toondata['reason'] = 'Unknown error retrieving data from Battle.net for toon %s.  Refresh page to try again.' % name
-        return toondata
-
-    # change the json from the response into a dict of data and store it
-    # into the toondata object that was passed in.
-    jsondata = json.loads(response.content)
-    toondata.update(jsondata)
-
-    # Blizzard's API will return an error if it couldn't retrieve the data
-    # for some reason.  Check for this and log it if it fails.  Note that
-    # this response doesn't contain the toon's name so it has to be added
-    # in afterwards.
-    if jsondata.get('status', 'ok') == 'nok':
-        logging.error('Blizzard API failed to find toon %s for reason: %s',
-                      name.encode('ascii', 'ignore'), jsondata['reason'])
-        toondata['toon'] = name
-        toondata['status'] = 'nok'
-        toondata['reason'] = "Error retrieving data for %s from Blizzard API: %s" % (name, jsondata['reason'])
-        return toondata
-
-    # we get all of the data here, but we want to filter out just the raids
-    # we care about so that it's not so much data returned from the importer
-    if toondata['progression'] is not None:
-        toondata['progression']['raids'] = [r for r in toondata['progression']['raids'] if r['name'] in ctrpmodels.Constants.raidnames]
+        return (None, 'Unknown error retrieving data from Battle.net for toon %s.  Refresh page to try again.' % name, False)
+
+    if response.status_code in RETRY_STATUSES:
+        logging.error('Battle.net returned status %d on toon %s', response.status_code, name.encode('ascii', 'ignore'))
+        return (response, 'Battle.net returned status %d for toon %s.  Refresh page to try again.' % (response.status_code, name), True)
+
+    return (response, None, False)
+
+# Method that gets called by the threadpool.  This will fill in the toondata
+# dict for the requested toon with either data from Battle.net or with an
+# error message to display on the page.  This has to be defined at the
+# module level so that the threadpool can call it correctly.  If there's a
+# cached copy of the toon, the request is made conditional on the toon having
+# changed since it was cached and the cached copy is returned if it hasn't.
+def handle_result(name, realm, oauth_headers, concurrency=None, cached=None):
+
+    url = 'https://us.api.blizzard.com/wow/character/%s/%s?fields=progression,items&locale=en_US' % (realm, urllib.quote(name.encode('utf-8')))
+
+    headers = dict(oauth_headers)
+    if cached is not None:
+        if cached.lastmodified:
+            headers['If-Modified-Since'] = email.utils.formatdate(cached.lastmodified / 1000.0, usegmt=True)
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+
+    for attempt in xrange(MAX_ATTEMPTS):
+
+        # wait for a free slot in the importer and then for our turn against
+        # the shared request budget
+        if concurrency is not None:
+            seq = concurrency.acquire()
+        api_limiter.acquire()
+
+        with metrics.span('fetch') as span:
+            (response, reason, retry) = fetch_once(url, name, headers)
+            if reason is not None:
+                span.fail()
+
+        if concurrency is not None:
+            throttled = response is not None and response.status_code in THROTTLE_STATUSES
+            concurrency.release(seq, throttled)
+
+        if not retry:
+            break
+
+        if attempt + 1 < MAX_ATTEMPTS:
+            retry_after = None
+            if response is not None:
+                retry_after = response.headers.get('Retry-After')
+            delay = retry_delay(attempt, retry_after)
+            if delay is None:
+                logging.error('Giving up on toon %s: Battle.net asked to wait %s seconds',
+                              name.encode('ascii', 'ignore'), retry_after)
+                break
+            logging.info('Retrying toon %s in %f seconds (attempt %d of %d)',
+                         name.encode('ascii', 'ignore'), delay, attempt + 2, MAX_ATTEMPTS)
+            time.sleep(delay)
+
+    if reason is not None:
+        # a stale copy of the toon is still better than dropping it from the
+        # group entirely.
+        if cached is not None:
+            logging.info('Using cached data for toon %s after failed request', name.encode('ascii', 'ignore'))
+            toondata = cached.to_toondata()
+            toondata['stale'] = True
+            return toondata
+        return error_result(name, reason)
+
+    if response.status_code == 304 and cached is not None:
+        return cached.to_toondata()
+
+    # pull just the fields the ranker uses out of the response.  if the
+    # response doesn't look like a normal character, decode the whole thing
+    # to find out what happened.
+    with metrics.span('parse'):
+        toondata = project_character(response.content)
+        if toondata is None:
+            jsondata = json.loads(response.content)
+
+            # Blizzard's API will return an error if it couldn't retrieve the data
+            # for some reason.  Check for this and log it if it fails.  Note that
+            # this response doesn't contain the toon's name so it has to be added
+            # in afterwards.
+            if jsondata.get('status', 'ok') == 'nok':
+                logging.error('Blizzard API failed to find toon %s for reason: %s',
+                              name.encode('ascii', 'ignore'), jsondata['reason'])
+                return error_result(name, "Error retrieving data for %s from Blizzard API: %s" % (name, jsondata['reason']))
+
+            toondata = project_decoded(jsondata)
+
+    toondata['name'] = name
+
+    # the API doesn't always honor the conditional headers, so also check if
+    # the character is unchanged from the cached copy.
+    if cached is not None and cached.lastmodified and toondata['lastModified'] == cached.lastmodified:
+        return cached.to_toondata()
+
+    if response.headers.get('ETag'):
+        toondata['etag'] = response.headers.get('ETag')
+
+    return toondata
+
+# The top-level numeric fields of a character response that the ranker uses.
+# With fields=progression,items each of these keys appears exactly once in a
+# response, so they can be found without walking the rest of it.
+_SCALAR_FIELDS = dict((field, re.compile(r'"%s"\s*:\s*(-?\d+)' % field))
+                      for field in ('level', 'lastModified', 'averageItemLevelEquipped'))
+
+# Finds the name field of the raid objects for the current tier.
+_RAID_NAMES = [(raidname, re.compile(r'"name"\s*:\s*%s' % re.escape(json.dumps(raidname))))
+               for raidname in ctrpmodels.Constants.raidnames]
+
+_decoder = json.JSONDecoder()
 
+# Pulls the fields the ranker uses out of a character response without
+# decoding all of it: the level, the last modified time, the equipped item
+# level and the raid objects for the current tier.  The rest of the items and
+# all of the old raids, which make up almost all of the response, are never
+# turned into objects.  Returns None if the response doesn't look the way
+# this expects, and the caller should decode the whole thing instead.
+def project_character(content):
+
+    values = dict()
+    for (field, pattern) in _SCALAR_FIELDS.iteritems():
+        if content.count('"%s"' % field) != 1:
+            return None
+        match = pattern.search(content)
+        if match is None:
+            return None
+        values[field] = int(match.group(1))
+
+    # each raid object has its name as the first field, so the raid starts at
+    # the brace before its name.  anything that doesn't decode to a raid with
+    # that name means the assumption didn't hold.
+    raids = list()
+    for (raidname, pattern) in _RAID_NAMES:
+        for match in pattern.finditer(content):
+            start = content.rfind('{', 0, match.start())
+            try:
+                (raid, _) = _decoder.raw_decode(content, start)
+            except ValueError:
+                return None
+            if not isinstance(raid, dict) or raid.get('name') != raidname or 'bosses' not in raid:
+                return None
+            raids.append(raid)
+
+    return {
+        'level': values['level'],
+        'lastModified': values['lastModified'],
+        'items': {'averageItemLevelEquipped': values['averageItemLevelEquipped']},
+        'progression': {'raids': raids},
+    }
+
+# Trims a fully decoded character response down to the same fields that
+# project_character returns.
+def project_decoded(jsondata):
+    toondata = {
+        'level': jsondata.get('level', 0),
+        'lastModified': jsondata.get('lastModified', 0),
+    }
+    if jsondata.get('items') is not None:
+        toondata['items'] = {'averageItemLevelEquipped': jsondata['items']['averageItemLevelEquipped']}
+
+    # we get all of the raid data here, but we only want the raids we care
+    # about so that it's not so much data returned from the importer
+    if jsondata.get('progression') is not None:
+        toondata['progression'] = {'raids': [r for r in jsondata['progression']['raids']
+                                             if r['name'] in ctrpmodels.Constants.raidnames]}
     return toondata
 
+# Splits a toon from a group roster into its name and normalized realm.  Toons
+# without a realm are on Aerie Peak.
+def split_toon(toon):
+    name = toon
+    realm = 'aerie-peak'
+    if '/' in toon:
+        (name, realm) = toon.split('/')
+        # normalize the realm name
+        realm = realm.lower().replace('\'', '').replace(' ', '-')
+    return (name, realm)
+
+# Returns the key used to identify a single character across all of the group
+# rosters.  Character names aren't case sensitive in the API.
+def toon_key(name, realm):
+    return ('%s/%s' % (name.lower(), realm)).encode('utf-8')
+
+# Shared store of the toon data for a single ranking run.  The fetch stage of a
+# run loads every distinct toon into this store once, and the builder tasks for
+# the groups read from it instead of going back to Battle.net for toons that
+# are on more than one roster.
+class ToonStore(object):
+
+    # how long the data is kept around for, in seconds.  a run should never
+    # take anywhere near this long.
+    EXPIRATION = 6 * 60 * 60
+
+    def __init__(self, run_id):
+        self.namespace = 'run-%s' % run_id
+
+    def get_multi(self, keys):
+        return memcache.get_multi(keys, namespace=self.namespace)
+
+    def put_multi(self, toondata):
+        if toondata:
+            memcache.set_multi(toondata, time=self.EXPIRATION, namespace=self.namespace)
+
+    # keeps count of the toons the builders had to fetch themselves because
+    # they weren't in the store, so the run report can account for them.
+    def record_misses(self, count):
+        memcache.incr('misses', delta=count, namespace=self.namespace, initial_value=0)
+
+    def get_misses(self):
+        return int(memcache.get('misses', namespace=self.namespace) or 0)
+
+    # keeps count of the groups an incremental run skipped because none of
+    # their toons had changed since they were last built.
+    def record_unchanged(self):
+        memcache.incr('unchanged', namespace=self.namespace, initial_value=0)
+
+    def get_unchanged(self):
+        return int(memcache.get('unchanged', namespace=self.namespace) or 0)
+
 class Importer(object):
 
-    def load(self, toonlist, data):
+    # The most requests a single importer will have in flight at once.  The
+    # importer starts out at this limit, halves it whenever the API throttles
+    # a request and slowly grows it back as requests succeed.
+    MAX_WORKERS = 7
+
+    # The number of requests handed to the threadpool ahead of the results
+    # being used, and the number of toon cache entries read or written at a
+    # time.  Anything more than this is only memory held for no reason.
+    MAX_QUEUED = 2 * MAX_WORKERS
+    BATCH_SIZE = 50
+
+    def __init__(self):
+        self.concurrency = ratelimit.AdaptiveConcurrency(self.MAX_WORKERS)
+
+        # counts of the toons that were served from the cache, either because
+        # they were checked recently or because the API said they hadn't
+        # changed
+        self.cache_hits = 0
+        self.not_modified = 0
+
+    # Fetches the data for each of the (name, realm) pairs in toons and yields
+    # each pair along with its toon data as the requests complete.  Toons in
+    # the cache that were checked recently enough are returned without going
+    # to the API at all, and the cache is updated with the results of the
+    # requests that were made.
+    def fetch(self, toons):
+
+        if not toons:
+            return
 
-        oauth_headers = get_oauth_headers()
         start = time.time()
 
+        # look the toons up in the cache a batch at a time, since ndb's
+        # bookkeeping for a get costs a lot more memory than the entries do
+        now = datetime.datetime.utcnow()
+        pending = collections.deque()
+        for i in xrange(0, len(toons), self.BATCH_SIZE):
+            batch = toons[i:i+self.BATCH_SIZE]
+            keys = [ndb.Key(ctrpmodels.ToonCache, toon_key(name, realm)) for (name, realm) in batch]
+            for (toon, entry) in zip(batch, ndb.get_multi(keys)):
+                if entry is not None and entry.is_fresh(now):
+                    self.cache_hits += 1
+                    yield (toon, entry.to_toondata())
+                else:
+                    pending.append((toon, entry))
+
+        if not pending:
+            logging.info("All %d toons were fresh in the cache", len(toons))
+            return
+
+        oauth_headers = get_oauth_headers()
+
         # Create a threadpool to use to make the URL requests to the Blizzard
         # API. This used to use the urlfetch async methods but I need finer
         # control over how many are running at a time since I'm bumping against
-        # the API's quotas for free accounts.
-        executor = futures.ThreadPoolExecutor(max_workers=7)
+        # the API's quotas for free accounts.  The overall request rate across
+        # all of the tasks is governed by api_limiter.  The threads record
+        # their spans for the same ranking run as the caller.
+        executor = futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS,
+                                              initializer=metrics.set_run,
+                                              initargs=(metrics.current_run(),))
         fs = dict()
 
-        # Request all of the toon data from the blizzard API and determine the
-        # group's ilvls, armor type counts and token type counts.  subs are not
-        # included in the counts, since they're not really part of the main
-        # group.
-        for toon in toonlist:
-            realm = 'aerie-peak'
-            if '/' in toon:
-                (toon, realm) = toon.split('/')
-                # normalize the realm name
-                realm = realm.lower().replace('\'', '').replace(' ', '-')
-            fs[executor.submit(handle_result, toon, realm, oauth_headers)] = toon
-
-        # Loop through all of the futures created above and handle each one as
-        # they complete.  The return value from the future is the toon data.
-        for future in futures.as_completed(fs):
-            toon = fs[future]
-            if future.exception() is not None:
-                logging.info("wowapi generated exception for %s: %s", toon, future.exception())
-            else:
+        # Completed futures are handed back through a queue instead of with
+        # futures.as_completed, which holds on to every future (and with them
+        # every response) until all of them are done.  Only MAX_QUEUED toons
+        # are handed to the pool at once, with the next one submitted as each
+        # one is used, so that each response can be dropped as soon as the
+        # caller is finished with it and nothing is held for the toons that
+        # haven't been sent yet besides their names and cache entries.
+        done = Queue.Queue()
+        misses = len(pending)
+        def submit():
+            if pending:
+                ((name, realm), entry) = pending.popleft()
+                future = executor.submit(handle_result, name, realm, oauth_headers,
+                                         self.concurrency, entry)
+                fs[future] = ((name, realm), entry)
+                future.add_done_callback(done.put)
+
+        for _ in xrange(self.MAX_QUEUED):
+            submit()
+
+        # Handle each of the futures created above as they complete.  The
+        # return value from the future is the toon data.  The cache entries
+        # are written a batch at a time as the results come in, instead of all
+        # at the end.
+        with writebatch.WriteBatcher(self.BATCH_SIZE, max_pending=1) as writer:
+            while fs:
+                future = done.get()
+                (toon, entry) = fs.pop(future)
+                submit()
+                if future.exception() is not None:
+                    logging.info("wowapi generated exception for %s: %s", toon[0], future.exception())
+                    continue
+
                 returnval = future.result()
-                data.append(returnval)
-        fs.clear()
+                if returnval.get('stale', False):
+                    # the request failed and the old cached copy was used
+                    pass
+                elif returnval.get('cached', False):
+                    # the toon hasn't changed.  just note when it was checked.
+                    self.not_modified += 1
+                    entry.checked = now
+                    writer.put(entry)
+                elif returnval.get('status', 'ok') != 'nok':
+                    writer.put(ctrpmodels.ToonCache.from_toondata(
+                        toon_key(toon[0], toon[1]), returnval, returnval.pop('etag', None)))
+                yield (toon, returnval)
+            executor.shutdown(wait=False)
+
+            with metrics.span('toons.write'):
+                writer.flush()
 
         end = time.time()
 
         logging.info("Time spent retrieving data: %f seconds", (end-start))
+        logging.info("Toon cache: %d fresh, %d not modified, %d fetched",
+                     self.cache_hits, self.not_modified, misses - self.not_modified)
+        logging.info("Importer concurrency limit is now %d", self.concurrency.current())
+
+    # Loads the data for every toon in toonlist into data, which can be a list
+    # or anything else with an append method (like a progression.GroupTally,
+    # which folds each toon in as it arrives).  If a store is passed, toons
+    # that are already in it are read from there and any toons that had to be
+    # fetched are added to it.
+    def load(self, toonlist, data, store=None):
+
+        toons = [split_toon(toon) for toon in toonlist]
+
+        if store is not None:
+            found = store.get_multi([toon_key(name, realm) for (name, realm) in toons])
+            missing = list()
+            for (name, realm) in toons:
+                key = toon_key(name, realm)
+                if key in found:
+                    data.append(found[key])
+                else:
+                    missing.append((name, realm))
+
+            logging.info('Found %d of %d toons in the run store', len(found), len(toons))
+            toons = missing
+            if toons:
+                store.record_misses(len(toons))
+
+        # only hang on to the toons if they're going in the store, so that
+        # each one can be dropped once data has it
+        fetched = dict()
+        for ((name, realm), toondata) in self.fetch(toons):
+            data.append(toondata)
+            if store is not None and toondata.get('status', 'ok') != 'nok':
+                fetched[toon_key(name, realm)] = toondata
+
+        if store is not None:
+            store.put_multi(fetched)
+
+    # Fetch stage of a ranking run.  Loads the data for every toon in toonlist
+    # into the store.  Toons that fail to load are left out so that the
+    # builder for their group tries them again.
+    def prefetch(self, toonlist, store):
+        fetched = dict()
+        for ((name, realm), toondata) in self.fetch([split_toon(toon) for toon in toonlist]):
+            if toondata.get('status', 'ok') != 'nok':
+                fetched[toon_key(name, realm)] = toondata
+        store.put_multi(fetched)
+        return len(fetched)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Batches up datastore writes.  Entities handed to a WriteBatcher are held
+# until there are enough of them to fill a batch, then written with a single
+# put_multi_async (or delete_multi_async for keys) while the caller carries on.
+# Everything still pending is written, and every outstanding write waited on,
+# when the batcher is flushed or its with block ends.
+#
+# ndb doesn't send an async write until something waits on a future, so a
+# caller that makes no other datastore calls would hold every batch until the
+# end.  A batcher with max_pending set waits for its oldest batch whenever more
+# than that many are outstanding, which keeps the writes going out and puts a
+# bound on the entities held in memory.
+
+from google.appengine.ext import ndb
+
+# The number of entities written per datastore call by default.  The datastore
+# takes up to 500 per call, but the entities here can be large (a group's
+# roster and progress, or a run's toon cache) and smaller batches let the
+# writes overlap with the work that produces them.
+DEFAULT_BATCH_SIZE = 100
+
+class WriteBatcher(object):
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, max_pending=None):
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.puts = list()
+        self.deletes = list()
+
+        # the futures for each batch that's been sent, oldest first
+        self.futures = list()
+
+        # the number of datastore calls made, for the benchmarks
+        self.calls = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            # don't start any new writes on the way out of an error, but let
+            # the ones that are already running finish
+            ndb.Future.wait_all([future for batch in self.futures for future in batch])
+        return False
+
+    def put(self, entity):
+        self.puts.append(entity)
+        if len(self.puts) >= self.batch_size:
+            self._send_puts()
+
+    def delete(self, key):
+        self.deletes.append(key)
+        if len(self.deletes) >= self.batch_size:
+            self._send_deletes()
+
+    # Writes anything that's still pending and waits for all of the writes to
+    # finish.  Raises the first error from any of them.
+    def flush(self):
+        self._send_puts()
+        self._send_deletes()
+        futures = self.futures
+        self.futures = list()
+        for batch in futures:
+            for future in batch:
+                future.get_result()
+
+    def _send_puts(self):
+        if self.puts:
+            self._sent(ndb.put_multi_async(self.puts))
+            self.puts = list()
+
+    def _send_deletes(self):
+        if self.deletes:
+            self._sent(ndb.delete_multi_async(self.deletes))
+            self.deletes = list()
+
+    def _sent(self, batch):
+        self.futures.append(batch)
+        self.calls += 1
+        if self.max_pending is not None:
+            while len(self.futures) > self.max_pending:
+                for future in self.futures.pop(0):
+                    future.get_result()